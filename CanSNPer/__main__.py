@@ -20,22 +20,72 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 from sys import stderr, argv, version_info, exit
-from os import path, remove, makedirs, getcwd
-from shutil import copy as shutil_copy
+import sys
+from os import path, remove, rename, makedirs, getcwd, listdir, chdir, symlink
+from os import wait4, setsid, killpg, WIFSIGNALED, WTERMSIG, WEXITSTATUS, WNOHANG, _exit
 from uuid import uuid4
 import errno
+import hashlib
 import inspect
+import itertools
 import getpass
+import json
 import time
-import pkg_resources
+import traceback
 
 import argparse
 import re
 import sqlite3
 
+from multiprocessing import Pool, BoundedSemaphore, cpu_count
+from signal import signal, SIGTERM
 from subprocess import Popen
-
-import ete2
+from StringIO import StringIO
+
+import numpy
+
+from scheme import load_scheme
+from flanks import load_flank_index
+from reads import load_read_index, read_fastq
+from results import scheme_version, query_hash, result_options, load_result, save_result
+from results import fill_warning
+from sequences import store_sequence, delete_sequences
+from database import create_tables, migrate_database, tree_edges, tree_rows, build_tree_index, data_changes
+from database import SCHEMA_VERSION
+from sequences import sequence_strains, stream_sequence
+from x2fa import write_fasta
+from aligners import ALIGNERS, make_aligner
+from windows import snp_windows, mini_reference, windows_header, read_windows, window_offsets, lift
+from matrix import SnpColumns, AlleleMatrix
+from profiling import SampleProfile, CountingCursor, profile_stage
+from newick import write_newick, read_newick
+from fasta import fasta_chunks, read_fasta, copy_fasta, is_compressed, REFERENCE_BASES, QUERY_BASES
+from server import TypingServer, send_job, JOB_OPTIONS
+from workspace import Workspace, remove_directory
+
+# File name endings of the files picked up from a --query directory
+FASTA_EXTENSIONS = (".fa", ".fasta", ".fna", ".fas", ".ffn",
+                    ".fa.gz", ".fasta.gz", ".fna.gz", ".fas.gz", ".ffn.gz")
+READS_EXTENSIONS = (".fastq", ".fq", ".fastq.gz", ".fq.gz")
+
+# Set in the worker processes of type_in_parallel, the shared budget of
+# progressiveMauve processes and what the worker needs to type a sample
+ALIGNMENT_SLOTS = None
+SAMPLE_WORKER = dict()
+
+# The process groups of the aligners run_alignments has running, so that a
+# stopped worker can stop them without going through run_alignments
+ALIGNER_GROUPS = set()
+
+# Seconds between the checks of the workspace quota while alignments run
+QUOTA_INTERVAL = 0.5
+
+# Seconds between the checks for finished aligner processes
+WAIT_INTERVAL = 0.05
+
+# Kept by a --serve server, the scheme and index of each organism and
+# typing mode, and the Data_changes count of the database they were loaded at
+WARM_ORGANISMS = dict()
 
 def parse_arguments():
     '''Parses arguments from the command line and sends them to read_config
@@ -58,12 +108,18 @@ def parse_arguments():
     parser = argparse.ArgumentParser(description=cansnper_description)
     parser.add_argument("-r", "--reference",
                         help="the name of the organism")
-    parser.add_argument("-i", "--query",
-                        help="fasta sequence file name that is to be analysed")
+    parser.add_argument("-i", "--query", nargs="+",
+                        help="fasta sequence file name(s) that are to be " +
+                        "analysed, a directory of fasta files or a text " +
+                        "file listing one fasta file name per line")
     parser.add_argument("-b", "--db_path",
                         help="path to CanSNPerDB.db")
     parser.add_argument("--import_tree_file",
-                        help="imports a tree structure into the database")
+                        help="imports a tree structure into the database, " +
+                        "as a text file of paths or in newick format")
+    parser.add_argument("--export_tree_file",
+                        help="writes the tree of the organism in the " +
+                        "database to a file in newick format")
     parser.add_argument("--import_snp_file",
                         help="imports a list of SNPs into the database")
     parser.add_argument("--import_seq_file",
@@ -83,8 +139,62 @@ def parse_arguments():
                         "of the query sequence")
     parser.add_argument("-m", "--progressiveMauve",
                         help="path to progressiveMauve binary file")
+    parser.add_argument("--aligner", choices=sorted(ALIGNERS),
+                        help="what the query is aligned to the reference " +
+                        "sequences with in align mode [progressiveMauve]")
+    parser.add_argument("--nucmer",
+                        help="path to the nucmer binary file of MUMmer")
+    parser.add_argument("--minimap2",
+                        help="path to minimap2 binary file")
+    parser.add_argument("--snp_window", type=int,
+                        help="align the query only to the bases within this " +
+                        "many bases of each SNP, joined into a mini-reference " +
+                        "per strain, instead of to the whole reference " +
+                        "sequences; 0 aligns to the whole sequences [0]")
     parser.add_argument("-l", "--list_snps", action="store_true",
                         help="lists the SNPs of the given sequence")
+    parser.add_argument("--snp_matrix",
+                        help="write the SNP alleles of all the queries as " +
+                        "one matrix, to <SNP_MATRIX>.tsv and .npy, with " +
+                        "the index of the SNPs in <SNP_MATRIX>.npz")
+    parser.add_argument("--profile",
+                        help="write the wall time, CPU time and memory " +
+                        "of each stage and each aligner process, " +
+                        "the number of database queries and of tree nodes " +
+                        "visited, as one JSON record per sample per line of " +
+                        "this file")
+    parser.add_argument("--lineage", action="store_true",
+                        help="also print the path from the root of the " +
+                        "tree to the node each query is classified as")
+    parser.add_argument("--clade_counts",
+                        help="write the number of queries classified as " +
+                        "each node of the tree, and in the clade under it, " +
+                        "to this file")
+    parser.add_argument("--mode", choices=["align", "flank", "reads"],
+                        help="how the query is typed; align aligns it to " +
+                        "the reference sequences, see --aligner, " +
+                        "flank looks up the bases on either side of each " +
+                        "SNP in the query without aligning, reads counts " +
+                        "the SNP k-mers in FASTQ files of raw reads [align]")
+    parser.add_argument("--flank_length", type=int,
+                        help="number of bases on each side of a SNP that " +
+                        "must match in flank mode [20]")
+    parser.add_argument("--kmer_length", type=int,
+                        help="length of the SNP k-mers counted in reads " +
+                        "mode [31]")
+    parser.add_argument("--min_depth", type=int,
+                        help="number of reads needed to call a SNP in " +
+                        "reads mode [3]")
+    parser.add_argument("--alignment_stats", action="store_true",
+                        help="write the identity, aligned coverage and gap " +
+                        "fraction of the alignment to each reference, in " +
+                        "total and per window, to <query>_alignment_stats.txt")
+    parser.add_argument("--stats_window", type=int,
+                        help="window size of the per-window alignment " +
+                        "statistics [10000]")
+    parser.add_argument("--no_result_cache", action="store_true",
+                        help="type every query even if the database has a " +
+                        "result for the same sequence, scheme and options")
     parser.add_argument("-v", "--verbose", action="store_true",
                         help="prints some more information about the " +
                         "goings-ons of the program while running")
@@ -94,7 +204,21 @@ def parse_arguments():
                         help="maximum number of threads CanSNPer is " +
                         "allowed to use, the default [0] is no limit, " +
                         "CanSNPer will start one process per " +
-                        "reference genome while aligning", type=int, default=0)
+                        "reference genome while aligning. With " +
+                        "--parallel_samples this is the number of " +
+                        "alignments all samples may run at once, [0] is " +
+                        "then one per CPU", type=int, default=0)
+    parser.add_argument("--serve",
+                        help="run as a server on this Unix socket, typing " +
+                        "the queries sent with --socket while keeping the " +
+                        "schemes and references of each organism loaded")
+    parser.add_argument("--socket",
+                        help="send the queries to the CanSNPer server " +
+                        "listening on this Unix socket instead of typing " +
+                        "them here, needs --reference")
+    parser.add_argument("--parallel_samples", type=int,
+                        help="number of samples typed at the same time, " +
+                        "each in its own process [1]")
     parser.add_argument("-delete_organism", action="store_true",
                         help="deletes all information in the database " +
                         "concerning an organism")
@@ -102,6 +226,18 @@ def parse_arguments():
                         help="initialise a new table for an organism")
     parser.add_argument("-f", "--tmp_path",
                         help="where temporary files are stored")
+    parser.add_argument("--reference_cache",
+                        help="where reference sequences and their " +
+                        "progressiveMauve index files are kept between " +
+                        "runs [<tmp_path>/reference_cache]")
+    parser.add_argument("--workspace",
+                        help="where each run makes a private directory for " +
+                        "the tmp files of its alignments, removed when it " +
+                        "ends, e.g. /dev/shm to keep them in memory [<tmp_path>]")
+    parser.add_argument("--workspace_quota", type=int,
+                        help="the most megabytes the tmp files of a run may " +
+                        "use, checked while the alignments run; a run that " +
+                        "goes over is stopped. The default [0] is no limit")
     parser.add_argument("-q", "--dev", action="store_true", help="dev mode")
     parser.add_argument("--galaxy", action="store_true",
                         help="argument used if Galaxy is running CanSNPer, " +
@@ -135,15 +271,30 @@ def read_config(args):
     version = '1.0.8'
 
     config_list = {"tmp_path": "string",
+                   "reference_cache": "string",
+                   "workspace": "string",
+                   "workspace_quota": "int",
                    "db_path": "string",
                    "mauve_path": "string",
-                   "x2fa_path": "string",
+                   "aligner": "string",
+                   "nucmer_path": "string",
+                   "minimap2_path": "string",
+                   "snp_window": "int",
                    "num_threads": "int",
+                   "parallel_samples": "int",
                    "verbose": "boolean",
                    "allow_differences": "int",
                    "save_align": "boolean",
                    "draw_tree": "boolean",
                    "list_snps": "boolean",
+                   "lineage": "boolean",
+                   "mode": "string",
+                   "flank_length": "int",
+                   "kmer_length": "int",
+                   "min_depth": "int",
+                   "alignment_stats": "boolean",
+                   "stats_window": "int",
+                   "result_cache": "boolean",
                    "reference": "string",
                    "tab_sep": "boolean",
                    "dev": "boolean",
@@ -154,21 +305,43 @@ def read_config(args):
 
     # Default settings
     config["tmp_path"] = "/tmp/CanSNPer_%s/" % user
+    config["reference_cache"] = None  # Set below, defaults to a folder in tmp_path
+    config["workspace"] = None  # Set below, defaults to tmp_path
+    config["workspace_quota"] = 0
     config["db_path"] = None
     config["mauve_path"] = "progressiveMauve"  # In your PATH
-    config["x2fa_path"] = "x2fa.py"  # In your PATH
+    config["aligner"] = "progressiveMauve"
+    config["nucmer_path"] = "nucmer"  # In your PATH
+    config["minimap2_path"] = "minimap2"  # In your PATH
+    config["snp_window"] = 0
     config["allow_differences"] = 0
     config["num_threads"] = 0
+    config["parallel_samples"] = 1
     config["tab_sep"] = False
     config["verbose"] = False
     config["save_align"] = False
     config["draw_tree"] = False
     config["list_snps"] = False
+    config["lineage"] = False
+    config["snp_matrix"] = None
+    config["profile"] = None
+    config["clade_counts"] = None
+    config["serve"] = None
+    config["socket"] = None
+    config["mode"] = "align"
+    config["flank_length"] = 20
+    config["kmer_length"] = 31
+    config["min_depth"] = 3
+    config["alignment_stats"] = False
+    config["stats_window"] = 10000
+    config["result_cache"] = True
     config["reference"] = None
     config["dev"] = False
     config["galaxy"] = False
-    config["query"] = None
+    config["query"] = None  # The queries as given, for the messages, see query_files
+    config["query_files"] = None
     config["import_tree_file"] = None
+    config["export_tree_file"] = None
     config["import_snp_file"] = None
     config["import_seq_file"] = None
     config["strain_name"] = None
@@ -181,11 +354,14 @@ def read_config(args):
     if args.reference:
         config["reference"] = args.reference
     if args.query:
-        config["query"] = args.query
+        config["query_files"] = args.query
+        config["query"] = " ".join(args.query)
     if args.db_path:
         config["db_path"] = args.db_path
     if args.import_tree_file:
         config["import_tree_file"] = args.import_tree_file
+    if args.export_tree_file:
+        config["export_tree_file"] = args.export_tree_file
     if args.import_snp_file:
         config["import_snp_file"] = args.import_snp_file
     if args.import_seq_file:
@@ -200,14 +376,50 @@ def read_config(args):
         config["draw_tree"] = True
     if args.progressiveMauve:
         config["mauve_path"] = args.progressiveMauve
+    if args.aligner:
+        config["aligner"] = args.aligner
+    if args.nucmer:
+        config["nucmer_path"] = args.nucmer
+    if args.minimap2:
+        config["minimap2_path"] = args.minimap2
+    if args.snp_window:
+        config["snp_window"] = int(args.snp_window)
     if args.list_snps:
         config["list_snps"] = True
+    if args.lineage:
+        config["lineage"] = True
+    if args.snp_matrix:
+        config["snp_matrix"] = args.snp_matrix
+    if args.profile:
+        config["profile"] = args.profile
+    if args.clade_counts:
+        config["clade_counts"] = args.clade_counts
+    if args.serve:
+        config["serve"] = args.serve
+    if args.socket:
+        config["socket"] = args.socket
+    if args.mode:
+        config["mode"] = args.mode
+    if args.flank_length:
+        config["flank_length"] = int(args.flank_length)
+    if args.kmer_length:
+        config["kmer_length"] = int(args.kmer_length)
+    if args.min_depth:
+        config["min_depth"] = int(args.min_depth)
+    if args.alignment_stats:
+        config["alignment_stats"] = True
+    if args.stats_window:
+        config["stats_window"] = int(args.stats_window)
+    if args.no_result_cache:
+        config["result_cache"] = False
     if args.verbose:
         config["verbose"] = True
     if args.save_align:
         config["save_align"] = True
     if args.num_threads:
         config["num_threads"] = int(args.num_threads)
+    if args.parallel_samples:
+        config["parallel_samples"] = int(args.parallel_samples)
     if args.delete_organism:
         config["delete_organism"] = True
     if args.initialise_organism:
@@ -216,6 +428,16 @@ def read_config(args):
         config["galaxy"] = True
     if args.tmp_path:
         config["tmp_path"] = args.tmp_path
+    if args.reference_cache:
+        config["reference_cache"] = args.reference_cache
+    else:
+        config["reference_cache"] = "%s/reference_cache/" % config["tmp_path"]
+    if args.workspace:
+        config["workspace"] = args.workspace
+    else:
+        config["workspace"] = config["tmp_path"]
+    if args.workspace_quota:
+        config["workspace_quota"] = int(args.workspace_quota)
     if config["dev"]:  # Developer printout
         print("#[DEV] configurations:%s" % config)
     if config["verbose"]:
@@ -258,21 +480,17 @@ def get_strain(organism, config, c):
 
 def select_table(c):
     '''Returns an organism name chosen by the user.'''
-    c.execute("SELECT name FROM sqlite_master WHERE type='table' ORDER BY name")
+    c.execute("SELECT Name FROM Organisms ORDER BY Name")
     tables = c.fetchall()
 
-    # You are not supposed to be able to pick one of these
-    tables_NOT_to_list = ["Sequences", "Tree"]
-
     table_list = list()
     db_name = ""
 
-    # print(the tables and enter them into table list, for cross-checking the user input)
+    # print(the organisms and enter them into table list, for cross-checking the user input)
     print("The organisms currently in the database are:")
     for table in tables:
-        if not table[0] in tables_NOT_to_list:
-            print(table[0])
-            table_list.append(table[0])
+        print(table[0])
+        table_list.append(table[0])
     while True:
         db_name = raw_input("Choose one: ")
         if db_name in table_list:  # Spell-check!
@@ -289,7 +507,7 @@ def select_strain(db_name, c):
     db_name -- the organism (or as named here, database)
 
     '''
-    c.execute("SELECT DISTINCT Strain FROM %s" % db_name)
+    c.execute("SELECT DISTINCT Strain FROM SNPs WHERE Organism = ?", (db_name,))
     rows = c.fetchall()
     strain_list = list()
 
@@ -325,8 +543,8 @@ def silent_remove(file_name):
 def initialise_table(config, c):
     '''Initialises a table in the SQLite3 database.
 
-    Prompts the user for an organism name that is
-    used as the table name.
+    Prompts the user for an organism name, which is
+    added to the Organisms table.
 
     '''
     if config["reference"]:
@@ -338,9 +556,8 @@ def initialise_table(config, c):
             exit("Exiting...")
     try:
         # Try to execute, otherwise spit out the error
-        c.execute("CREATE TABLE IF NOT EXISTS Tree (Name text, Children text, Organism text)")
-        c.execute("CREATE TABLE IF NOT EXISTS Sequences (Organism text, Strain text, Sequence text)")
-        c.execute("CREATE TABLE IF NOT EXISTS %s (SNP text, Reference text, Strain text, Position integer, Derived_base text, Ancestral_base text)" % organism_name)
+        create_tables(c)
+        c.execute("INSERT OR IGNORE INTO Organisms VALUES(?)", (organism_name,))
     except sqlite3.OperationalError as e:
         exit("#[ERROR in %s] SQLite OperationalError: %s" % (config["query"], str(e)))
 
@@ -349,9 +566,14 @@ def purge_organism(config, c):
     '''Removes everything in the SQLite3 database connected to a organism.'''
     db_name = get_organism(config, c)
     if raw_input("Delete everything concerning %s? (Y/N) " % db_name).lower()[0] == "y":
-        c.execute("DROP TABLE %s" % db_name)
+        c.execute("DELETE FROM SNPs WHERE Organism = ?", (db_name, ))
         c.execute("DELETE FROM Sequences WHERE Organism = ?", (db_name, ))
-        c.execute("DELETE FROM Tree WHERE Organism = ?", (db_name, ))
+        delete_sequences(db_name, c)
+        c.execute("DELETE FROM Tree_edges WHERE Organism = ?", (db_name, ))
+        c.execute("DELETE FROM Tree_index WHERE Organism = ?", (db_name, ))
+        c.execute("DELETE FROM Results WHERE Organism = ?", (db_name, ))
+        c.execute("DELETE FROM Organisms WHERE Name = ?", (db_name, ))
+        clear_reference_cache(db_name, None, config)
     else:
         exit("#Nothing happened, promise.")
 
@@ -362,23 +584,15 @@ def import_sequence(file_name, config, c):
     Keyword arguments:
     file_name -- the file name of the fasta file
 
-    The file is checked for non-ATGCN characters and
-    the database is also checked for a sequence for
-    the same strain. If there is one the user is asked
-    whether or not to update the sequence entry.
+    The file is checked for non-ATGCN characters, see
+    check_fasta, and the database is also checked for
+    a sequence for the same strain. If there is one the
+    user is asked whether or not to update the sequence
+    entry.
 
     '''
     print(file_name)
-    seq_file = open(file_name, "r")
-    seq = "".join(seq_file.read().split("\n")[1:])
-    seq_file.close()
-
-    # Going to search for ATCGN and see if that is all we find
-    sequence_validation_regex = re.compile("[ATCGN]+")
-    validation_search = sequence_validation_regex.search(seq)
-    if validation_search.start() != 0 or validation_search.end() != len(seq):
-        message = "#[ERROR in %s] You have a non-ATCGN character in your sequence file at position  % d" % (config["query"], validation_search.end() + 1)
-        exit(message)
+    check_fasta(file_name, config)
 
     organism_name = get_organism(config, c)
     strain_name = get_strain(organism_name, config, c)
@@ -390,7 +604,9 @@ def import_sequence(file_name, config, c):
         if strain_name == row[1] and organism_name == row[0]:  # If an entry was found, set our flag to false
             flag = False
     if flag:  # No entry for this strain name
-        c.execute("INSERT INTO Sequences VALUES(?,?,?)", (organism_name, strain_name, seq))
+        c.execute("INSERT INTO Sequences (Organism, Strain) VALUES(?,?)", (organism_name, strain_name))
+        store_sequence(organism_name, strain_name, fasta_sequence(file_name), c)
+        clear_reference_cache(organism_name, strain_name, config)
     else:  # There was an entry for this strain name, ask for update
         print("This strain name already has a sequence listed in the database. Update entry? (Y/N)")
         while True:
@@ -398,13 +614,43 @@ def import_sequence(file_name, config, c):
             if answer[0].lower() == "n":  # Dont do anything if user doesnt want update
                 break
             elif answer[0].lower() == "y":  # Update Sequences
-                c.execute("UPDATE Sequences SET Sequence = ? WHERE Organism = ? AND Strain = ?",
-                          (seq, organism_name, strain_name))
+                store_sequence(organism_name, strain_name, fasta_sequence(file_name), c)
+                clear_reference_cache(organism_name, strain_name, config)
                 break
             elif answer.lower().strip() == "exit":
                 exit("Exiting...")
 
 
+def check_fasta(file_name, config):
+    '''Checks a reference fasta file for non-ATCGN characters before it is imported.
+
+    Keyword arguments:
+    file_name -- the fasta file, plain or gzip compressed
+
+    The file is streamed one chunk at a time. Exits, naming the record and
+    position of the first character that is not ATCGN, or if the file has
+    no records.
+
+    '''
+    records = 0
+    try:
+        for record, offset, chunk in fasta_chunks(file_name, REFERENCE_BASES):
+            if offset == 0:
+                records += 1
+    except (IOError, ValueError) as e:
+        exit("#[ERROR in %s] Could not import %s: %s" % (config["query"], file_name, str(e)))
+    if not records:
+        exit("#[ERROR in %s] No fasta records in %s" % (config["query"], file_name))
+    if config["verbose"] and records > 1:
+        print("#The %i records of %s are imported one after the other" % (records, file_name))
+
+
+def fasta_sequence(file_name):
+    '''Yields the sequence of a fasta file in chunks, the records one after the other.'''
+    for record, offset, chunk in fasta_chunks(file_name):
+        yield chunk
+
+
 def import_to_db(file_name, config, c):
     '''Imports a textfile of SNP information into the SQLite3 database.
     Lines beginning with # are considered comment lines.
@@ -416,14 +662,16 @@ def import_to_db(file_name, config, c):
     #SNP-name\tOrganism-name\tReference\tStrain\tPosition\tDerived-base\tAncestral-base
     B.1\tFrancisella\tSvensson\tLVS\t23942\tA\tG
 
-    Organism-name isnt used at the moment, the table name is the organism name.
+    Organism-name isnt used at the moment, the SNPs are added to the organism
+    chosen with -r.
 
     '''
     db_name = get_organism(config, c)
 
+    # Read the whole file first, a SNP listed more than once takes the values of its last line
+    snps = dict()
+    snp_order = list()
     snp_file = open(file_name, "r")
-
-    queries = []
     for line in snp_file.readlines():
         if line != "" and line[0] != "#":
             line = line.strip()
@@ -431,22 +679,27 @@ def import_to_db(file_name, config, c):
             unicode_values = list()
             for value in values:
                 unicode_values.append(unicode(value.strip(), encoding="utf8"))
-            snpname = unicode_values[0]
-            c.execute("SELECT SNP from %s WHERE SNP=?" % db_name, (snpname,))
-            if c.fetchone():
-                if len(unicode_values) == 7:
-                    c.execute("UPDATE %s SET Reference = ?, Strain = ?, Position = ?, Derived_base = ?, Ancestral_base = ? WHERE SNP = ?" % db_name,
-                              (unicode_values[2], unicode_values[3], int(unicode_values[4]),
-                               unicode_values[5], unicode_values[6], snpname))
-            else:
-                if len(unicode_values) == 7:
-                    queries.append((snpname, unicode_values[2], unicode_values[3],
-                                   int(unicode_values[4]), unicode_values[5], unicode_values[6]))
-                else:  # Skip line if one of the pieces of information is missing
-                    print("#Skipping:", values)
-    c.executemany("INSERT INTO %s VALUES(?,?,?,?,?,?)" % db_name, queries)
+            if len(unicode_values) == 7:
+                snpname = unicode_values[0]
+                if snpname not in snps:
+                    snp_order.append(snpname)
+                snps[snpname] = (unicode_values[2], unicode_values[3], int(unicode_values[4]),
+                                 unicode_values[5], unicode_values[6])
+            else:  # Skip line if one of the pieces of information is missing
+                print("#Skipping:", values)
     snp_file.close()
 
+    # SNPs already in the table are updated, the rest inserted, all in one transaction
+    with c.connection:
+        c.execute("INSERT OR IGNORE INTO Organisms VALUES(?)", (db_name,))
+        c.execute("SELECT DISTINCT SNP FROM SNPs WHERE Organism = ?", (db_name,))
+        existing = set(row[0] for row in c.fetchall())
+        c.executemany("UPDATE SNPs SET Reference = ?, Strain = ?, Position = ?, Derived_base = ?, Ancestral_base = ? " +
+                      "WHERE Organism = ? AND SNP = ?",
+                      [snps[snpname] + (db_name, snpname) for snpname in snp_order if snpname in existing])
+        c.executemany("INSERT INTO SNPs VALUES(?,?,?,?,?,?,?)",
+                      [(db_name, snpname) + snps[snpname] for snpname in snp_order if snpname not in existing])
+
 
 def import_tree(file_name, config, c):
     '''Imports a tree structure into the SQLite3 database
@@ -463,43 +716,84 @@ def import_tree(file_name, config, c):
     ROOT;N2;N5
     ROOT;N2;N5;N6
 
-    The above structure represents this newick tree,
-    however newick format can not be imported at this time:
+    The above structure represents this newick tree, which can be
+    imported as it is. A file is read as newick if it starts with (
     (N1,(N3,N4,(N6)N5)N2)ROOT;
 
     '''
     organism_name = get_organism(config, c)
     tree_file = open(file_name, "r")
-    text_tree = tree_file.readlines()
-    # Truncate the table
-    c.execute("DELETE FROM Tree WHERE Organism = ?", (organism_name, ))
-    tree_file.close()
+    first_char = tree_file.read(1)
+    while first_char.isspace():
+        first_char = tree_file.read(1)
+    tree_file.seek(0)
+    if first_char == "(":
+        try:
+            rows = read_newick(tree_file)
+        except ValueError as e:
+            exit("#[ERROR in %s] Could not read the newick tree in %s: %s" % (config["query"], file_name, str(e)))
+        finally:
+            tree_file.close()
+    else:
+        text_tree = tree_file.readlines()
+        tree_file.close()
+        rows = text_tree_rows(text_tree)
+
+    # Replace the tree of the organism in one transaction
+    with c.connection:
+        c.execute("INSERT OR IGNORE INTO Organisms VALUES(?)", (organism_name,))
+        c.execute("DELETE FROM Tree_edges WHERE Organism = ?", (organism_name, ))
+        c.executemany("INSERT INTO Tree_edges VALUES(?,?,?)",
+                      [(organism_name, parent, child) for parent, child in tree_edges(rows)])
+        build_tree_index(organism_name, c)
+
+
+def text_tree_rows(text_tree):
+    '''Returns the (Name, Children) rows of a tree given as the lines of a tree text file.'''
+    # Build the Tree rows in memory, in the order the nodes are first seen.
+    # children holds the ;-joined Children string of each node and
+    # child_sets the names in it, so a child is only listed once
+    names = list()
+    children = dict()
+    child_sets = dict()
     for line in text_tree:
         if line[0] != "#":
             nodes = line.strip().split(";")
             for i in range(0, len(nodes)):
                 if nodes[i] != "":
-                    c.execute("SELECT Name FROM Tree WHERE Name = ? AND Organism = ?", (nodes[i], organism_name))
-                    if c.fetchone():
+                    if nodes[i] in children:
                         if len(nodes) > i + 1:  # Looking for children
-                            c.execute("SELECT Children FROM Tree WHERE Name = ? and Organism = ?", (nodes[i], organism_name))
-                            children = c.fetchone()[0]
-                            if children:
-                                child_list = children.split(";")
-                                if nodes[i + 1] in child_list:
-                                    pass  # Already listed as a child, skip
-                                else:  # Append child
-                                    new_children = ";".join(child_list) + ";" + nodes[i + 1]
-                                    c.execute("UPDATE Tree SET Children = ? WHERE Name = ? AND Organism = ?",
-                                              (new_children, nodes[i], organism_name))
+                            if children[nodes[i]]:
+                                if nodes[i + 1] not in child_sets[nodes[i]]:  # Append child
+                                    children[nodes[i]] += ";" + nodes[i + 1]
+                                    child_sets[nodes[i]].add(nodes[i + 1])
                             else:
-                                c.execute("UPDATE Tree SET Children = ? WHERE Name = ? AND Organism = ?",
-                                          (nodes[i + 1], nodes[i], organism_name))
+                                children[nodes[i]] = nodes[i + 1]
+                                child_sets[nodes[i]] = set([nodes[i + 1]])
                     else:  # Add a node
+                        names.append(nodes[i])
                         if len(nodes) > i + 1 and nodes[i + 1] != "":  # First check if its got children
-                            c.execute("INSERT INTO Tree VALUES(?,?,?)", (nodes[i], nodes[i + 1], organism_name))
+                            children[nodes[i]] = nodes[i + 1]
+                            child_sets[nodes[i]] = set([nodes[i + 1]])
                         else:
-                            c.execute("INSERT INTO Tree VALUES(?,?,?)", (nodes[i], None, organism_name))
+                            children[nodes[i]] = None
+    return [(name, children[name]) for name in names]
+
+
+def export_tree(file_name, config, c):
+    '''Writes the tree of an organism in the SQLite3 database to a newick file
+
+    Keyword arguments:
+    file_name -- the file name of the newick file
+
+    '''
+    organism_name = get_organism(config, c)
+    newick = tree_to_newick(organism_name, config, c)
+    if not newick:
+        exit("#[ERROR in %s] There is no tree for %s in the database" % (config["query"], organism_name))
+    tree_file = open(file_name, "w")
+    tree_file.write(newick + "\n")
+    tree_file.close()
 
 
 def tree_to_newick(organism, config, c):
@@ -508,48 +802,31 @@ def tree_to_newick(organism, config, c):
     Keyword arguments:
     organism -- the organism tree wanted
 
-    Tries to convert the tree in the SQLite3 database into newick
-    format. Does so by inserting the root and its children, after
-    which each child is replaced by an entry containing itself and
-    its children. Tries to go through all nodes 10000 times. This
-    is because of the possibility of a node being listed before
-    its parent. If after 10000 loops there are still nodes left,
-    a warning is printed, but the resulting tree is still returned
+    Converts the tree in the SQLite3 database into newick format in a
+    single pass from the root, which is the first node that is no one's
+    child. If some nodes can not be reached from the root a warning is
+    printed, but the resulting tree is still returned
 
     '''
-    c.execute("SELECT * FROM Tree WHERE Organism = ?", (organism, ))
-    nodes = c.fetchall()
+    nodes = tree_rows(organism, c)
     if config['dev']:
         print("#[DEV] Nodes in Tree that have %s as Organism" % organism)
         for node in nodes:
             print("#[DEV]", node)
-    result = ''
-    count = 0  # Counter to stop if it doesnt work properly
-    while nodes and count < 10000:  # Run the loop a maximum of 10000 times
-        for node in nodes:  # Go through all nodes
-            search_regex = re.compile("[(|,]" + node[0] + "[,|)]")
-            search_hit = search_regex.search(result)
-            if search_hit:  # If the node is part of result, replace that entry with the same node and its children
-                if node[1]:
-                    result = result[:search_hit.start() + 1] + \
-                        "(%s)%s" % (node[1].replace(";", ","), node[0]) + \
-                        result[search_hit.end() - 1:]
-                    nodes.remove(node)
-                else:
-                    nodes.remove(node)  # Just remove the node from the list if it doesnt have children
-            elif result == '':  # If result is empty, just add the node. This is the root!
-                if node[1]:
-                    result += "(%s)%s;" % (node[1].replace(";", ","), node[0])
-                    nodes.remove(node)
-                else:
-                    result += "%s;" % node[0]
-                    nodes.remove(node)
-        count += 1
-    if count > 9999:  # Could not insert all nodes into the tree
+    if not nodes:
+        return ''
+    children = dict()
+    for name, child_names in nodes:
+        children[name] = child_names.split(";") if child_names else []
+    is_child = set(itertools.chain.from_iterable(children.values()))
+    roots = [name for name, child_names in nodes if name not in is_child] or [nodes[0][0]]
+    result, written = write_newick(roots[0], children)
+    left_out = [node for node in nodes if node[0] not in written]
+    if left_out:  # Could not insert all nodes into the tree
         stderr.write("#[WARNING in %s] Broken tree, cannot convert entire tree to newick format. " % config["query"] +
                      "Most likely reason is a non-root node not listed as a child anywhere in the tree\n")
         if config["dev"]:
-            print("#[DEV] These nodes were left out of the tree: %s" % str(nodes))
+            print("#[DEV] These nodes were left out of the tree: %s" % str(left_out))
     if config["dev"]:
         print("#[DEV] Tree in newick format:%s" % result)
     return result
@@ -557,6 +834,7 @@ def tree_to_newick(organism, config, c):
 
 def CanSNPer_tree_layout(node):
     '''Layout style for ETE2 trees.'''
+    import ete2
     name_face = ete2.AttrFace("name")
     # Adds the name face to the image at the top side of the branch
     ete2.faces.add_face_to_node(name_face, node, column=0, position="branch-top")
@@ -570,7 +848,11 @@ def draw_ete2_tree(organism, snplist, tree_file_name, config, c):
     snplist -- a list of the SNP names, positions and state
     file_name -- the name of the out-file _tree.pdf will be added
 
+    ete2 pulls in Qt and is slow to import, so it is only imported when
+    a tree is drawn.
+
     '''
+    import ete2
     newick = tree_to_newick(organism, config, c)
     tree = ete2.Tree(newick, format=1)
     tree_depth = int(tree.get_distance(tree.get_farthest_leaf()[0]))
@@ -615,67 +897,36 @@ def draw_ete2_tree(organism, snplist, tree_file_name, config, c):
     tree.render(tree_file_name, tree_style=ts, w=tree_depth * 500)
 
 
-def find_tree_root(db_name, c, config):
-    '''Returns the root of a tree.
-
-    Keyword arguments:
-    db_name -- the name of the organism from which we are grabbing the tree
-
-    Definition of root:
-    Is not listed as a child anywhere in the entire tree.
-
-    If there are several nodes that arent listed as a child,
-    the first one listed in the SQLite3 database is returned.
-
-    '''
-    root = None
-    c.execute("SELECT * FROM Tree WHERE Organism = ?", (db_name,))
-    nodes = c.fetchall()
-    for node in nodes:
-        flag = True
-        for node_two in nodes:
-            if node_two[1]:
-                if node[0] in node_two[1].split(";"):
-                    flag = False
-                    break  # Break out if the node is listed as a child somewhere
-        if flag:  # If the node was never listed as a child
-            root = node[0]  # Set it as root
-            break
-    if config["dev"]:  # Developer printout
-        print("#[DEV] root %s tree: %s" % (db_name, root))
-    if not root:
-        exit("#[ERROR in %s] Could not find root of %s tree" % (config["query"], db_name))
-    return root
-
-
-def snp_lister(sequences, organism, out_name, config, c):
+def snp_lister(sequences, scheme, out_name, config):
     '''Returns a list of all SNPs, their positions and state in the sequence.
 
     Keyword arguments:
     sequences -- a list of all the query sequences, aligned to each reference
-    organism -- the name of the organism
+    scheme -- the compiled Scheme of the organism
     out_name -- the name of the query
 
     '''
-    c.execute("SELECT Strain, Position, Derived_base, Ancestral_base, SNP FROM %s" % organism)
+    try:  # Catch a KeyError that arises when a sequence is missing from the DB
+        alleles = SnpColumns(scheme).alleles(sequences).tolist()
+    except KeyError as e:
+        strain = str(e.message)
+        snp = next(row[0] for row in scheme.snp_rows() if row[1] == strain)
+        message = "#[ERROR in %s] SNP position of %s listed in strain that is not in the database: %s" % (config["query"], snp, strain)
+        exit(message)
     results = list()
     results.append(["#SNP", "Derived", "Ancestral", out_name])
-    for snp in c.fetchall():
-        try:  # Catch a KeyError that arises when a sequence is missing from the DB
-            results.append([snp[4], snp[2], snp[3], sequences[snp[0]][snp[1] - 1]])
-        except KeyError as e:
-            message = "#[ERROR in %s] SNP position of %s listed in strain that is not in the database: %s" % (config["query"], snp[4], str(e.message))
-            exit(message)
+    for row in range(len(alleles)):
+        results.append([scheme.snp_names[row], scheme.snp_derived[row], scheme.snp_ancestral[row], alleles[row]])
     return results
 
 
-def multi_tree_walker(node, sequences, organism, threshold, wrong_list, config, c, force_flag=False, quiet=False):
+def multi_tree_walker(node, sequences, scheme, threshold, wrong_list, config, force_flag=False, quiet=False):
     '''Tree walking classifier for CanSNPer.
 
     Keyword arguments:
     node -- The current node in the tree.
     sequences -- The aligned sequences of the query. A list, one for each reference strain
-    organism -- The name of the organism
+    scheme -- The compiled Scheme of the organism
     threshold -- Number of ancestral SNPs to allow in the classification
     wrong_list -- A list of the positions that have been wrong, ie ancestral SNP
         config -- Dictionary containing running arguments for CanSNPer
@@ -700,8 +951,7 @@ def multi_tree_walker(node, sequences, organism, threshold, wrong_list, config,
         fstring = "Walking"
     if config["dev"]:
         print("#[DEV]", fstring, "into", node, qstring)
-    c.execute("SELECT Strain, Position, Derived_base FROM %s WHERE SNP = ?" % organism, (node,))
-    snp_info = c.fetchone()
+    snp_info = scheme.snp(node)
     if snp_info:
         try:  # Catch a KeyError that arises when a sequence is missing from the DB
             if sequences[snp_info[0]][snp_info[1] - 1] == snp_info[2] or force_flag:
@@ -713,8 +963,7 @@ def multi_tree_walker(node, sequences, organism, threshold, wrong_list, config,
                     # Return True if we are quietly testing a single node
                     # and we are not forcing it
                     return True, True
-                c.execute("SELECT Children FROM Tree WHERE Name = ? AND Organism = ?", (node, organism))
-                children = c.fetchone()[0]
+                children = scheme.children(node)
 
                 if not children:  # No children, Leaf node.
                     #  Hit a leaf that is not derived
@@ -729,15 +978,15 @@ def multi_tree_walker(node, sequences, organism, threshold, wrong_list, config,
                         return node, wrong_list
 
                 # Has children, loop through them
-                for child in children.split(";"):
+                for child in children:
                     if config["dev"] and not quiet:  # Developer printout
                         print("#[DEV] testing child: %s" % child)
                     # Test the SNP of child
-                    if multi_tree_walker(child, sequences, organism, threshold, wrong_list, config, c, False, True)[0]:
+                    if multi_tree_walker(child, sequences, scheme, threshold, wrong_list, config, False, True)[0]:
                         # Move further down the Tree if it worked
                         if config["dev"] and not quiet:
                             print("#[DEV] testing child success, going into: %s" % child)
-                        return multi_tree_walker(child, sequences, organism, threshold, wrong_list, config, c, False, quiet)
+                        return multi_tree_walker(child, sequences, scheme, threshold, wrong_list, config, False, quiet)
                 if config["dev"] and not quiet:
                     print("#[DEV] Number of forced SNPs: %s, Threshold: %s, %s" % (len(wrong_list), threshold, str(wrong_list)))
                 if len(wrong_list) >= threshold:
@@ -749,14 +998,14 @@ def multi_tree_walker(node, sequences, organism, threshold, wrong_list, config,
                         return None, wrong_list
 
                 if config["dev"] and not quiet:  # Developer printout
-                    print("#[DEV] Now going to try to force %s" % children)
-                for child in children.split(";"):  # loop again if there were no results without force
+                    print("#[DEV] Now going to try to force %s" % ";".join(children))
+                for child in children:  # loop again if there were no results without force
                     if config["dev"] and not quiet:
                             print("#[DEV] force-testing child: %s" % child)
                     # Test forcing the SNP of child
-                    if multi_tree_walker(child, sequences, organism, threshold, wrong_list, config, c, True, True)[0]:
+                    if multi_tree_walker(child, sequences, scheme, threshold, wrong_list, config, True, True)[0]:
                         # Move further down the Tree if it worked
-                        return multi_tree_walker(child, sequences, organism, threshold, wrong_list, config, c, True, quiet)
+                        return multi_tree_walker(child, sequences, scheme, threshold, wrong_list, config, True, quiet)
 
                 if sequences[snp_info[0]][snp_info[1] - 1] == snp_info[2]:
                     return node, wrong_list  # Return node if we didnt find anything by forcing
@@ -776,205 +1025,1024 @@ def multi_tree_walker(node, sequences, organism, threshold, wrong_list, config,
     return None, wrong_list
 
 
-def x2fa_error_check(num, config):
-    '''Function that checks for errors in x2fa.py runs.
+def projection_error_check(projection_errors, aligner, config):
+    '''Function that checks for errors in the projections of alignments.
 
     Keyword arguments:
-    num -- the uuid for this specific x2fa run
+    projection_errors -- the traceback of the projection, empty if it went well
+    aligner -- the Aligner that made the alignment
 
     '''
-    # This file contains the stderr output from progressiveMauve
-    x2fa_errors_file = open("%s/CanSNPer_xerr%s.txt" % (config["tmp_path"], num), "r")
-    x2fa_errors = x2fa_errors_file.read()
-    x2fa_errors_file.close()
+    if projection_errors:  # Quit if there was something wrong
+        if aligner.name == "progressiveMauve":
+            exit("#[ERROR in %s] x2fa.py failed to complete:\n%s" % (config["query"], projection_errors))
+        exit("#[ERROR in %s] Could not read the %s output:\n%s" % (config["query"], aligner.name, projection_errors))
+
+
+def alignment_error_check(error_file, returncode, aligner, config):
+    '''Function that checks for errors in aligner runs.
+
+    Keyword arguments:
+    error_file -- the file the stderr of this aligner run went to
+    returncode -- the exit code of the run
+    aligner -- the Aligner that was run
 
-    if x2fa_errors:  # Quit if there was something wrong
-        exit("#[ERROR in %s] x2fa.py failed to complete:\n%s" % (config["query"], x2fa_errors))
+    progressiveMauve has failed if it wrote anything to stderr, the other
+    aligners if they exited with an error, as they report their progress
+    on stderr.
+
+    '''
+    # This file contains the stderr output from the aligner
+    aligner_errors_file = open(error_file, "r")
+    aligner_errors = aligner_errors_file.read()
+    aligner_errors_file.close()
+
+    if returncode:  # Quit if there was something wrong
+        exit("#[ERROR in %s] %s filed to complete, exit code %i:\n%s" % (config["query"], aligner.name, returncode,
+                                                                        aligner_errors))
+    if aligner.stderr_is_error and aligner_errors:
+        exit("#[ERROR in %s] %s filed to complete:\n%s" % (config["query"], aligner.name, aligner_errors))
 
     # Remove the file if there were no errors, annoying to have an empty file lying around
-    silent_remove("%s/CanSNPer_xerr%s.txt" % (config["tmp_path"], num))
+    silent_remove(error_file)
 
 
-def mauve_error_check(num, config):
-    '''Function that checks for errors in progressiveMauve runs.
+def get_query_files(queries, config):
+    '''Returns the list of fasta (or reads) files that are to be typed.
 
     Keyword arguments:
-    num -- the uuid for this specific progressiveMauve run
+    queries -- the file names given with --query
+
+    Each name can be a fasta file, a directory, in which case every fasta
+    file in it is typed, or a manifest. A manifest is a text file listing
+    one fasta file name per line, relative names are read relative to the
+    directory of the manifest. Lines beginning with # are comment lines.
+
+    In reads mode FASTQ files are picked from directories instead, and the
+    reads files of one sample can be joined by commas, e.g. R1.fq,R2.fq.
 
     '''
-    # This file contains the stderr output from progressiveMauve
-    mauve_errors_file = open("%s/CanSNPer_err%s.txt" % (config["tmp_path"], num), "r")
-    mauve_errors = mauve_errors_file.read()
-    mauve_errors_file.close()
+    if config["mode"] == "reads":
+        extensions = READS_EXTENSIONS
+    else:
+        extensions = FASTA_EXTENSIONS
+    query_files = list()
+    for query in queries:
+        if path.isdir(query):
+            for file_name in sorted(listdir(query)):
+                if file_name.lower().endswith(extensions):
+                    query_files.append(path.join(query, file_name))
+        elif "," in query and not path.exists(query):
+            query_files.append(query)  # Reads files of one sample
+        elif path.isfile(query):
+            query_file = open(query, "r")
+            first_line = query_file.readline()
+            while first_line and not first_line.strip():
+                first_line = query_file.readline()
+            query_file.seek(0)
+            if query.lower().endswith(".gz") or first_line.startswith((">", "@")):
+                query_files.append(query)
+            else:  # Not a fasta or FASTQ file, treat it as a manifest
+                for line in query_file:
+                    line = line.strip()
+                    if line and line[0] != "#":
+                        query_files.append(",".join([path.join(path.dirname(query), part)
+                                                     for part in line.split(",")]))
+            query_file.close()
+        else:
+            exit("#[ERROR in %s] No such file: %s" % (query, query))
 
-    if mauve_errors:  # Quit if there was something wrong
-        exit("#[ERROR in %s] progressiveMauve filed to complete:\n%s" % (config["query"], mauve_errors))
+    # Type each file once, even if it was listed more than once
+    unique_files = list()
+    for file_name in query_files:
+        if file_name not in unique_files:
+            unique_files.append(file_name)
+    if config["dev"]:
+        print("#[DEV] query files: %s" % unique_files)
+    return unique_files
 
-    # Remove the file if there were no errors, annoying to have an empty file lying around
-    silent_remove("%s/CanSNPer_err%s.txt" % (config["tmp_path"], num))
 
+def cache_name(name):
+    '''Returns a version of an organism or strain name that is safe to use in a file name.'''
+    return re.sub(r"[^\w.-]", "_", name)
 
-def align(file_name, config, c):
-    '''This function is the "main" of the classifier part of the program.
+
+def clear_reference_cache(organism, strain, config):
+    '''Removes cached reference files of a strain.
 
     Keyword arguments:
-    file_name -- the name of the fasta file that is to be typed
+    organism -- the organism of the strain
+    strain -- the strain whose files are removed, None removes every strain of the organism
 
-    Sets everything in motion and retrieves and distributes all the results.
+    Called whenever a reference sequence is changed in the database. The
+    fasta files, the mini-references of --snp_window and the
+    progressiveMauve .sslist files are removed.
 
     '''
-    # Set warning flags
-    WARNINGS = dict()
+    if not path.isdir(config["reference_cache"]):
+        return
+    if strain is None:
+        strain_pattern = ".+"
+    else:
+        strain_pattern = re.escape(cache_name(strain))
+    cache_regex = re.compile("^%s\\.%s\\.(snp_windows\\.)?[0-9a-f]{40}\\.fa(\\.sslist)?$" %
+                             (re.escape(cache_name(organism)), strain_pattern))
+    for file_name in listdir(config["reference_cache"]):
+        if cache_regex.search(file_name):
+            if config["dev"]:
+                print("#[DEV] Removing cached reference: %s" % file_name)
+            silent_remove(path.join(config["reference_cache"], file_name))
 
-    # Get database and output name
-    db_name = get_organism(config, c)
-    out_name = file_name.split("/")[-1]
-    output = "%s/%s.CanSNPer" % (config["tmp_path"], out_name)
 
-    # Get the sequences from our SQLite3 database, and write them
-    # to tmp files that progressiveMauve can read
-    c.execute("SELECT Organism, Strain, Sequence FROM Sequences WHERE Organism = ?", (db_name,))
-    seq_counter = 0  # Counter for the number of sequences
-    seq_uids = dict()
+def export_references(db_name, config, c):
+    '''Writes the reference sequences of an organism to the reference cache.
+
+    Keyword arguments:
+    db_name -- the organism whose reference sequences are written
+
+    Returns a list of (strain, uid, file name) tuples, one for each reference
+    sequence. The uid is unique for this run and is used to name the tmp files
+    of the alignments.
 
-    reference_sequences = dict()
+    The cached file is named by organism, strain and the SHA-1 of the
+    sequence, so it is only written if the sequence has changed since the
+    last run. progressiveMauve keeps its .sslist index next to the fasta file
+    and can then reuse it as well.
+
+    '''
+    references = list()
 
     if config["verbose"]:
         print("#Fetching reference sequence(s) ...")
-    for row in c.fetchall():
-        seq_counter += 1
+    make_cache_folders(config)
+    for strain in sequence_strains(db_name, c):
+        # The sequences are streamed from the database one block at a time,
+        # once for the hash and once more if the file has to be written
+        seq_hash = hashlib.sha1()
+        for block in stream_sequence(db_name, strain, c):
+            seq_hash.update(block)
+        reference_file = "%s/%s.%s.%s.fa" % (config["reference_cache"], cache_name(db_name),
+                                             cache_name(strain), seq_hash.hexdigest())
+        if not path.isfile(reference_file):
+            # Remove the files of any older sequence of this strain
+            clear_reference_cache(db_name, strain, config)
+            write_reference(reference_file, ">%s.%s\n" % (db_name, strain), stream_sequence(db_name, strain, c))
+        elif config["dev"]:
+            print("#[DEV] Using cached reference: %s" % reference_file)
         # 32 char long unique hex string used for unique tmp file names
-        seq_uids[seq_counter] = uuid4().hex
-        reference_sequences[seq_counter] = row[1]  # save the name of the references
-        if not path.exists(config["tmp_path"]):
-            makedirs(config["tmp_path"])
-        tmp_file = open("%s/CanSNPer_reference_sequence." % config["tmp_path"] +
-                        seq_uids[seq_counter] +
-                        ".fa", "w")  # Open a tmp file
-        tmp_file.write(">%s.%s\n%s\n" % (row[0], row[1], row[2]))  # Write to tmp file
-        tmp_file.close()
+        references.append((strain, uuid4().hex, reference_file))
+    return references
+
+
+def make_cache_folders(config):
+    '''Creates the tmp folder and the reference cache, if they are missing.'''
+    for directory in (config["tmp_path"], config["reference_cache"]):
+        try:
+            makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:  # Another CanSNPer run may have just created it
+                raise
+
+
+def write_reference(reference_file, header, pieces):
+    '''Writes a reference fasta file to the reference cache.
+
+    Keyword arguments:
+    reference_file -- the file name in the cache
+    header -- the fasta header line
+    pieces -- the sequence, in pieces of any size
+
+    The file is written to a tmp name and renamed, so a concurrent run
+    never sees a half written reference.
+
+    '''
+    tmp_name = "%s.%s.tmp" % (reference_file, uuid4().hex)
+    tmp_file = open(tmp_name, "w")
+    tmp_file.write(header)
+    for piece in pieces:
+        tmp_file.write(piece)
+    tmp_file.write("\n")
+    tmp_file.close()
+    rename(tmp_name, reference_file)
+
+
+def export_snp_windows(scheme, config, c):
+    '''Writes a mini-reference of the windows around its SNPs for each strain to the reference cache.
+
+    Keyword arguments:
+    scheme -- the compiled Scheme of the organism
+
+    For --snp_window: the snp_window bases on either side of each SNP are
+    read from the reference sequence of its strain, overlapping windows are
+    merged, and the windows are joined into one mini-reference, see
+    windows.py. Its header records the windows, which map it back to the
+    reference. Returns (strain, uid, file name) tuples like
+    export_references, for the strains that have both a reference sequence
+    and SNPs. The file is named by the SHA-1 of the header and the bases,
+    so a change to the sequence, the SNPs or the window size gives a new
+    one, and mini-references are removed from the cache with the other
+    files of their strain, see clear_reference_cache.
+
+    '''
+    db_name = scheme.organism
+    references = list()
+
+    if config["verbose"]:
+        print("#Fetching the windows around the SNPs of the reference sequence(s) ...")
+    make_cache_folders(config)
+    positions = dict()
+    for snp, strain, position, derived, ancestral in scheme.snp_rows():
+        positions.setdefault(strain, list()).append(position)
+    for strain in sequence_strains(db_name, c):
+        if strain not in positions:  # Nothing to align to
+            continue
+        bases, windows = mini_reference(db_name, strain, snp_windows(positions[strain], config["snp_window"]), c)
+        if not windows:  # The SNPs are past the end of the sequence
+            continue
+        header = windows_header("%s.%s" % (db_name, strain), windows)
+        reference_file = "%s/%s.%s.snp_windows.%s.fa" % (config["reference_cache"], cache_name(db_name),
+                                                         cache_name(strain), hashlib.sha1(header + bases).hexdigest())
+        if not path.isfile(reference_file):
+            write_reference(reference_file, header, [bases])
+        elif config["dev"]:
+            print("#[DEV] Using cached reference: %s" % reference_file)
+        if config["dev"]:
+            print("#[DEV] %i windows of %s, %i bases" % (len(windows), strain, len(bases)))
+        references.append((strain, uuid4().hex, reference_file))
+    return references
+
+
+def load_organism(db_name, config, c):
+    '''Returns the compiled Scheme of an organism and the index of the typing mode.
+
+    Keyword arguments:
+    db_name -- the organism the queries are typed against
+
+    The tree and SNPs of the organism are compiled into a Scheme. In align
+    mode the reference sequences, or with --snp_window their mini-references,
+    are exported to the reference cache, and the index is the list of
+    references, in flank mode the SNP flanks and
+    in reads mode the SNP k-mers are indexed.
+
+    '''
+    with profile_stage(config, "load scheme"):
+        scheme = load_scheme(db_name, config, c)
+    if config["verbose"]:
+        print("#Using tree root:", scheme.root)
+    if config["result_cache"]:
+        with profile_stage(config, "scheme version"):
+            scheme.version = scheme_version(scheme, c)
+        if config["dev"]:
+            print("#[DEV] scheme version: %s" % scheme.version)
+
+    if config["mode"] == "flank":
+        with profile_stage(config, "flank index"):
+            index = load_flank_index(scheme, config, c)
+    elif config["mode"] == "reads":
+        with profile_stage(config, "read index"):
+            index = load_read_index(scheme, config, c)
+    elif config["snp_window"]:
+        with profile_stage(config, "reference export"):
+            index = export_snp_windows(scheme, config, c)
+    else:
+        with profile_stage(config, "reference export"):
+            index = export_references(db_name, config, c)
+    return scheme, index
+
+
+def type_queries(file_names, config, c, loaded=None):
+    '''Types a batch of fasta files against one organism.
+
+    Keyword arguments:
+    file_names -- the file names given with --query, see get_query_files
+    loaded -- the scheme and index of the organism, if they are already
+              loaded, as returned by load_organism
+
+    The scheme and index of the organism are loaded once, see
+    load_organism, after which every query is typed and classified.
+    In align mode the tmp files of the alignments are kept in a Workspace of
+    this run, which is removed when the run ends, however it ends.
+    The classifications are counted per clade for --clade_counts, and the
+    SNP alleles of each query are written to the --snp_matrix files as soon
+    as it is typed. With --profile the work shared by all the queries is
+    the first record of the profile, with "sample" null, followed by a
+    record for each query.
+
+    '''
+    query_files = get_query_files(file_names, config)
+    db_name = get_organism(config, c)
+
+    profile_file = None
+    shared_config = dict(config)
+    shared_config["sample_profile"] = None
+    shared_c = c
+    if config["profile"]:
+        profile_file = open(config["profile"], "w")
+        shared_config["sample_profile"] = SampleProfile(None)
+        shared_c = CountingCursor(c, shared_config["sample_profile"])
+
+    if loaded is None:
+        scheme, index = load_organism(db_name, shared_config, shared_c)
+    else:
+        scheme, index = loaded
+    if profile_file:
+        profile_file.write(json.dumps(shared_config["sample_profile"].record()) + "\n")
+
+    workspace = None
+    if config["mode"] == "align":
+        workspace = Workspace(config["workspace"], config["workspace_quota"] << 20)
+        config = dict(config, run_workspace=workspace)
+        if config["dev"]:
+            print("#[DEV] workspace: %s" % workspace.path)
+
+    if config["parallel_samples"] > 1 and len(query_files) > 1:
+        results = type_in_parallel(query_files, scheme, index, config, c)
+    else:
+        results = ((file_name, type_sample(file_name, scheme, index, config, c)) for file_name in query_files)
+
+    matrix = None
+    classifications = list()
+    try:
+        if config["snp_matrix"]:
+            matrix = AlleleMatrix(config["snp_matrix"], scheme, query_files)
+        for file_name, (classification, alleles, profile) in results:
+            classifications.append(classification)
+            if matrix:
+                matrix.add(file_name, alleles)
+            if profile_file:
+                profile_file.write(json.dumps(profile) + "\n")
+                profile_file.flush()
+    finally:
+        results.close()  # Stops any samples still being typed before their files are removed
+        if matrix:
+            matrix.close()
+        if profile_file:
+            profile_file.close()
+        if workspace:
+            workspace.remove()
+
+    if config["clade_counts"]:
+        write_clade_counts(config["clade_counts"], scheme, classifications)
+
+
+def write_clade_counts(file_name, scheme, classifications):
+    '''Writes the number of queries classified as each node and in each clade of the tree.
+
+    Keyword arguments:
+    file_name -- the name of the tab separated file that is written
+    scheme -- the compiled Scheme of the organism
+    classifications -- the nodes the queries were classified as
+
+    One line per node, in pre-order from the root, with its depth, the
+    number of queries classified as the node and the number classified as
+    the node or any node under it. The clade counts come from the nested
+    set intervals of the Tree_index, see Scheme.clade_counts.
+
+    '''
+    counts_file = open(file_name, "w")
+    counts_file.write("#Node\tDepth\tQueries\tQueries_in_clade\n")
+    for node, at_node, in_clade in scheme.clade_counts(classifications):
+        counts_file.write("%s\t%i\t%i\t%i\n" % (node, scheme.node_depths[scheme.node_ids[node]], at_node, in_clade))
+    counts_file.close()
+
+
+def type_sample(file_name, scheme, index, config, c):
+    '''Types and classifies one query.
+
+    Keyword arguments:
+    file_name -- the name of the fasta (or reads) file that is to be typed
+    scheme -- the compiled Scheme of the organism
+    index -- the FlankIndex, the ReadIndex or the exported references,
+             depending on the mode
+
+    Returns the node the query was classified as, for --snp_matrix the
+    bases of the query at every SNP and for --profile the profile record
+    of the query.
+
+    '''
+    # Error and warning messages are to name the sample they concern
+    sample_config = dict(config)
+    sample_config["query"] = file_name
+    sample_config["sample_profile"] = None
+    if config["profile"]:
+        sample_config["sample_profile"] = SampleProfile(file_name)
+        c = CountingCursor(c, sample_config["sample_profile"])
+    if config["verbose"]:
+        print("#Starting %s ..." % file_name)
+
+    # A query that has been typed before with the same scheme and options is
+    # not typed again, unless its alignment or SNP list is asked for
+    result_key = None
+    if config["result_cache"] and all(path.isfile(query_file) for query_file in file_name.split(",")):
+        with profile_stage(sample_config, "result cache"):
+            try:
+                result_key = (query_hash(file_name, config["mode"]), scheme.organism, scheme.version,
+                              result_options(config))
+            except (IOError, ValueError) as e:
+                exit("#[ERROR in %s] Could not read %s: %s" % (sample_config["query"], file_name, str(e)))
+            result = load_result(result_key, c)
+        if result and not (config["list_snps"] or config["draw_tree"] or config["save_align"] or
+                           config["alignment_stats"] or config["snp_matrix"]):
+            classification, forced_snps, warning = result
+            out_name = file_name.split(",")[0].split("/")[-1]
+            if config["verbose"]:
+                print("#Found a result for %s in the database" % out_name)
+            WARNINGS = dict()
+            if warning:
+                WARNINGS["ALIGNMENT_WARNING"] = fill_warning(warning, file_name, out_name)
+            with profile_stage(sample_config, "output"):
+                report_result(out_name, (classification, forced_snps), scheme, WARNINGS, sample_config)
+            return classification, None, sample_profile_record(sample_config, classification=classification,
+                                                               cached=True)
+
+    if config["mode"] == "flank":
+        with profile_stage(sample_config, "flank lookup"):
+            alternates, WARNINGS = flank_type(file_name, index, sample_config)
+    elif config["mode"] == "reads":
+        with profile_stage(sample_config, "read counting"):
+            alternates, WARNINGS = reads_type(file_name, index, sample_config)
+        file_name = file_name.split(",")[0]  # Results are named after the first reads file
+    else:
+        alternates, WARNINGS = align(file_name, scheme, index, sample_config, c)
+    visits = scheme.visits
+    tree_location = classify(file_name, alternates, scheme, WARNINGS, sample_config, c)
+    if sample_config["sample_profile"]:
+        sample_config["sample_profile"].walker_visits = scheme.visits - visits
+    alleles = None
+    if config["snp_matrix"]:
+        with profile_stage(sample_config, "allele matrix"):
+            try:
+                alleles = SnpColumns(scheme).alleles(alternates)
+            except KeyError as e:
+                exit("#[ERROR in %s] SNP positions listed in strain that is not in the database: %s" %
+                     (sample_config["query"], str(e.message)))
+
+    if result_key:
+        warning = WARNINGS.get("ALIGNMENT_TEMPLATE")
+        try:
+            with profile_stage(sample_config, "result cache"):
+                save_result(result_key, tree_location[0], tree_location[1], warning, c)
+        except sqlite3.OperationalError as e:  # E.g. a read-only or busy database, the result is still printed
+            if config["dev"]:
+                print("#[DEV] could not cache the result: %s" % str(e))
+    return tree_location[0], alleles, sample_profile_record(sample_config, classification=tree_location[0],
+                                                            cached=False)
+
+
+def sample_profile_record(config, **fields):
+    '''Returns the profile record of the sample in config, None if it is not profiled.'''
+    if config["sample_profile"] is None:
+        return None
+    return config["sample_profile"].record(**fields)
+
+
+def type_in_parallel(query_files, scheme, index, config, c):
+    '''Types several queries at once in a pool of worker processes.
+
+    Keyword arguments:
+    query_files -- the files that are to be typed, as from get_query_files
+    scheme -- the compiled Scheme of the organism
+    index -- the FlankIndex, the ReadIndex or the exported references
+
+    parallel_samples workers type one sample each at a time. They share the
+    scheme and the index, and one budget of alignment processes: no more
+    than num_threads aligner processes run at once across all the
+    samples, or one per CPU if num_threads is 0. The output of a sample is
+    printed in one piece once it is done, in the order the samples were
+    given. The first sample that fails stops the others and CanSNPer exits
+    with its error. Yields each query file name with what type_sample
+    returned for it, in the order the queries were given.
+
+    In align mode the first sample is typed on its own if the references
+    in the cache have no progressiveMauve index files yet, so that the
+    workers do not all build the same .sslist files at once.
+
+    '''
+    if config["mode"] == "align" and config["aligner"] == "progressiveMauve":
+        for strain, uid, reference_file in index:
+            if not path.isfile("%s.sslist" % reference_file):
+                yield query_files[0], type_sample(query_files[0], scheme, index, config, c)
+                query_files = query_files[1:]
+                break
+
+    c.connection.commit()  # The workers read the database through connections of their own
+    # A --serve server has one budget for all the queries it types at once
+    slots = ALIGNMENT_SLOTS or BoundedSemaphore(config["num_threads"] or cpu_count())
+    pool = Pool(min(config["parallel_samples"], len(query_files)), init_sample_worker,
+                (scheme, index, config, slots))
+    try:
+        for file_name, (output, error, result) in itertools.izip(query_files,
+                                                                 pool.imap(sample_worker, query_files)):
+            sys.stdout.write(output)
+            sys.stdout.flush()
+            if error is not None:
+                exit(error)
+            yield file_name, result
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.close()
+        pool.join()
+
+
+def init_sample_worker(scheme, index, config, slots):
+    '''Sets up a worker process of type_in_parallel.'''
+    global ALIGNMENT_SLOTS
+    ALIGNMENT_SLOTS = slots
+    signal(SIGTERM, stop_sample_worker)
+    SAMPLE_WORKER["scheme"] = scheme
+    SAMPLE_WORKER["index"] = index
+    SAMPLE_WORKER["config"] = config
+    SAMPLE_WORKER["c"] = sqlite3.connect(config["db_path"]).cursor()
+
+
+def stop_sample_worker(signum, frame):
+    '''Stops a worker of type_in_parallel and its aligner processes, as pool.terminate() asks.
+
+    The worker exits right away instead of raising SystemExit, which
+    sample_worker would return as the error of its sample. The worker would
+    then go back to the pool for the next sample and wait forever for the
+    task queue, which terminate() holds, so the pool could not be joined.
+    The tmp files of the sample are removed with the workspace of the run.
+    A stop that comes while an aligner is being started waits until its
+    process group is known, see run_alignments.
+
+    '''
+    if SAMPLE_WORKER.get("starting"):
+        SAMPLE_WORKER["stopped"] = True
+        return
+    for group in list(ALIGNER_GROUPS):
+        try:
+            killpg(group, SIGTERM)
+        except OSError:
+            pass
+    _exit(1)
+
+
+def sample_worker(file_name):
+    '''Types a sample in a worker process.
+
+    Keyword arguments:
+    file_name -- the name of the fasta (or reads) file that is to be typed
+
+    Returns what the sample printed, its error message, None if it was
+    typed without errors, and what type_sample returned.
+
+    '''
+    error = None
+    result = None
+    sys.stdout = StringIO()
+    try:
+        result = type_sample(file_name, SAMPLE_WORKER["scheme"], SAMPLE_WORKER["index"],
+                    SAMPLE_WORKER["config"], SAMPLE_WORKER["c"])
+    except SystemExit as e:
+        error = e.code
+    finally:
+        output = sys.stdout.getvalue()
+        sys.stdout = sys.__stdout__
+    return output, error, result
+
+
+def alignment_warning(WARNINGS, template, out_name, config):
+    '''Sets the alignment warning of a sample, and its template for the result cache, see fill_warning.'''
+    WARNINGS["ALIGNMENT_TEMPLATE"] = template
+    WARNINGS["ALIGNMENT_WARNING"] = fill_warning(template, config["query"], out_name)
+
+
+def flank_type(file_name, flank_index, config):
+    '''Calls the SNP bases of a query by matching SNP flanks, without aligning.
+
+    Keyword arguments:
+    file_name -- the name of the fasta file that is to be typed
+    flank_index -- the FlankIndex of the organism
+
+    Returns the called bases, in place of the aligned sequences, and a dict
+    of warnings.
+
+    '''
+    WARNINGS = dict()
+    out_name = file_name.split("/")[-1]
 
     # Check if the file exists
     if not path.isfile(file_name):
         exit("#[ERROR in %s] No such file: %s" % (config["query"], file_name))
 
-    # Parallelised running of several progressiveMauve processes
-    if config["num_threads"] == 0 or config["num_threads"] > seq_counter:
-        max_threads = seq_counter
-    else:
-        max_threads = config["num_threads"]
+    try:
+        alternates, found = flank_index.type_contigs(read_fasta(file_name, QUERY_BASES))
+    except (IOError, ValueError) as e:
+        exit("#[ERROR in %s] Could not read %s: %s" % (config["query"], file_name, str(e)))
+    total = len(flank_index.scheme.snp_names)
+    if config["verbose"]:
+        print("#Found the flanks of %i of %i SNPs" % (found, total))
+    if total and float(found) / float(total) < 0.8:
+        alignment_warning(WARNINGS, "#[WARNING in {query}] Only %i of %i SNPs of %s were found in {name}" %
+                          (found, total, flank_index.scheme.organism), out_name, config)
+    return alternates, WARNINGS
+
+
+def reads_type(file_names, read_index, config):
+    '''Calls the SNP bases of a sample from its sequencing reads, without assembling.
 
+    Keyword arguments:
+    file_names -- the FASTQ file(s) of the sample, joined by commas
+    read_index -- the ReadIndex of the organism
+
+    The reads are streamed once, only the read depth of each allele of each
+    SNP is kept. Returns the called bases, in place of the aligned
+    sequences, and a dict of warnings.
+
+    '''
+    WARNINGS = dict()
+    file_names = file_names.split(",")
+    out_name = file_names[0].split("/")[-1]
+
+    # Check if the files exist
+    for file_name in file_names:
+        if not path.isfile(file_name):
+            exit("#[ERROR in %s] No such file: %s" % (config["query"], file_name))
+
+    reads = itertools.chain.from_iterable(read_fastq(file_name) for file_name in file_names)
+    alternates, called, read_count = read_index.type_reads(reads, config["min_depth"])
+    total = len(read_index.scheme.snp_names)
     if config["verbose"]:
-        print("#Aligning sequence against %i reference sequence(s) ..." % len(reference_sequences))
-
-    processes = list()
-    mauve_jobs = list()
-    x2f_jobs = list()
-    for i in range(1, seq_counter + 1):
-        if config["save_align"]:
-            fasta_name = reference_sequences[i]
-        else:
-            fasta_name = seq_uids[i]
+        print("#Called %i of %i SNPs from %i reads" % (called, total, read_count))
+    if total and float(called) / float(total) < 0.8:
+        alignment_warning(WARNINGS, "#[WARNING in {query}] Only %i of %i SNPs of %s had a read depth of %i or more in {name}" %
+                          (called, total, read_index.scheme.organism, config["min_depth"]), out_name, config)
+    return alternates, WARNINGS
 
-        # Write the commands that will be run. one for each reference sequence
-        mauve_jobs.append("%s --output=%s.%s.xmfa " % (config["mauve_path"], output, seq_uids[i]) +
-                          "%s/CanSNPer_reference_sequence.%s.fa %s > " % (config["tmp_path"],
-                                                                          seq_uids[i], file_name) +
-                          "/dev/null 2> %s/CanSNPer_err%s.txt" % (config["tmp_path"], seq_uids[i]))
 
-        x2f_jobs.append("%s %s.%s.xmfa %s/CanSNPer_reference_sequence.%s.fa " % (config["x2fa_path"],
-                        output, seq_uids[i], config["tmp_path"], seq_uids[i]) +
-                        "0 %s.%s.fa 2> %s/CanSNPer_xerr%s.txt" % (output, fasta_name,
-                                                                  config["tmp_path"], seq_uids[i]))
+def alignment_stats(reference, alternate, window, windows=None):
+    '''Returns the identity, aligned coverage and gap fraction of an aligned query.
 
-    # Starting the processes that use progressiveMauve to align sequences
-    while True:
-        while mauve_jobs and len(processes) < max_threads:
-            job = mauve_jobs.pop()
-            processes.append(Popen(job, shell=True))
-            if config["dev"]:
-                print("#[DEV] progressiveMauve command: %s" % job)
-        for p in processes:
-            if p.poll() is not None:
-                processes.remove(p)
-        if not processes and not mauve_jobs:
-            break
-        time.sleep(0.5)
-    for uid in seq_uids:  # Errorcheck mauve, cant continue if it crashed
-        mauve_error_check(seq_uids[uid], config)
+    Keyword arguments:
+    reference -- the reference sequence, as converted by x2fa
+    alternate -- the query sequence in the coordinates of the reference
+    window -- the size of the windows
+    windows -- the windows of a mini-reference, see windows.py, if the
+               sequences are in mini-reference coordinates
+
+    Returns a list of (start, end, identity, aligned coverage, gap fraction),
+    first for the whole reference and then for each window, with 1-based
+    start and end positions. Identity is the fraction of positions where
+    the query has the same base as the reference, coverage the fraction
+    where the query has a base at all and the gap fraction is the fraction
+    of the positions within aligned blocks where the query has a gap. For
+    a mini-reference the windows around the SNPs are reported instead of
+    windows of a fixed size, with their positions on the whole reference.
+
+    '''
+    length = len(reference)
+    if not length:
+        return [(1, 0, 0.0, 0.0, 0.0)]
+    ref = numpy.frombuffer(reference, dtype=numpy.uint8)
+    alt = numpy.frombuffer(alternate, dtype=numpy.uint8)
+    gap = ord("-")
+    identical = (ref == alt).astype(numpy.int64)
+    covered = (alt != gap).astype(numpy.int64)
+    in_block = ref != gap
+    deleted = (in_block & (alt == gap)).astype(numpy.int64)
+    in_block = in_block.astype(numpy.int64)
+
+    if windows:
+        starts = numpy.array([offset for offset in window_offsets(windows) if offset < length], dtype=numpy.int64)
+        first, last = windows[0][0], windows[-1][1]
+    else:
+        starts = numpy.arange(0, length, window)
+        first, last = 1, length
+    sizes = numpy.diff(numpy.append(starts, length))
+    counts = [numpy.add.reduceat(values, starts) for values in (identical, covered, deleted, in_block)]
+    stats = list()
+    stats.append((first, last, float(identical.sum()) / length, float(covered.sum()) / length,
+                  float(deleted.sum()) / max(1, in_block.sum())))
+    for i in range(len(starts)):
+        start = windows[i][0] if windows else starts[i] + 1  # On the whole reference
+        stats.append((start, start + sizes[i] - 1, float(counts[0][i]) / sizes[i],
+                      float(counts[1][i]) / sizes[i], float(counts[2][i]) / max(1, counts[3][i])))
+    return stats
+
+
+def wait_for_exit(pids, poll=None):
+    '''Waits until one of some child processes exits, returns its pid, exit code and resource usage.
+
+    Keyword arguments:
+    pids -- the child processes to wait for
+    poll -- called every QUOTA_INTERVAL seconds until one of them exits,
+            e.g. to check the workspace quota, None to just wait
+
+    Only the processes asked for are reaped, each with wait4(pid, WNOHANG)
+    every WAIT_INTERVAL seconds, so the exit status of any other child, e.g.
+    of a pool worker or a --serve server, is left for whoever started it.
+
+    '''
+    polled = time.time()
     while True:
-        while x2f_jobs and len(processes) < max_threads:
-            job = x2f_jobs.pop()
-            processes.append(Popen(job, shell=True))
+        for pid in pids:
+            try:
+                exited, status, usage = wait4(pid, WNOHANG)
+            except OSError as e:
+                if e.errno != errno.EINTR:  # Interrupted by a signal, try again
+                    raise
+                continue
+            if exited and WIFSIGNALED(status):
+                return pid, -WTERMSIG(status), usage
+            if exited:
+                return pid, WEXITSTATUS(status), usage
+        if poll is not None and time.time() - polled >= QUOTA_INTERVAL:
+            poll()
+            polled = time.time()
+        time.sleep(WAIT_INTERVAL)
+
+
+def run_alignments(file_name, references, output, config):
+    '''Aligns a query to each reference and yields the alignments as they finish.
+
+    Keyword arguments:
+    file_name -- the name of the fasta file that is aligned
+    references -- the (strain, uid, file name) tuples returned by export_references
+    output -- the prefix of the alignment files, written as <output>.<uid>
+              and the extension of the aligner, e.g. .xmfa, and of the
+              files their stderr goes to
+
+    The query is aligned with the aligner chosen with --aligner, see
+    aligners.py. At most num_threads aligner processes run at once. The
+    scheduler waits for one of them to exit, see wait_for_exit, starts the
+    next job in its place, checks the finished one with alignment_error_check and
+    yields its (strain, uid, file name). The caller can then convert that
+    alignment while the rest are still running. Any processes left when the
+    generator is closed, e.g. after a failed alignment or conversion, are
+    stopped.
+
+    If the workspace of the run has a quota, the scheduler also checks it
+    every QUOTA_INTERVAL seconds while it waits, and exits, stopping the
+    running aligners, as soon as their files grow past it.
+
+    In a worker of type_in_parallel every process also takes a slot of
+    the shared ALIGNMENT_SLOTS. A sample only waits for a slot when it
+    has no processes running, so samples never hold each other up.
+
+    '''
+    if config["num_threads"] == 0 or config["num_threads"] > len(references):
+        max_threads = len(references)
+    else:
+        max_threads = config["num_threads"]
+
+    aligner = make_aligner(config)
+    queue = list(references)
+    running = dict()  # pid -> (Popen object, error file, reference tuple, start time)
+
+    check_quota = None
+    workspace = config.get("run_workspace")
+    if workspace is not None and workspace.quota:
+        def check_quota():
+            try:
+                workspace.check()
+            except IOError as e:
+                exit("#[ERROR in %s] %s" % (config["query"], e.strerror))
+
+    def start_jobs():
+        while queue and len(running) < max_threads:
+            if ALIGNMENT_SLOTS is not None and not ALIGNMENT_SLOTS.acquire(not running):
+                break
+            strain, uid, reference_file = queue.pop(0)
+            error_file = "%s.%s.err" % (output, uid)
+            job = "%s 2> %s" % (aligner.command(reference_file, file_name, "%s.%s" % (output, uid)), error_file)
+            # Own process group, so the whole job can be stopped and not only the shell
+            SAMPLE_WORKER["starting"] = True
+            process = Popen(job, shell=True, preexec_fn=setsid)
+            running[process.pid] = (process, error_file, (strain, uid, reference_file), time.time())
+            ALIGNER_GROUPS.add(process.pid)
+            SAMPLE_WORKER["starting"] = False
+            if SAMPLE_WORKER.get("stopped"):  # Stopped while the process was started
+                stop_sample_worker(SIGTERM, None)
             if config["dev"]:
-                print("#[DEV] x2fa.py command: %s" % job)
-        for p in processes:
-            if p.poll() is not None:
-                processes.remove(p)
-        if not processes and not x2f_jobs:
-            break
-        time.sleep(0.5)
-    for uid in seq_uids:  # Errorcheck x2fa.py
-        x2fa_error_check(seq_uids[uid], config)
+                print("#[DEV] %s command: %s" % (aligner.name, job))
+
+    try:
+        while queue or running:
+            start_jobs()
+            pid, returncode, usage = wait_for_exit(list(running), check_quota)
+            process, error_file, reference, start_time = running.pop(pid)
+            ALIGNER_GROUPS.discard(pid)
+            process.returncode = returncode  # Already reaped by wait4()
+            if config.get("sample_profile"):
+                config["sample_profile"].child("%s %s" % (aligner.name, reference[0]), time.time() - start_time, usage)
+            if ALIGNMENT_SLOTS is not None:
+                ALIGNMENT_SLOTS.release()
+            start_jobs()
+            alignment_error_check(error_file, returncode, aligner, config)  # Cant continue if it crashed
+            yield reference
+    finally:
+        for process, error_file, reference, start_time in running.values():
+            try:
+                killpg(process.pid, SIGTERM)
+            except OSError:
+                pass
+            process.wait()
+            ALIGNER_GROUPS.discard(process.pid)
+            if ALIGNMENT_SLOTS is not None:
+                ALIGNMENT_SLOTS.release()
+
+
+def align(file_name, scheme, references, config, c):
+    '''Aligns a query to the reference sequences of an organism.
+
+    Keyword arguments:
+    file_name -- the name of the fasta file that is to be typed
+    scheme -- the compiled Scheme of the organism
+    references -- the (strain, uid, file name) tuples returned by export_references
+
+    Returns the query sequences aligned to each reference strain, keyed by
+    strain, and a dict of warnings.
+
+    With --snp_window the references are mini-references of the windows
+    around the SNPs, see export_snp_windows, and the aligned query is lifted
+    back to the coordinates of the whole reference.
+
+    The tmp files of the sample, the query, the progressiveMauve .sslist
+    index of it and the alignments, go to a directory of its own in the workspace
+    of the run, which is removed when the sample is done. The workspace
+    quota is checked each time an alignment is done.
+
+    '''
+    # Set warning flags
+    WARNINGS = dict()
+
+    db_name = scheme.organism
+
+    # Get output name
+    out_name = file_name.split("/")[-1]
+
+    # Check if the file exists
+    if not path.isfile(file_name):
+        exit("#[ERROR in %s] No such file: %s" % (config["query"], file_name))
 
-    # Now we have aligned sequences, read them into memory and
-    # start working through the tree
+    workspace = config["run_workspace"]
+    sample_directory = workspace.directory(out_name)
+    output = "%s/%s.CanSNPer" % (sample_directory, out_name)
+    # progressiveMauve writes the .sslist index next to the query, so the
+    # query is linked into the sample directory. It reads plain fasta, so a
+    # compressed query is written out instead.
+    query_file = path.join(sample_directory, out_name)
+    compressed = is_compressed(file_name)
+    if compressed:
+        query_file = path.join(sample_directory, "query.fa")
+
+    # Each alignment is projected onto the coordinates of its reference as
+    # soon as it is done, while the others are still running
+    aligner = make_aligner(config)
     alternates = dict()
-    for i in range(1, seq_counter + 1):
-        if config["save_align"]:
-            fasta_name = reference_sequences[i]
-        else:
-            fasta_name = seq_uids[i]
-        fasta_name_readable = reference_sequences[i]
-        alignment_file = open("%s.%s.fa" % (output, fasta_name), "r")
-        sequences = alignment_file.read().split(">")[1:]
-        alignment_file.close()
-        reference = "".join(sequences[0].split("\n")[1:])
-        alternate = "".join(sequences[1].split("\n")[1:])
-        alternates[reference_sequences[i]] = alternate
-        identity_counter = 0
-        for j in range(0, len(reference)):
-            if reference[j] == alternate[j]:
-                identity_counter += 1
+    stats = dict()
+    finished_alignments = run_alignments(query_file, references, output, config)
+    try:
+        # The query is checked against QUERY_BASES in one streaming pass
+        # either way, a plain one before it is linked
+        try:
+            if compressed:
+                copy_fasta(file_name, query_file, QUERY_BASES)
+            else:
+                for record, offset, chunk in fasta_chunks(file_name, QUERY_BASES):
+                    pass
+        except ValueError as e:
+            exit("#[ERROR in %s] Could not read %s: %s" % (config["query"], file_name, str(e)))
+        if not compressed:
+            symlink(path.abspath(file_name), query_file)
+
         if config["verbose"]:
-            print("#Seq identity with %s: %.2f%s" % (fasta_name_readable, float(identity_counter) /
-                  float(len(reference)) * 100, "%"))
-        if float(identity_counter) / float(len(reference)) < 0.8:
-            WARNINGS["ALIGNMENT_WARNING"] = "#[WARNING in %s] Sequence identity between %s and a reference strain of" % (config["query"], out_name) +\
-                " %s was only %.2f percent" % (db_name, float(identity_counter) / float(len(reference)) * 100)
+            print("#Aligning sequence against %i reference sequence(s) ..." % len(references))
 
-    root = find_tree_root(db_name, c, config)  # Find the root of the tree we are using
-    if config["verbose"]:
-        print("#Using tree root:", root)
+        while True:
+            with profile_stage(config, "alignment"):  # Waiting for the next alignment to finish
+                finished = next(finished_alignments, None)
+            if finished is None:
+                break
+            try:
+                workspace.check()
+            except IOError as e:
+                exit("#[ERROR in %s] %s" % (config["query"], e.strerror))
+            strain, uid, reference_file = finished
+            alignment_file = aligner.output_file("%s.%s" % (output, uid))
+            if config["dev"]:
+                print("#[DEV] %s conversion: %s %s" % (aligner.name, alignment_file, reference_file))
+            projection_errors = ""
+            with profile_stage(config, "projection"):
+                try:
+                    sequences = aligner.project(alignment_file, reference_file, query_file)
+                except Exception:
+                    projection_errors = traceback.format_exc()
+            projection_error_check(projection_errors, aligner, config)
+            windows = None
+            if config["snp_window"]:
+                windows = read_windows(reference_file)
+            if config["save_align"]:  # The query named as given, not as linked into the workspace
+                write_fasta("%s/%s.CanSNPer.%s.fa" % (getcwd(), out_name, strain),
+                            [(file_name if name == query_file else name,
+                              lift(sequence, windows) if windows else sequence) for name, sequence in sequences])
+            reference = sequences[0][1]
+            alternate = sequences[1][1]
+            alternates[strain] = alternate
+            if windows:
+                alternates[strain] = lift(alternate, windows)
+            with profile_stage(config, "identity"):
+                stats[strain] = alignment_stats(reference, alternate, config["stats_window"], windows)
+            identity = stats[strain][0][2]
+            if config["verbose"]:
+                print("#Seq identity with %s: %.2f%s" % (strain, identity * 100, "%"))
+            if config["dev"]:
+                print("#[DEV] Aligned coverage of %s: %.4f, gap fraction: %.4f, lowest window identity: %.4f" %
+                      (strain, stats[strain][0][3], stats[strain][0][4], min([window[2] for window in stats[strain]])))
+            if identity < 0.8:
+                alignment_warning(WARNINGS, "#[WARNING in {query}] Sequence identity between {name} and a reference strain of" +
+                                  " %s was only %.2f percent" % (db_name, identity * 100), out_name, config)
+    finally:
+        finished_alignments.close()  # Stops the alignments that are left if a conversion failed
+        remove_directory(sample_directory)
+
+    if config["alignment_stats"]:
+        stats_file = open("%s_alignment_stats.txt" % file_name, "w")
+        stats_file.write("#Reference\tStart\tEnd\tIdentity\tAligned_coverage\tGap_fraction\n")
+        for strain, uid, reference_file in references:
+            for start, end, identity, coverage, gap_fraction in stats[strain]:
+                stats_file.write("%s\t%i\t%i\t%.4f\t%.4f\t%.4f\n" % (strain, start, end, identity,
+                                                                      coverage, gap_fraction))
+        stats_file.close()
+    return alternates, WARNINGS
+
+
+def classify(file_name, alternates, scheme, WARNINGS, config, c):
+    '''This function is the "main" of the classifier part of the program.
+
+    Keyword arguments:
+    file_name -- the name of the fasta file that is typed
+    alternates -- the query sequence aligned to each reference strain, keyed by strain
+    scheme -- the compiled Scheme of the organism
+    WARNINGS -- warnings collected while typing the query
+
+    Walks the tree and distributes all the results. Returns the node the
+    query was classified as and the list of SNPs that were not in the
+    derived state.
+
+    '''
+    db_name = scheme.organism
+    out_name = file_name.split("/")[-1]
 
     if config["allow_differences"]:  # Check whether or not to force the first tree node
         force_flag = True
     else:
         force_flag = False
 
-    if config["list_snps"]:  # Make a raw list of which SNPs the sequence has
-        snp_out_file = open("%s_snplist.txt" % file_name, "w")
-        snplist = snp_lister(alternates, db_name, out_name, config, c)
-        for snp in snplist:
-            snp_out_file.write("\t".join(snp) + "\n")
-        snp_out_file.close()
+    with profile_stage(config, "output"):
+        if config["list_snps"] or config["draw_tree"]:
+            snplist = snp_lister(alternates, scheme, out_name, config)
 
-    if config["draw_tree"]:  # Draw a tree and mark positions
-        snplist = snp_lister(alternates, db_name, out_name, config, c)
-        if config["galaxy"]:
-            tree_file_name = getcwd() + "/CanSNPer_tree_galaxy.pdf"
-        else:
-            tree_file_name = "%s_tree.pdf" % file_name
-        draw_ete2_tree(db_name, snplist[1:], tree_file_name, config, c)
+        if config["list_snps"]:  # Make a raw list of which SNPs the sequence has
+            snp_out_file = open("%s_snplist.txt" % file_name, "w")
+            for snp in snplist:
+                snp_out_file.write("\t".join(snp) + "\n")
+            snp_out_file.close()
+
+        if config["draw_tree"]:  # Draw a tree and mark positions
+            if config["galaxy"]:
+                tree_file_name = getcwd() + "/CanSNPer_tree_galaxy.pdf"
+            else:
+                tree_file_name = "%s_tree.pdf" % file_name
+            draw_ete2_tree(db_name, snplist[1:], tree_file_name, config, c)
     # Tree walker!
-    tree_location = multi_tree_walker(root, alternates, db_name, config["allow_differences"],
-                                      list(), config, c, force_flag)
+    with profile_stage(config, "tree walk"):
+        tree_location = multi_tree_walker(scheme.root, alternates, scheme, config["allow_differences"],
+                                          list(), config, force_flag)
+    with profile_stage(config, "output"):
+        report_result(out_name, tree_location, scheme, WARNINGS, config)
+    return tree_location
+
+
+def report_result(out_name, tree_location, scheme, WARNINGS, config):
+    '''Prints the classification of a query and the warnings collected while typing it.
+
+    Keyword arguments:
+    out_name -- the name the query is reported as
+    tree_location -- the node the query was classified as and the list of
+                     SNPs that were not in the derived state on the way
+    scheme -- the compiled Scheme of the organism
+    WARNINGS -- warnings collected while typing the query
 
+    With --lineage the path from the root to the node is printed as well,
+    ;-separated like the lines of a tree text file.
+
+    '''
     # print(the results of our walk)
+    if config["lineage"]:
+        lineage = ";".join(str(node) for node in scheme.lineage(tree_location[0]))
     if config["tab_sep"]:
-        print("%s\t%s" % (out_name, tree_location[0]))
+        if config["lineage"]:
+            print("%s\t%s\t%s" % (out_name, tree_location[0], lineage))
+        else:
+            print("%s\t%s" % (out_name, tree_location[0]))
     else:
         print("Classification of %s: %s" % (out_name, tree_location[0]))
+        if config["lineage"]:
+            print("Lineage of %s: %s" % (out_name, lineage))
 
     if tree_location[1]:
         incorrect_snps = ""
@@ -993,27 +2061,139 @@ def align(file_name, config, c):
     except KeyError:
         pass
 
-    # Remove a bunch of tmp files
-    while seq_counter:
-        if config["save_align"]:
-            destination = getcwd()
-            srcfile = "%s.%s.fa" % (output, reference_sequences[seq_counter])
-            shutil_copy(srcfile, destination)
-            silent_remove("%s.%s.fa" % (output, reference_sequences[seq_counter]))
-        silent_remove("%s.%s.fa" % (output, seq_uids[seq_counter]))
-        silent_remove("%s/CanSNPer_reference_sequence.%s.fa" % (config["tmp_path"],
-                      seq_uids[seq_counter]))
-        silent_remove("%s/CanSNPer_reference_sequence.%s.fa.sslist" % (config["tmp_path"],
-                      seq_uids[seq_counter]))
-        silent_remove("%s.sslist" % (file_name))
-        silent_remove("%s.%s.xmfa" % (output, seq_uids[seq_counter]))
-        silent_remove("%s.%s.xmfa.bbcols" % (output, seq_uids[seq_counter]))
-        silent_remove("%s.%s.xmfa.backbone" % (output, seq_uids[seq_counter]))
-        seq_counter -= 1
+
+def warm_organism(config, c):
+    '''Returns the scheme and index of an organism, as kept by a --serve server.
+
+    Keyword arguments:
+    config -- the settings of a job, with its organism and typing mode
+
+    They are loaded with load_organism the first time they are needed, and
+    again if the tree, SNPs or sequences in the database have been written
+    to since, i.e. the Data_changes counter has changed, see data_changes,
+    or if an exported reference has been removed from the reference cache.
+    The results the jobs save do not count as changes.
+
+    '''
+    db_name = get_organism(config, c)
+    if config["mode"] == "flank":
+        key = (db_name, config["mode"], config["flank_length"])
+    elif config["mode"] == "reads":
+        key = (db_name, config["mode"], config["kmer_length"])
+    else:
+        key = (db_name, config["mode"], config["snp_window"])
+    changes = data_changes(c)
+    if key in WARM_ORGANISMS:
+        version, loaded = WARM_ORGANISMS[key]
+        if version == changes and (config["mode"] != "align" or
+                                   all(path.isfile(reference[2]) for reference in loaded[1])):
+            return loaded
+    if config["verbose"]:
+        print("#Loading %s for %s mode" % (db_name, config["mode"]))
+    # The scheme version is always computed, it is kept for jobs with a result cache
+    loaded = load_organism(db_name, dict(config, result_cache=True, sample_profile=None), c)
+    c.connection.commit()
+    WARM_ORGANISMS[key] = (changes, loaded)
+    return loaded
+
+
+def serve(config, c):
+    '''Types the queries sent with --socket to the --serve socket, until stopped.
+
+    Keyword arguments:
+    config -- the settings of the server, a job brings its own JOB_OPTIONS
+
+    The server keeps the scheme and index of each organism and typing mode
+    it has typed queries of loaded, see warm_organism, so a job only has to
+    align or look up its queries. The organism given with --reference, if
+    any, is loaded before the first job. Each job is typed in a process of
+    its own, forked from the server, in the working directory of the
+    client. Jobs run at the same time, and in align mode share one budget
+    of num_threads aligner processes, one per CPU if num_threads
+    is 0. A job gets back what CanSNPer would have printed had it been run
+    on the command line, and its exit code.
+
+    '''
+    global ALIGNMENT_SLOTS
+    ALIGNMENT_SLOTS = BoundedSemaphore(config["num_threads"] or cpu_count())
+    for option in ("db_path", "tmp_path", "reference_cache", "workspace"):
+        config[option] = path.abspath(config[option])  # The jobs change directory
+    c.connection.commit()  # The jobs write results to the database
+
+    def job_config(job):
+        # As str, the way they are given on the command line
+        job_config = dict(config)
+        for option in JOB_OPTIONS:
+            job_config[option] = job["options"][option]
+            if isinstance(job_config[option], unicode):
+                job_config[option] = job_config[option].encode("utf8")
+        job_config["query_files"] = [query.encode("utf8") for query in job["query"]]
+        job_config["query"] = " ".join(job_config["query_files"])
+        return job_config
+
+    def prepare_job(job):
+        # Runs in the server, which prints as verbose as it was started
+        job["loaded"] = warm_organism(dict(job_config(job), verbose=config["verbose"], dev=config["dev"]), c)
+
+    def run_job(job):
+        signal(SIGTERM, stop_sample_worker)
+        chdir(job["cwd"])
+        scheme, index = job["loaded"]
+        if job["options"]["mode"] == "align":  # New tmp file names for this job
+            index = [(strain, uuid4().hex, reference_file) for strain, uid, reference_file in index]
+        job_c = sqlite3.connect(config["db_path"]).cursor()
+        try:
+            type_queries(job["query"], job_config(job), job_c, (scheme, index))
+        finally:
+            job_c.connection.commit()
+            job_c.connection.close()
+
+    if config["reference"]:
+        warm_organism(config, c)
+    server = TypingServer(config["serve"], prepare_job, run_job)
+    signal(SIGTERM, stop_server)
+    if config["verbose"]:
+        print("#Serving on %s" % config["serve"])
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def stop_server(signum, frame):
+    exit(0)
+
+
+def submit_job(config):
+    '''Types the queries on the CanSNPer server listening on the --socket, returns the exit code.
+
+    The queries and the typing options are sent as given to this process,
+    file names relative to its working directory, and what the server
+    printed for the job is printed here.
+
+    '''
+    if not config["reference"] or not config["query_files"]:
+        exit("#[ERROR in %s] --socket needs the organism, given with --reference, and the queries" %
+             config["query"])
+    job = {"cwd": getcwd(), "query": config["query_files"],
+           "options": dict((option, config[option]) for option in JOB_OPTIONS)}
+    try:
+        reply = send_job(config["socket"], job)
+    except EnvironmentError as e:
+        exit("#[ERROR in %s] Could not reach the CanSNPer server at %s:\n%s" % (config["query"],
+             config["socket"], str(e)))
+    sys.stdout.write(reply["stdout"].encode("utf8"))
+    sys.stdout.flush()
+    sys.stderr.write(reply["stderr"].encode("utf8"))
+    return reply["exit_code"]
 
 
 def main():
     config = parse_arguments()
+
+    if config["socket"]:
+        exit(submit_job(config))
     
     db_open = False
     # Open sqlite3 connection
@@ -1024,6 +2204,10 @@ def main():
             cnx = sqlite3.connect(config["db_path"])
             c = cnx.cursor()
             db_open = True
+            # Databases from earlier versions are migrated to the current schema
+            old_version = migrate_database(config, c)
+            if old_version < SCHEMA_VERSION and config["verbose"]:
+                print("#Migrated the database from schema version %i to %i" % (old_version, SCHEMA_VERSION))
         except sqlite3.OperationalError as e:
             exit("#[ERROR in %s] Could not open database at %s:\n%s" % (config["query"],
                  config["db_path"], str(e)))
@@ -1043,10 +2227,14 @@ def main():
         if config["import_seq_file"]:
             import_sequence(config["import_seq_file"], config, c)
 
-        if config["query"]:
-            if config["verbose"]:
-                print("#Starting %s ..." % config["query"])
-            align(config["query"], config, c)
+        if config["export_tree_file"]:
+            export_tree(config["export_tree_file"], config, c)
+
+        if config["serve"]:
+            serve(config, c)
+
+        if config["query_files"]:
+            type_queries(config["query_files"], config, c)
 
         if config["delete_organism"]:
             purge_organism(config, c)
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+aligners.py: The aligners a query can be aligned to the references with.
+This file is part of CanSNPer.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Each aligner gives the shell command that aligns a query to one reference
+and projects its output onto the coordinates of the reference. The output
+of an earlier run can be projected without the aligner, e.g. to check a
+backend against recorded files:
+
+    aligners.py <aligner> <alignment file> <reference fasta> <query fasta> <out fasta>
+
+writes the reference and the projected query to a fasta file, like x2fa.py.
+'''
+import re
+import sys
+
+from x2fa import project, reverse_complement, write_fasta
+from fasta import read_fasta
+
+# The operations of a minimap2 cs tag: identical bases, long (=ACGT) or short
+# (:4) form, a substitution, an insertion or deletion, and an intron
+CS_OPERATION = re.compile(r"(=[A-Za-z]+|:[0-9]+|\*[a-z][a-z]|[+-][a-z]+|~[a-z]{2}[0-9]+[a-z]{2})")
+
+
+def read_reference(reference_file):
+    '''Returns the name and sequence of the first record of a reference fasta file.'''
+    for name, sequence in read_fasta(reference_file):
+        return name.split()[0], sequence
+    raise ValueError("No fasta records in %s" % reference_file)
+
+
+class Aligner(object):
+    '''An aligner, that aligns a query to one reference sequence at a time.
+
+    run_alignments runs the command of each reference in a process of its
+    own, with stderr going to a file, and align then projects the output,
+    see project. Subclasses give the name, the config option with the path
+    to the aligner and whether anything on stderr means that it failed.
+
+    '''
+    name = None
+    path_option = None
+    stderr_is_error = False  # Else only the exit code counts
+
+    def __init__(self, path):
+        '''
+        Keyword arguments:
+        path -- the aligner command, e.g. the path to its binary
+
+        '''
+        self.path = path
+
+    def command(self, reference_file, query_file, output):
+        '''Returns the shell command that aligns the query to the reference.
+
+        Keyword arguments:
+        reference_file -- the reference fasta file
+        query_file -- the query fasta file
+        output -- the prefix of the output files
+
+        '''
+        raise NotImplementedError
+
+    def output_file(self, output):
+        '''Returns the name of the alignment file written by command with the output prefix.'''
+        raise NotImplementedError
+
+    def project(self, alignment_file, reference_file, query_file):
+        '''Returns the reference and the query in the coordinates of the reference.
+
+        Keyword arguments:
+        alignment_file -- the output of the aligner, see output_file
+        reference_file -- the reference fasta file
+        query_file -- the query fasta file
+
+        Returns [(reference name, reference), (query name, query)], as
+        x2fa.project does. The query has a gap, "-", wherever no base of
+        it is aligned to the reference. Where alignments overlap on the
+        reference the last one in the file wins.
+
+        '''
+        raise NotImplementedError
+
+
+class MauveAligner(Aligner):
+    '''progressiveMauve, its xmfa output is projected by x2fa.'''
+    name = "progressiveMauve"
+    path_option = "mauve_path"
+    stderr_is_error = True
+
+    def command(self, reference_file, query_file, output):
+        return "%s --output=%s %s %s > /dev/null" % (self.path, self.output_file(output), reference_file, query_file)
+
+    def output_file(self, output):
+        return "%s.xmfa" % output
+
+    def project(self, alignment_file, reference_file, query_file):
+        return project(alignment_file, reference_file)
+
+
+class NucmerAligner(Aligner):
+    '''nucmer of MUMmer, its delta output is projected with the sequences of the query.'''
+    name = "nucmer"
+    path_option = "nucmer_path"
+
+    def command(self, reference_file, query_file, output):
+        return "%s --prefix=%s %s %s > /dev/null" % (self.path, output, reference_file, query_file)
+
+    def output_file(self, output):
+        return "%s.delta" % output
+
+    def project(self, alignment_file, reference_file, query_file):
+        '''Projects a delta file, see Aligner.project.
+
+        Each alignment lists its reference and query interval, the query
+        interval backwards if it aligns to the reverse strand, followed by
+        the distance from one indel to the next, positive for a reference
+        base with no query base, negative for a query base with no reference
+        base, and a 0.
+
+        '''
+        reference_name, reference = read_reference(reference_file)
+        queries = dict((name.split()[0], sequence) for name, sequence in read_fasta(query_file))
+        alternate = bytearray("-" * len(reference))
+        delta_file = open(alignment_file, "r")
+        delta_file.readline()  # The file names
+        delta_file.readline()  # NUCMER or PROMER
+        segment = None  # The aligned part of the query, on the strand it aligns on
+        for line in delta_file:
+            fields = line.split()
+            if line.startswith(">"):  # >reference record, query record, lengths
+                query = None
+                if fields[0][1:] == reference_name:
+                    query = queries[fields[1]]
+            elif len(fields) == 7:  # Start and end on the reference and the query, and error counts
+                reference_start, reference_end, query_start, query_end = [int(field) for field in fields[:4]]
+                segment = None
+                if query is not None:
+                    if query_start <= query_end:
+                        segment = query[query_start - 1:query_end]
+                    else:
+                        segment = reverse_complement(query[query_end - 1:query_start])
+                    position = reference_start - 1  # In the reference
+                    offset = 0  # In the segment
+            elif segment is not None:
+                distance = int(fields[0])
+                if distance == 0:  # The end of the alignment, the rest is ungapped
+                    bases = reference_end - position
+                    alternate[position:position + bases] = segment[offset:offset + bases]
+                    segment = None
+                    continue
+                bases = abs(distance) - 1
+                alternate[position:position + bases] = segment[offset:offset + bases]
+                position += bases
+                offset += bases
+                if distance > 0:
+                    alternate[position:position + 1] = "-"
+                    position += 1
+                else:
+                    offset += 1
+        delta_file.close()
+        return [(reference_file, reference), (query_file, str(alternate))]
+
+
+class Minimap2Aligner(Aligner):
+    '''minimap2, its PAF output with cs tags is projected without reading the query.'''
+    name = "minimap2"
+    path_option = "minimap2_path"
+
+    def command(self, reference_file, query_file, output):
+        return "%s -c --cs -x asm20 --secondary=no %s %s > %s" % (self.path, reference_file, query_file,
+                                                                    self.output_file(output))
+
+    def output_file(self, output):
+        return "%s.paf" % output
+
+    def project(self, alignment_file, reference_file, query_file):
+        '''Projects a PAF file, see Aligner.project.
+
+        The cs tag describes the alignment along the + strand of the
+        reference, whichever strand the query aligns on, so the bases of the
+        query are read from the reference and the cs tag alone. Secondary
+        alignments are skipped.
+
+        '''
+        reference_name, reference = read_reference(reference_file)
+        alternate = bytearray("-" * len(reference))
+        paf_file = open(alignment_file, "r")
+        for line_number, line in enumerate(paf_file, 1):
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 12 or fields[5] != reference_name:
+                continue
+            tags = dict((tag[:2], tag[5:]) for tag in fields[12:])
+            if tags.get("tp") == "S":
+                continue
+            if "cs" not in tags:
+                raise ValueError("No cs tag on line %i of %s, minimap2 has to be run with --cs" %
+                                 (line_number, alignment_file))
+            position = int(fields[7])
+            for operation in CS_OPERATION.findall(tags["cs"]):
+                if operation[0] == ":":
+                    bases = int(operation[1:])
+                    alternate[position:position + bases] = reference[position:position + bases]
+                    position += bases
+                elif operation[0] == "=":
+                    alternate[position:position + len(operation) - 1] = operation[1:]
+                    position += len(operation) - 1
+                elif operation[0] == "*":  # Reference base, query base
+                    alternate[position:position + 1] = operation[2].upper()
+                    position += 1
+                elif operation[0] == "-":
+                    alternate[position:position + len(operation) - 1] = "-" * (len(operation) - 1)
+                    position += len(operation) - 1
+                elif operation[0] == "~":
+                    position += int(operation[3:-2])
+                # Insertions in the query have no reference position
+        paf_file.close()
+        return [(reference_file, reference), (query_file, str(alternate))]
+
+
+# The aligners that can be chosen with --aligner
+ALIGNERS = dict((aligner.name, aligner) for aligner in (MauveAligner, NucmerAligner, Minimap2Aligner))
+
+
+def make_aligner(config):
+    '''Returns the aligner chosen with --aligner, with its path from the config.'''
+    aligner = ALIGNERS[config["aligner"]]
+    return aligner(config[aligner.path_option])
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 6 or sys.argv[1] not in ALIGNERS:
+        sys.exit("Usage: aligners.py <%s> <alignment file> <reference fasta> <query fasta> <out fasta>" %
+                 "|".join(sorted(ALIGNERS)))
+    write_fasta(sys.argv[5], ALIGNERS[sys.argv[1]](None).project(sys.argv[2], sys.argv[3], sys.argv[4]))
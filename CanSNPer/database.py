@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+'''
+database.py: The schema of the CanSNPer database and its migrations.
+This file is part of CanSNPer.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+from sys import exit
+
+from sequences import create_sequence_tables, migrate_sequences
+from results import create_results_table
+
+# The schema version is kept in the user_version of the database file.
+# 0 -- one SNP table per organism, the tree as ;-joined Children strings in
+#      the Tree table and the reference sequences as text
+# 1 -- the reference sequences in compressed blocks, see sequences.py
+# 2 -- one SNP table and one table of tree edges for all organisms, indexed
+# 3 -- the Tree_index table of parents, nested set intervals and depths
+# 4 -- the Data_changes counter and the triggers that bump it
+# 5 -- the Sequences table without the Sequence column, NULL since version 1
+SCHEMA_VERSION = 5
+
+# Tables the compiled schemes and exported references are made from, any
+# write to them bumps the Data_changes counter
+CHANGE_TABLES = ["SNPs", "Tree_edges", "Sequences", "Sequence_blocks"]
+
+# Columns of the per organism SNP tables of schema version 0
+LEGACY_SNP_COLUMNS = ["SNP", "Reference", "Strain", "Position", "Derived_base", "Ancestral_base"]
+
+
+def create_tables(c):
+    '''Creates the tables and indexes of the current schema that are not in the database.
+
+    Organisms -- the organisms in the database
+    SNPs -- the canSNPs of every organism
+    Tree_edges -- the canSNP trees as (parent, child) edges, the children of
+                  a node in the order they were imported. Nodes that are no
+                  one's child, i.e. the root, have an edge from NULL
+    Tree_index -- the parent, depth and nested set interval of every node,
+                  see nested_set, rebuilt whenever a tree is imported
+    Sequences -- the strains that have a reference sequence
+    Sequence_blocks -- the reference sequences, see sequences.py
+    Results -- cached typing results
+    Data_changes -- one row counting the writes to the CHANGE_TABLES, see
+                    data_changes
+
+    '''
+    c.execute("CREATE TABLE IF NOT EXISTS Organisms (Name text PRIMARY KEY)")
+    c.execute("CREATE TABLE IF NOT EXISTS SNPs (Organism text, SNP text, Reference text, Strain text, " +
+              "Position integer, Derived_base text, Ancestral_base text)")
+    c.execute("CREATE INDEX IF NOT EXISTS SNPs_index ON SNPs (Organism, SNP)")
+    c.execute("CREATE TABLE IF NOT EXISTS Tree_edges (Organism text, Parent text, Child text)")
+    c.execute("CREATE INDEX IF NOT EXISTS Tree_edges_parent ON Tree_edges (Organism, Parent)")
+    c.execute("CREATE INDEX IF NOT EXISTS Tree_edges_child ON Tree_edges (Organism, Child)")
+    c.execute("CREATE TABLE IF NOT EXISTS Tree_index (Organism text, Node text, Parent text, " +
+              "Lft integer, Rgt integer, Depth integer)")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS Tree_index_node ON Tree_index (Organism, Node)")
+    c.execute("CREATE INDEX IF NOT EXISTS Tree_index_interval ON Tree_index (Organism, Lft)")
+    c.execute("CREATE TABLE IF NOT EXISTS Sequences (Organism text, Strain text)")
+    c.execute("CREATE INDEX IF NOT EXISTS Sequences_index ON Sequences (Organism, Strain)")
+    create_sequence_tables(c)
+    create_results_table(c)
+    c.execute("CREATE TABLE IF NOT EXISTS Data_changes (Changes integer)")
+    c.execute("INSERT INTO Data_changes SELECT 0 WHERE NOT EXISTS (SELECT * FROM Data_changes)")
+    for table in CHANGE_TABLES:
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            c.execute("CREATE TRIGGER IF NOT EXISTS %s_%s AFTER %s ON %s " % (table, event.lower(), event, table) +
+                      "BEGIN UPDATE Data_changes SET Changes = Changes + 1; END")
+
+
+def data_changes(c):
+    '''Returns the number of writes made to the SNPs, trees and reference sequences of the database.
+
+    The counter is bumped by triggers, whichever process writes, but not by
+    writes to other tables such as Results, so it is a cheap way to tell
+    whether a compiled scheme or an exported reference may be out of date.
+
+    '''
+    c.execute("SELECT Changes FROM Data_changes")
+    return c.fetchone()[0]
+
+
+def schema_version(c):
+    '''Returns the schema version of the database.'''
+    c.execute("PRAGMA user_version")
+    return c.fetchone()[0]
+
+
+def migrate_database(config, c):
+    '''Brings the database up to the current schema version, one version at a time.
+
+    Keyword arguments:
+    c -- cursor of the CanSNPer database
+
+    Each step runs in a transaction of its own, begun and committed here
+    along with the new version number, as python's sqlite3 would otherwise
+    commit before each CREATE or DROP TABLE. A step that is stopped half
+    way, e.g. by a crash after one of its tables was dropped, is rolled
+    back as a whole and run again the next time the database is opened. A
+    new database is set up with the current schema right away. Returns the
+    version the database had.
+
+    '''
+    version = schema_version(c)
+    if version > SCHEMA_VERSION:
+        exit("#[ERROR in %s] The database has schema version %i, this version of CanSNPer " % (config["query"], version) +
+             "only knows version %i or lower" % SCHEMA_VERSION)
+    original_version = version
+    isolation_level = c.connection.isolation_level
+    c.connection.isolation_level = None  # The transactions are begun and committed by hand
+    try:
+        while version < SCHEMA_VERSION:
+            c.execute("BEGIN")
+            try:
+                MIGRATIONS[version](c)
+                version += 1
+                c.execute("PRAGMA user_version = %i" % version)
+                c.execute("COMMIT")
+            except Exception:
+                c.execute("ROLLBACK")
+                raise
+        if original_version == 0:
+            c.execute("VACUUM")  # Give the space of the text sequences back to the file system
+    finally:
+        c.connection.isolation_level = isolation_level
+    return original_version
+
+
+def normalise_tables(c):
+    '''Migrates a database from schema version 1 to 2.
+
+    The rows of each per organism SNP table are moved to the SNPs table and
+    the Children strings of the Tree table are split into Tree_edges, after
+    which the old tables are dropped. Rows keep their order. The tables are
+    dropped in the transaction of migrate_database, so they are only gone
+    once the Organisms rows are in as well.
+
+    '''
+    create_tables(c)
+    c.execute("SELECT name FROM sqlite_master WHERE type='table' ORDER BY name")
+    tables = [row[0] for row in c.fetchall()]
+    organisms = list()
+    for table in tables:
+        c.execute("PRAGMA table_info(%s)" % table)
+        if [row[1] for row in c.fetchall()] == LEGACY_SNP_COLUMNS:
+            organisms.append(table)
+            c.execute("INSERT INTO SNPs SELECT ?, SNP, Reference, Strain, Position, Derived_base, Ancestral_base " +
+                      "FROM %s ORDER BY rowid" % table, (table,))
+            c.execute("DROP TABLE %s" % table)
+    if "Tree" in tables:
+        c.execute("SELECT Name, Children, Organism FROM Tree ORDER BY rowid")
+        legacy_trees = dict()
+        for name, children, organism in c.fetchall():
+            if organism not in legacy_trees:
+                legacy_trees[organism] = list()
+                organisms.append(organism)
+            legacy_trees[organism].append((name, children))
+        for organism in legacy_trees:
+            c.executemany("INSERT INTO Tree_edges VALUES(?,?,?)",
+                          [(organism, parent, child) for parent, child in tree_edges(legacy_trees[organism])])
+        c.execute("DROP TABLE Tree")
+    c.execute("SELECT DISTINCT Organism FROM Sequences")
+    organisms.extend(row[0] for row in c.fetchall())
+    c.executemany("INSERT OR IGNORE INTO Organisms VALUES(?)", [(organism,) for organism in organisms])
+
+
+def index_trees(c):
+    '''Migrates a database from schema version 2 to 3 by indexing every tree.'''
+    create_tables(c)
+    c.execute("SELECT DISTINCT Organism FROM Tree_edges")
+    for organism in [row[0] for row in c.fetchall()]:
+        build_tree_index(organism, c)
+
+
+def add_change_counter(c):
+    '''Migrates a database from schema version 3 to 4 by adding the Data_changes counter and its triggers.'''
+    create_tables(c)
+
+
+def drop_sequence_column(c):
+    '''Migrates a database from schema version 4 to 5 by dropping the Sequence column of Sequences.
+
+    The sequences are in Sequence_blocks since version 1, so the column is
+    always NULL. SQLite cannot drop a column, so the table is copied
+    without it, keeping the order of the rows, and the copy takes its
+    place. Its index and triggers are then made again by create_tables.
+
+    '''
+    c.execute("PRAGMA table_info(Sequences)")
+    if "Sequence" in [row[1] for row in c.fetchall()]:
+        c.execute("CREATE TABLE Sequences_copy (Organism text, Strain text)")
+        c.execute("INSERT INTO Sequences_copy SELECT Organism, Strain FROM Sequences ORDER BY rowid")
+        c.execute("DROP TABLE Sequences")
+        c.execute("ALTER TABLE Sequences_copy RENAME TO Sequences")
+    create_tables(c)
+
+
+# MIGRATIONS[i] migrates a database from schema version i to i + 1
+MIGRATIONS = [migrate_sequences, normalise_tables, index_trees, add_change_counter, drop_sequence_column]
+
+
+def tree_edges(rows):
+    '''Returns the (parent, child) edges of a tree given as (Name, Children) rows.
+
+    Keyword arguments:
+    rows -- (Name, Children) rows, Children a ;-joined string or None, in
+            the order the nodes were first seen
+
+    Like the walker always did, only the first row of a node counts. A
+    node that is no one's child gets an edge from None before its own
+    children, so the first of those is the root.
+
+    '''
+    children = dict()
+    names = list()
+    for name, child_names in rows:
+        if name not in children:
+            names.append(name)
+            children[name] = [child for child in (child_names or "").split(";") if child]
+    is_child = set()
+    for name in names:
+        is_child.update(children[name])
+    edges = list()
+    for name in names:
+        if name not in is_child:
+            edges.append((None, name))
+        for child in children[name]:
+            edges.append((name, child))
+    return edges
+
+
+def tree_rows(organism, c):
+    '''Returns the tree of an organism as (Name, Children) rows, the inverse of tree_edges.
+
+    Keyword arguments:
+    organism -- the name of the organism
+    c -- cursor of the CanSNPer database
+
+    Nodes are listed in the order they first appear in the edges, so the
+    root comes before any other node that is no one's child.
+
+    '''
+    c.execute("SELECT Parent, Child FROM Tree_edges WHERE Organism = ? ORDER BY rowid", (organism,))
+    names = list()
+    children = dict()
+    for parent, child in c.fetchall():
+        for node in (parent, child):
+            if node is not None and node not in children:
+                names.append(node)
+                children[node] = list()
+        if parent is not None:
+            children[parent].append(child)
+    return [(name, ";".join(children[name]) or None) for name in names]
+
+
+def nested_set(rows):
+    '''Returns the (Node, Parent, Lft, Rgt, Depth) rows of the index of a tree.
+
+    Keyword arguments:
+    rows -- (Name, Children) rows of the tree, as returned by tree_rows
+
+    Nodes are numbered in pre-order from the root, Lft being the number of
+    the node and Rgt the highest number in its clade, so Y is X or one of
+    its ancestors exactly when Y.Lft <= X.Lft <= Y.Rgt, and the clade of Y
+    is the nodes with Lft from Y.Lft to Y.Rgt. The root has depth 0 and no
+    parent. Trees are numbered from every node that is no one's child, in
+    row order, so nodes that are cut off from the root are still indexed.
+    Rows come out in pre-order.
+
+    '''
+    children = dict()
+    names = list()
+    for name, child_names in rows:
+        if name not in children:
+            names.append(name)
+            children[name] = [child for child in (child_names or "").split(";") if child]
+    is_child = set()
+    for name in names:
+        is_child.update(children[name])
+    starts = [name for name in names if name not in is_child] + names  # Roots first, then any cycles
+    index = list()
+    position = dict()  # Where the row of each numbered node is in index
+    for start in starts:
+        if start in position:
+            continue
+        # Each node is numbered when it is popped, its Rgt is filled in
+        # once the last node of its clade has been numbered
+        stack = [(start, None, 0)]
+        open_nodes = list()
+        while stack:
+            node, parent, depth = stack.pop()
+            if node in position:
+                continue
+            while open_nodes and open_nodes[-1][1] >= depth:
+                index[open_nodes.pop()[0]][3] = len(index) - 1
+            position[node] = len(index)
+            open_nodes.append((len(index), depth))
+            index.append([node, parent, len(index), None, depth])
+            for child in reversed(children.get(node, [])):
+                if child not in position:
+                    stack.append((child, node, depth + 1))
+        for row, depth in open_nodes:
+            index[row][3] = len(index) - 1
+    return [tuple(row) for row in index]
+
+
+def build_tree_index(organism, c):
+    '''Replaces the Tree_index rows of an organism with those of its tree in Tree_edges.'''
+    c.execute("DELETE FROM Tree_index WHERE Organism = ?", (organism,))
+    c.executemany("INSERT INTO Tree_index VALUES(?,?,?,?,?,?)",
+                  [(organism,) + row for row in nested_set(tree_rows(organism, c))])
+
+
+def tree_index(organism, c):
+    '''Returns the (Node, Parent, Lft, Rgt, Depth) rows of the Tree_index of an organism, in pre-order.'''
+    c.execute("SELECT Node, Parent, Lft, Rgt, Depth FROM Tree_index WHERE Organism = ? ORDER BY Lft", (organism,))
+    return c.fetchall()
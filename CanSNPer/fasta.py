@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+'''
+fasta.py: Streams the records of fasta files, plain or gzip compressed.
+This file is part of CanSNPer.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import gzip
+
+# Characters allowed in reference sequences, and in queries, which may
+# have soft-masked bases, IUPAC ambiguity codes and gaps
+REFERENCE_BASES = "ACGTN"
+QUERY_BASES = "ACGTUNRYSWKMBDHVacgtunryswkmbdhv-"
+
+# Number of bases read before a chunk of a record is yielded
+CHUNK_SIZE = 1 << 20
+
+# Length of the sequence lines written by copy_fasta
+LINE_LENGTH = 80
+
+
+def is_compressed(file_name):
+    '''Returns True if a file is gzip (or bgzip) compressed.'''
+    sequence_file = open(file_name, "rb")
+    magic = sequence_file.read(2)
+    sequence_file.close()
+    return magic == "\x1f\x8b"  # gzip magic number
+
+
+def open_compressed(file_name):
+    '''Opens a fasta or FASTQ file, gzip (or bgzip) compressed or not.'''
+    if is_compressed(file_name):
+        return gzip.open(file_name, "rb")
+    return open(file_name, "r")
+
+
+def invalid_character(chunk, alphabet):
+    '''Returns the index of the first character of a chunk that is not in the alphabet, None if there is none.'''
+    invalid = chunk.translate(None, alphabet)
+    if not invalid:
+        return None
+    return min(chunk.index(character) for character in set(invalid))
+
+
+def fasta_chunks(file_name, alphabet=None, chunk_size=CHUNK_SIZE):
+    '''Yields the sequence of each record in a fasta file in chunks.
+
+    Keyword arguments:
+    file_name -- the fasta file, plain or gzip (or bgzip) compressed
+    alphabet -- the characters allowed in the sequences, None to allow any
+    chunk_size -- number of bases read before a chunk is yielded
+
+    Yields (record name, offset, chunk), the offset being the 0-based
+    position of the chunk in its record, so a new record starts with offset
+    0. A record without sequence yields one empty chunk. At most one chunk
+    (and one line) is kept in memory. Each chunk is checked against the
+    alphabet with one translation, and a ValueError names the record,
+    1-based position and line of the first character that is not in it.
+
+    '''
+    fasta_file = open_compressed(file_name)
+    name = None
+    offset = 0  # Of the chunk being read, in its record
+    pieces = list()
+    lines = list()  # Line number of each piece, to report bad characters
+    size = 0
+    line_number = 0
+
+    def chunk():
+        sequence = "".join(pieces)
+        if alphabet is not None:
+            position = invalid_character(sequence, alphabet)
+            if position is not None:
+                line, column = lines[0], position
+                for piece, piece_line in zip(pieces, lines):
+                    if column < len(piece):
+                        line = piece_line
+                        break
+                    column -= len(piece)
+                raise ValueError("Invalid character %r in record %s at position %i (line %i of %s)" %
+                                 (sequence[position], name, offset + position + 1, line, file_name))
+        return sequence
+
+    try:
+        for line in fasta_file:
+            line_number += 1
+            if line.startswith(">"):
+                if name is not None and (pieces or offset == 0):
+                    yield name, offset, chunk()
+                name = line[1:].strip()
+                offset = 0
+                pieces = list()
+                lines = list()
+                size = 0
+                continue
+            line = line.rstrip()
+            if not line:
+                continue
+            if name is None:
+                raise ValueError("Sequence before the first > header line (line %i of %s)" % (line_number, file_name))
+            pieces.append(line)
+            lines.append(line_number)
+            size += len(line)
+            if size >= chunk_size:
+                yield name, offset, chunk()
+                offset += size
+                pieces = list()
+                lines = list()
+                size = 0
+        if name is not None and (pieces or offset == 0):
+            yield name, offset, chunk()
+    finally:
+        fasta_file.close()
+
+
+def copy_fasta(file_name, out_name, alphabet=None):
+    '''Writes the records of a fasta file, e.g. a compressed one, to a plain fasta file.
+
+    The file is copied chunk by chunk, see fasta_chunks for the alphabet
+    and the errors raised.
+
+    '''
+    out_file = open(out_name, "w")
+    try:
+        for name, offset, chunk in fasta_chunks(file_name, alphabet):
+            if offset == 0:
+                out_file.write(">%s\n" % name)
+            for start in xrange(0, len(chunk), LINE_LENGTH):
+                out_file.write(chunk[start:start + LINE_LENGTH])
+                out_file.write("\n")
+    finally:
+        out_file.close()
+
+
+def read_fasta(file_name, alphabet=None):
+    '''Yields (name, sequence) for each record in a fasta file, plain or gzip compressed.
+
+    Only one record is held in memory at a time. See fasta_chunks for the
+    alphabet and the errors raised.
+
+    '''
+    name = None
+    pieces = list()
+    for record, offset, chunk in fasta_chunks(file_name, alphabet):
+        if offset == 0 and name is not None:
+            yield name, "".join(pieces)
+            pieces = list()
+        name = record
+        pieces.append(chunk)
+    if name is not None:
+        yield name, "".join(pieces)
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+'''
+flanks.py: Alignment-free typing by matching the flanks of each SNP.
+This file is part of CanSNPer.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+from x2fa import reverse_complement
+from sequences import sequence_strains, read_sequence, sequence_str
+
+
+class SparseSequence(dict):
+    '''The called bases of a query at the SNP positions of one reference strain.
+
+    Indexed like the aligned sequences from x2fa.py, i.e. by reference
+    position - 1, so it can be handed to multi_tree_walker and snp_lister.
+    Positions that were not found in the query read as a gap, "-".
+
+    '''
+
+    def __missing__(self, key):
+        return "-"
+
+
+class FlankIndex(object):
+    '''Index of the reference flanks of every SNP in a scheme.
+
+    For each SNP the flank_length bases on either side of it are taken from
+    the reference sequence of its strain. The left flank, and the reverse
+    complement of the right flank for the minus strand, are keys of one
+    dict, so that a single pass over the query looks up every SNP on both
+    strands at once. A hit only counts if the flank on the other side of
+    the SNP base matches as well.
+
+    '''
+
+    def __init__(self, scheme, flank_length):
+        '''
+        Keyword arguments:
+        scheme -- the compiled Scheme of the organism
+        flank_length -- number of bases matched on each side of a SNP
+
+        Reference sequences are added with add_reference.
+
+        '''
+        self.scheme = scheme
+        self.flank_length = flank_length
+        self.kmers = dict()  # flank -> list of (SNP row, strand)
+        self.other_flanks = dict()  # (SNP row, strand) -> the flank that has to follow the SNP base
+        self.strains = set()  # The strains that have a reference sequence
+        self.indexed = 0  # Number of SNPs with flanks in the index
+
+    def add_reference(self, strain, sequence):
+        '''Indexes the flanks of the SNPs placed on a reference sequence.
+
+        Keyword arguments:
+        strain -- the strain name of the reference
+        sequence -- the reference sequence
+
+        SNPs closer than flank_length to either end of the sequence can not
+        be indexed and will be reported as gaps.
+
+        '''
+        k = self.flank_length
+        sequence = sequence_str(sequence)
+        self.strains.add(strain)
+        for row, (snp, snp_strain, position, derived, ancestral) in enumerate(self.scheme.snp_rows()):
+            if snp_strain != strain or position - 1 - k < 0 or position + k > len(sequence):
+                continue
+            left = sequence[position - 1 - k:position - 1].upper()
+            right = sequence[position:position + k].upper()
+            self.kmers.setdefault(left, list()).append((row, "+"))
+            self.other_flanks[(row, "+")] = right
+            self.kmers.setdefault(reverse_complement(right), list()).append((row, "-"))
+            self.other_flanks[(row, "-")] = reverse_complement(left)
+            self.indexed += 1
+
+    def find_alleles(self, contigs):
+        '''Returns the set of bases found at each SNP, keyed by SNP row.
+
+        Keyword arguments:
+        contigs -- (name, sequence) pairs of the query
+
+        '''
+        k = self.flank_length
+        kmers = self.kmers
+        other_flanks = self.other_flanks
+        found = dict()
+        for name, sequence in contigs:
+            sequence = sequence.upper()
+            for i in xrange(len(sequence) - 2 * k):
+                hits = kmers.get(sequence[i:i + k])
+                if hits:
+                    for hit in hits:
+                        if sequence[i + k + 1:i + 2 * k + 1] == other_flanks[hit]:
+                            base = sequence[i + k]
+                            if hit[1] == "-":
+                                base = reverse_complement(base)
+                            found.setdefault(hit[0], set()).add(base)
+        return found
+
+    def type_contigs(self, contigs):
+        '''Returns the called SNP bases of a query and the number of SNPs found.
+
+        Keyword arguments:
+        contigs -- (name, sequence) pairs of the query
+
+        The bases are returned as a dict of SparseSequence, one per reference
+        strain, which takes the place of the aligned sequences. A SNP whose
+        flanks hit the query with different bases is called N.
+
+        '''
+        found = self.find_alleles(contigs)
+        alternates = dict()
+        for strain in self.strains:
+            alternates[strain] = SparseSequence()
+        for row, (snp, strain, position, derived, ancestral) in enumerate(self.scheme.snp_rows()):
+            if row in found:
+                if len(found[row]) == 1:
+                    alternates[strain][position - 1] = list(found[row])[0]
+                else:
+                    alternates[strain][position - 1] = "N"
+        return alternates, len(found)
+
+
+def load_flank_index(scheme, config, c):
+    '''Returns a FlankIndex of the SNPs of a scheme.
+
+    Keyword arguments:
+    scheme -- the compiled Scheme of the organism
+    c -- cursor of the CanSNPer database
+
+    The reference sequences are read from the database one at a time.
+
+    '''
+    flank_index = FlankIndex(scheme, config["flank_length"])
+    for strain in sequence_strains(scheme.organism, c):
+        flank_index.add_reference(strain, read_sequence(scheme.organism, strain, c))
+    if config["verbose"]:
+        print("#Indexed the flanks of %i of %i SNPs" % (flank_index.indexed, len(scheme.snp_names)))
+    return flank_index
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+'''
+matrix.py: The SNP alleles of a batch of samples, as one samples x SNPs matrix.
+This file is part of CanSNPer.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import numpy
+from numpy.lib.format import open_memmap
+
+
+class SnpColumns(object):
+    '''The SNP positions of a scheme grouped by reference strain.
+
+    The rows of the SNP table and their 0-based positions are kept per
+    strain as arrays, so the alleles of a sample are read with one fancy
+    index per reference sequence.
+
+    '''
+
+    def __init__(self, scheme):
+        '''Groups the SNPs of a compiled Scheme by strain.'''
+        self.size = len(scheme.snp_names)
+        strains = numpy.array(scheme.snp_strains, dtype=numpy.intp)
+        positions = numpy.array(scheme.snp_positions, dtype=numpy.int64) - 1
+        self.groups = list()
+        for strain_id, strain in enumerate(scheme.strain_names):
+            rows = numpy.flatnonzero(strains == strain_id)
+            self.groups.append((strain, rows, positions[rows]))
+
+    def alleles(self, sequences):
+        '''Returns the bases of a sample at every SNP, in SNP table order.
+
+        Keyword arguments:
+        sequences -- the query sequences aligned to each reference strain,
+                     keyed by strain, or the called bases of flank and reads
+                     mode
+
+        Returns an array of one byte strings. Positions past the end of an
+        aligned sequence read as a gap, "-". Raises KeyError, with the
+        strain, if a strain of the SNP table has no sequence.
+
+        '''
+        result = numpy.empty(self.size, dtype="S1")
+        for strain, rows, positions in self.groups:
+            sequence = sequences[strain]
+            if isinstance(sequence, str):
+                bases = numpy.frombuffer(sequence, dtype="S1")
+                inside = positions < len(bases)
+                result[rows] = "-"
+                result[rows[inside]] = bases[positions[inside]]
+            else:
+                result[rows] = [sequence[position] for position in positions.tolist()]
+        return result
+
+
+class AlleleMatrix(object):
+    '''Writes the alleles of a batch of samples as they are typed.
+
+    Three files are written, named by a prefix:
+    <prefix>.tsv -- one line per sample with its base at every SNP, after
+                    header lines with the SNP names, derived and ancestral
+                    bases
+    <prefix>.npy -- the same bases as a samples x SNPs array of one byte
+                    strings, row i being sample i of the batch
+    <prefix>.npz -- the index of the matrix: samples, snps, strains,
+                    positions, derived and ancestral
+
+    The .npy file is laid out at its final size up front and each sample
+    is written to its row as soon as it is typed, so nothing has to be
+    merged afterwards. Rows of samples that were not typed are empty.
+
+    '''
+
+    def __init__(self, prefix, scheme, samples):
+        '''Creates the matrix files.
+
+        Keyword arguments:
+        prefix -- the file name prefix
+        scheme -- the compiled Scheme of the organism
+        samples -- the names of the samples, in the order of the rows
+
+        '''
+        self.columns = SnpColumns(scheme)
+        self.rows = dict((sample, row) for row, sample in enumerate(samples))
+        numpy.savez(prefix + ".npz", samples=numpy.array(samples), snps=numpy.array(scheme.snp_names),
+                    strains=numpy.array([scheme.strain_names[strain] for strain in scheme.snp_strains]),
+                    positions=numpy.array(scheme.snp_positions, dtype=numpy.int64),
+                    derived=numpy.array(scheme.snp_derived), ancestral=numpy.array(scheme.snp_ancestral))
+        self.matrix = open_memmap(prefix + ".npy", mode="w+", dtype="S1", shape=(len(samples), self.columns.size))
+        self.tsv = open(prefix + ".tsv", "w")
+        self.tsv.write("#Sample\t%s\n" % "\t".join(scheme.snp_names))
+        self.tsv.write("#Derived\t%s\n" % "\t".join(scheme.snp_derived))
+        self.tsv.write("#Ancestral\t%s\n" % "\t".join(scheme.snp_ancestral))
+
+    def add(self, sample, alleles):
+        '''Writes the alleles of a sample, as returned by SnpColumns.alleles.'''
+        self.matrix[self.rows[sample]] = alleles
+        self.tsv.write("%s\t%s\n" % (sample, "\t".join(alleles.tolist())))
+        self.tsv.flush()
+
+    def close(self):
+        self.matrix.flush()
+        del self.matrix
+        self.tsv.close()
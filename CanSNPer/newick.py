@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+'''
+newick.py: Writing and reading canSNP trees in newick format.
+This file is part of CanSNPer.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Characters that end an unquoted node name
+DELIMITERS = "(),:;[ \t\r\n"
+CHUNK_SIZE = 65536
+
+
+def quote_name(name):
+    '''Returns a node name as written in newick, quoted with ' if it holds DELIMITERS or quotes.'''
+    if name and not any(char in DELIMITERS or char == "'" for char in name):
+        return name
+    return "'%s'" % name.replace("'", "''")
+
+
+def write_newick(root, children):
+    '''Returns a tree in newick format and the set of nodes that are in it.
+
+    Keyword arguments:
+    root -- the name of the root
+    children -- dict of the list of child names of each node, nodes without
+                children can be left out
+
+    Every node is written once, in a single pass with a stack instead of
+    recursion, so deep trees are fine. A node listed as the child of more
+    than one node is only written under the first of them. Internal nodes
+    are written as (child,child)name and the tree ends with ; Names that
+    read_newick would split or skip are quoted, see quote_name.
+
+    '''
+    pieces = list()
+    written = set([root])
+    stack = [(False, root)]  # (is text, node name or text)
+    while stack:
+        is_text, value = stack.pop()
+        if is_text:
+            pieces.append(value)
+            continue
+        node_children = [child for child in children.get(value, []) if child not in written]
+        if not node_children:
+            pieces.append(quote_name(value))
+            continue
+        written.update(node_children)
+        pieces.append("(")
+        stack.append((True, ")" + quote_name(value)))
+        for i in range(len(node_children) - 1, -1, -1):
+            stack.append((False, node_children[i]))
+            if i:
+                stack.append((True, ","))
+    pieces.append(";")
+    return "".join(pieces), written
+
+
+def newick_tokens(newick_file):
+    '''Yields the tokens of a newick file, reading it a chunk at a time.
+
+    Keyword arguments:
+    newick_file -- an open newick file
+
+    Tokens are ("(", offset), (")", offset), (",", offset), (";", offset)
+    and ("name", offset, name), offset being the character offset in the
+    file. Branch lengths, [comments] and white space are skipped. Names can
+    be quoted with ', a quote inside a quoted name is written twice.
+
+    '''
+    offset = 0
+    name = None  # The unquoted name or quoted name being read
+    name_start = 0
+    quoted = False
+    after_quote = False  # A quote was just read inside a quoted name
+    skipping = None  # ":" while in a branch length, "[" while in a comment
+    chunk = newick_file.read(CHUNK_SIZE)
+    while chunk:
+        for char in chunk:
+            if quoted:
+                if after_quote:
+                    after_quote = False
+                    if char == "'":  # An escaped quote
+                        name.append("'")
+                        offset += 1
+                        continue
+                    quoted = False  # The closing quote, char is handled below
+                elif char == "'":
+                    after_quote = True
+                    offset += 1
+                    continue
+                else:
+                    name.append(char)
+                    offset += 1
+                    continue
+            if skipping == "[":
+                if char == "]":
+                    skipping = None
+                offset += 1
+                continue
+            if skipping == ":" and char not in DELIMITERS:
+                offset += 1
+                continue
+            skipping = None
+            if char in DELIMITERS:
+                if name is not None:
+                    yield "name", name_start, "".join(name)
+                    name = None
+                if char in "(),;":
+                    yield char, offset
+                elif char in ":[":
+                    skipping = char
+            elif char == "'" and name is None:
+                name = list()
+                name_start = offset
+                quoted = True
+            else:
+                if name is None:
+                    name = list()
+                    name_start = offset
+                name.append(char)
+            offset += 1
+        chunk = newick_file.read(CHUNK_SIZE)
+    if quoted:
+        if not after_quote:
+            raise ValueError("Unterminated quoted name starting at character %i" % name_start)
+    if name is not None:
+        yield "name", name_start, "".join(name)
+
+
+def read_newick(newick_file):
+    '''Returns the (Name, Children) rows of a tree in newick format.
+
+    Keyword arguments:
+    newick_file -- an open newick file
+
+    The file is read a chunk at a time and parsed in one pass. Rows are
+    returned with the root first and every node before its children, the
+    same order as a tree text file gives, Children being a ;-joined string
+    or None. Only the first tree of the file is read. Raises ValueError,
+    with the character offset, for malformed trees and unnamed nodes.
+
+    '''
+    names = list()  # Node names, indexed by node id, None until named
+    children = list()  # Child ids of each node
+    name_offsets = list()  # Where each node was closed, for error messages
+    open_nodes = list()  # Child ids of the internal nodes that are still open
+    last = None  # The id of the node just read, until a , or ) places it
+    root = None
+    for token in newick_tokens(newick_file):
+        kind, offset = token[0], token[1]
+        if kind == "(":
+            if last is not None:
+                raise ValueError("Missing , before ( at character %i" % offset)
+            open_nodes.append(list())
+        elif kind == "name":
+            if last is not None and names[last] is None and children[last]:
+                names[last] = token[2]  # The name of an internal node follows its )
+            elif last is None:
+                last = len(names)
+                names.append(token[2])
+                children.append(list())
+                name_offsets.append(offset)
+            else:
+                raise ValueError("Unexpected name %s at character %i" % (token[2], offset))
+        elif kind in ",)":
+            if not open_nodes:
+                raise ValueError("Unexpected %s at character %i" % (kind, offset))
+            if last is None:
+                raise ValueError("Empty node before character %i" % offset)
+            open_nodes[-1].append(last)
+            last = None
+            if kind == ")":
+                last = len(names)
+                names.append(None)
+                children.append(open_nodes.pop())
+                name_offsets.append(offset)
+        elif kind == ";":
+            if open_nodes:
+                raise ValueError("Unbalanced parentheses, %i ( not closed at character %i" % (len(open_nodes), offset))
+            root = last
+            break
+    if root is None:
+        raise ValueError("No tree found, a newick tree ends with ;")
+    for node in range(len(names)):
+        if names[node] is None:
+            raise ValueError("Unnamed node closed at character %i, every node of a canSNP tree needs a name" %
+                             name_offsets[node])
+
+    # Root first, each node before its children
+    rows = list()
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        rows.append((names[node], ";".join(names[child] for child in children[node]) or None))
+        stack.extend(reversed(children[node]))
+    return rows
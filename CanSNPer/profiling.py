@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+'''
+profiling.py: Time, CPU and memory use of each stage of typing a sample.
+This file is part of CanSNPer.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import resource
+import time
+from contextlib import contextmanager
+
+
+def cpu_time(usage):
+    '''Returns the user plus system CPU seconds of a resource.getrusage result.'''
+    return usage.ru_utime + usage.ru_stime
+
+
+class SampleProfile(object):
+    '''The measurements made while typing one sample, for --profile.
+
+    Each stage adds up its wall time, the CPU time of the CanSNPer process
+    and how far it raised the peak RSS of the process, in kB. The peak RSS
+    is that of the whole run so far, so a stage that stays below an earlier
+    peak raises it by 0; the peak itself is recorded once per sample.
+    Child processes, i.e. the aligner jobs, are recorded with
+    their own wall time, CPU time and peak RSS from os.wait4. Database
+    queries are counted by a CountingCursor.
+
+    '''
+
+    def __init__(self, sample):
+        '''Starts the profile of a sample, None for the work shared by all the samples.'''
+        self.sample = sample
+        self.stages = dict()
+        self.children = list()
+        self.queries = 0
+        self.walker_visits = 0
+        self.start_wall = time.time()
+        self.start_cpu = cpu_time(resource.getrusage(resource.RUSAGE_SELF))
+
+    @contextmanager
+    def stage(self, name):
+        '''Context manager that measures a stage, a stage can be entered more than once.'''
+        wall = time.time()
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        cpu = cpu_time(usage)
+        peak_rss = usage.ru_maxrss
+        try:
+            yield
+        finally:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            stage = self.stages.setdefault(name, {"wall": 0.0, "cpu": 0.0, "peak_rss_growth_kb": 0})
+            stage["wall"] += time.time() - wall
+            stage["cpu"] += cpu_time(usage) - cpu
+            stage["peak_rss_growth_kb"] += usage.ru_maxrss - peak_rss
+
+    def child(self, name, wall, usage):
+        '''Records a child process that has exited.
+
+        Keyword arguments:
+        name -- what the process did
+        wall -- the wall time it ran for
+        usage -- its resource usage, as returned by os.wait4
+
+        '''
+        self.children.append({"name": name, "wall": wall, "cpu": cpu_time(usage), "peak_rss_kb": usage.ru_maxrss})
+
+    def record(self, **fields):
+        '''Returns the profile as a dict for json, with any other fields given.'''
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        record = {"sample": self.sample,
+                  "wall": time.time() - self.start_wall,
+                  "cpu": cpu_time(usage) - self.start_cpu,
+                  "peak_rss_kb": usage.ru_maxrss,
+                  "stages": self.stages,
+                  "children": self.children,
+                  "db_queries": self.queries,
+                  "walker_visits": self.walker_visits}
+        record.update(fields)
+        return record
+
+
+class CountingCursor(object):
+    '''A database cursor that counts the queries run through it for a SampleProfile.'''
+
+    def __init__(self, cursor, profile):
+        self._cursor = cursor
+        self._profile = profile
+
+    def execute(self, *args):
+        self._profile.queries += 1
+        return self._cursor.execute(*args)
+
+    def executemany(self, *args):
+        self._profile.queries += 1
+        return self._cursor.executemany(*args)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    @property
+    def connection(self):
+        '''The connection, wrapped so that the cursors opened from it, e.g. by stream_sequence, count too.'''
+        return CountingConnection(self._cursor.connection, self._profile)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class CountingConnection(object):
+    '''The connection of a CountingCursor, whose new cursors count their queries for the same SampleProfile.'''
+
+    def __init__(self, connection, profile):
+        self._connection = connection
+        self._profile = profile
+
+    def cursor(self, *args):
+        return CountingCursor(self._connection.cursor(*args), self._profile)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+@contextmanager
+def no_profile():
+    yield
+
+
+def profile_stage(config, name):
+    '''Returns a context manager measuring a stage of the sample in config, if it is profiled.'''
+    profile = config.get("sample_profile")
+    if profile is None:
+        return no_profile()
+    return profile.stage(name)
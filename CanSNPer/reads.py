@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+'''
+reads.py: Typing straight from sequencing reads by counting SNP k-mers.
+This file is part of CanSNPer.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+from array import array
+
+from x2fa import reverse_complement
+from sequences import sequence_strains, read_sequence, sequence_str
+from flanks import SparseSequence
+from fasta import open_compressed
+
+# Allele indexes used in the k-mer index and the depth arrays
+ANCESTRAL = 0
+DERIVED = 1
+
+
+def read_fastq(file_name):
+    '''Yields the sequence of each read in a FASTQ file, one read at a time.'''
+    reads_file = open_compressed(file_name)
+    line_number = 0
+    for line in reads_file:
+        if line_number % 4 == 1:  # Header, sequence, + and quality lines
+            yield line.rstrip()
+        line_number += 1
+    reads_file.close()
+
+
+class ReadIndex(object):
+    '''Index of the ancestral and derived k-mers of every SNP in a scheme.
+
+    Every k-mer that covers a SNP is indexed twice, once with the ancestral
+    and once with the derived base at the SNP, on both strands. A k-mer
+    that would count towards more than one SNP or allele is left out.
+
+    Reads are checked at every step:th position and at their last position.
+    Any k consecutive positions include a checked one when the step is at
+    most k, so a read that covers a SNP with a full k-mer is always looked
+    up, and a step of half a k-mer gives reads with a sequencing error in
+    one checked k-mer a second chance. Each read counts at most once
+    towards each allele of each SNP.
+
+    '''
+
+    def __init__(self, scheme, kmer_length):
+        '''
+        Keyword arguments:
+        scheme -- the compiled Scheme of the organism
+        kmer_length -- the length of the indexed k-mers
+
+        Reference sequences are added with add_reference.
+
+        '''
+        self.scheme = scheme
+        self.kmer_length = kmer_length
+        self.step = max(1, kmer_length // 2)
+        self.kmers = dict()  # k-mer -> (SNP row, allele), None if ambiguous
+        self.strains = set()  # The strains that have a reference sequence
+
+    def _add_kmer(self, kmer, value):
+        '''Adds a k-mer to the index, marking it ambiguous if it is already taken.'''
+        if self.kmers.get(kmer, value) != value:
+            self.kmers[kmer] = None
+        else:
+            self.kmers[kmer] = value
+
+    def add_reference(self, strain, sequence):
+        '''Indexes the k-mers of the SNPs placed on a reference sequence.
+
+        Keyword arguments:
+        strain -- the strain name of the reference
+        sequence -- the reference sequence
+
+        '''
+        k = self.kmer_length
+        sequence = sequence_str(sequence).upper()
+        self.strains.add(strain)
+        for row, (snp, snp_strain, position, derived, ancestral) in enumerate(self.scheme.snp_rows()):
+            if snp_strain != strain:
+                continue
+            for allele, base in ((ANCESTRAL, str(ancestral).upper()), (DERIVED, str(derived).upper())):
+                for offset in range(k):  # The position of the SNP within the k-mer
+                    start = position - 1 - offset
+                    if start < 0 or start + k > len(sequence):
+                        continue
+                    kmer = sequence[start:position - 1] + base + sequence[position:start + k]
+                    self._add_kmer(kmer, (row, allele))
+                    self._add_kmer(reverse_complement(kmer), (row, allele))
+
+    def count_reads(self, reads):
+        '''Returns the ancestral and derived read depth of every SNP and the number of reads.
+
+        Keyword arguments:
+        reads -- an iterable of read sequences, read once
+
+        The depths are arrays indexed by SNP row, so memory does not grow
+        with the number of reads.
+
+        '''
+        k = self.kmer_length
+        step = self.step
+        kmers = self.kmers
+        depth = (array("l", [0] * len(self.scheme.snp_names)),
+                 array("l", [0] * len(self.scheme.snp_names)))
+        read_count = 0
+        for read in reads:
+            read_count += 1
+            read = read.upper()
+            last = len(read) - k
+            if last < 0:
+                continue
+            hits = None
+            for i in range(0, last, step) + [last]:
+                hit = kmers.get(read[i:i + k])
+                if hit:
+                    if hits is None:
+                        hits = set()
+                    hits.add(hit)
+            if hits:
+                for row, allele in hits:
+                    depth[allele][row] += 1
+        return depth, read_count
+
+    def type_reads(self, reads, min_depth):
+        '''Returns the called SNP bases of a set of reads and the number of SNPs called.
+
+        Keyword arguments:
+        reads -- an iterable of read sequences, read once
+        min_depth -- the number of reads an allele needs to be called
+
+        The allele with the most reads is called if it has at least min_depth
+        reads, SNPs with too few reads are reported as gaps and ties as N. The
+        bases are returned as a dict of SparseSequence, one per reference
+        strain, which takes the place of the aligned sequences.
+
+        '''
+        depth, read_count = self.count_reads(reads)
+        alternates = dict()
+        for strain in self.strains:
+            alternates[strain] = SparseSequence()
+        called = 0
+        for row, (snp, strain, position, derived, ancestral) in enumerate(self.scheme.snp_rows()):
+            ancestral_depth = depth[ANCESTRAL][row]
+            derived_depth = depth[DERIVED][row]
+            if max(ancestral_depth, derived_depth) < min_depth or strain not in alternates:
+                continue
+            called += 1
+            if derived_depth > ancestral_depth:
+                alternates[strain][position - 1] = derived
+            elif ancestral_depth > derived_depth:
+                alternates[strain][position - 1] = ancestral
+            else:
+                alternates[strain][position - 1] = "N"
+        return alternates, called, read_count
+
+
+def load_read_index(scheme, config, c):
+    '''Returns a ReadIndex of the SNPs of a scheme.
+
+    Keyword arguments:
+    scheme -- the compiled Scheme of the organism
+    c -- cursor of the CanSNPer database
+
+    The reference sequences are read from the database one at a time.
+
+    '''
+    read_index = ReadIndex(scheme, config["kmer_length"])
+    for strain in sequence_strains(scheme.organism, c):
+        read_index.add_reference(strain, read_sequence(scheme.organism, strain, c))
+    if config["verbose"]:
+        print("#Indexed %i SNP k-mers" % len(read_index.kmers))
+    return read_index
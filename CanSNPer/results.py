@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+'''
+results.py: A cache of typing results, kept in the CanSNPer database.
+This file is part of CanSNPer.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import hashlib
+import re
+import sqlite3
+from os import stat
+
+from fasta import read_fasta
+from sequences import sequence_strains, stream_sequence
+
+# Options that change the result of typing a query, per mode
+RESULT_OPTIONS = {"align": ("allow_differences", "aligner", "snp_window"),
+                  "flank": ("allow_differences", "flank_length"),
+                  "reads": ("allow_differences", "kmer_length", "min_depth")}
+
+# The places in a warning template where the query and the sample are named
+WARNING_FIELD = re.compile(r"\{(query|name)\}")
+
+# Bytes hashed at the start and at the end of a reads file, see query_hash
+READS_SAMPLE = 1 << 20
+
+
+def scheme_version(scheme, c):
+    '''Returns a hash of the tree, SNPs and reference sequences of an organism.
+
+    Keyword arguments:
+    scheme -- the compiled Scheme of the organism
+    c -- cursor of the CanSNPer database
+
+    The hash changes with any change to the tree, SNPs or reference
+    sequences that the typing of a query depends on.
+
+    '''
+    version = hashlib.sha1()
+    for node in range(len(scheme.node_names)):
+        version.update(("%s\t%s\n" % (scheme.node_names[node], ";".join(scheme.children(scheme.node_names[node])))).encode("utf8"))
+    for row in scheme.snp_rows():
+        version.update(("%s\t%s\t%s\t%s\t%s\n" % row).encode("utf8"))
+    for strain in sorted(sequence_strains(scheme.organism, c)):
+        version.update(("%s\t" % strain).encode("utf8"))
+        for block in stream_sequence(scheme.organism, strain, c):
+            version.update(block)
+        version.update("\n")
+    return version.hexdigest()
+
+
+def query_hash(file_name, mode):
+    '''Returns a hash of the sequences of a query.
+
+    Keyword arguments:
+    file_name -- the fasta file of the query, in reads mode the FASTQ files
+                 joined by commas
+    mode -- the typing mode
+
+    Fasta files are hashed by their sequences only, so the same assembly
+    under another file name, compressed or not, with other record names or
+    another line length hashes the same. Reads files are too large to be
+    read an extra time, so each is hashed by its size and its first and
+    last READS_SAMPLE bytes, which also hash the same under another name
+    or in another folder.
+
+    '''
+    query = hashlib.sha1()
+    if mode == "reads":
+        for reads_file_name in file_name.split(","):
+            status = stat(reads_file_name)
+            query.update("%i\n" % status.st_size)
+            reads_file = open(reads_file_name, "rb")
+            query.update(reads_file.read(READS_SAMPLE))
+            if status.st_size > READS_SAMPLE:
+                reads_file.seek(max(READS_SAMPLE, status.st_size - READS_SAMPLE))
+                query.update(reads_file.read(READS_SAMPLE))
+            reads_file.close()
+            query.update("\n")
+    else:
+        for name, sequence in read_fasta(file_name):
+            query.update(sequence.upper())
+            query.update("\n")
+    return query.hexdigest()
+
+
+def result_options(config):
+    '''Returns the typing options that a cached result is only valid for.'''
+    return ";".join(["mode=%s" % config["mode"]] +
+                    ["%s=%s" % (option, config[option]) for option in RESULT_OPTIONS[config["mode"]]])
+
+
+def create_results_table(c):
+    '''Creates the Results table, if it is not already in the database.'''
+    c.execute("CREATE TABLE IF NOT EXISTS Results (Query_hash text, Organism text, Scheme_version text, " +
+              "Options text, Classification text, Forced_SNPs text, Warning text)")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS Results_key ON Results " +
+              "(Query_hash, Organism, Scheme_version, Options)")
+
+
+def load_result(key, c):
+    '''Returns the cached result of a query, or None.
+
+    Keyword arguments:
+    key -- (query hash, organism, scheme version, options)
+    c -- cursor of the CanSNPer database
+
+    The result is (classification, list of forced SNPs, alignment warning),
+    the warning is None or a template for fill_warning.
+
+    '''
+    try:
+        c.execute("SELECT Classification, Forced_SNPs, Warning FROM Results WHERE Query_hash = ? AND " +
+                  "Organism = ? AND Scheme_version = ? AND Options = ?", key)
+    except sqlite3.OperationalError:  # No Results table yet
+        return None
+    row = c.fetchone()
+    if row is None:
+        return None
+    classification, forced_snps, warning = row
+    return classification, forced_snps.split(";") if forced_snps else [], warning
+
+
+def save_result(key, classification, forced_snps, warning, c):
+    '''Stores the result of a query and drops the results of older scheme versions.
+
+    Keyword arguments:
+    key -- (query hash, organism, scheme version, options)
+    classification -- the node the query was classified as
+    forced_snps -- the SNPs that were not in the derived state
+    warning -- the alignment warning template, see fill_warning, or None
+    c -- cursor of the CanSNPer database
+
+    The result is committed right away, as several processes may be typing
+    samples against the same database.
+
+    '''
+    create_results_table(c)
+    c.execute("DELETE FROM Results WHERE Organism = ? AND Scheme_version != ?", (key[1], key[2]))
+    c.execute("INSERT OR REPLACE INTO Results VALUES (?,?,?,?,?,?,?)",
+              tuple(key) + (classification, ";".join(forced_snps), warning))
+    c.connection.commit()
+
+
+def fill_warning(template, query, name):
+    '''Returns a warning template written out for a query.
+
+    Keyword arguments:
+    template -- the warning with {query} where it names the query and
+                {name} where it names the sample file
+    query -- the query as given
+    name -- the file name of the sample
+
+    The fields are filled in one pass, so the template is cached as the
+    warning was built, and names that turn up elsewhere in the warning, or
+    that hold braces themselves, are left as they are.
+
+    '''
+    fields = {"query": query, "name": name}
+    return WARNING_FIELD.sub(lambda field: fields[field.group(1)], template)
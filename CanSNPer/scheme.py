@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+'''
+scheme.py: The canSNP scheme of an organism, compiled for the tree walker.
+This file is part of CanSNPer.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+from array import array
+from sys import exit
+
+from database import tree_rows, tree_index, nested_set
+
+
+class Scheme(object):
+    '''The tree and SNP table of an organism, read from the database once.
+
+    Tree nodes are numbered in the order they are listed in the tree rows,
+    children that are never listed themselves are numbered after those.
+    The children of node i are child_ids[child_offsets[i]:child_offsets[i + 1]]
+    in the order they were imported.
+
+    The parent, depth and nested set interval of node i are node_parents[i]
+    (-1 for roots), node_depths[i], node_left[i] and node_right[i], as in
+    the Tree_index table (see database.nested_set), so the lineage of a
+    node takes one step per level and clade membership one comparison.
+
+    The SNP table is kept in table order in snp_names, snp_strains (an
+    index into strain_names), snp_positions, snp_derived and snp_ancestral.
+    If a SNP is listed more than once the first row is the one used by the
+    walker, as with the SELECT it replaces.
+
+    '''
+
+    def __init__(self, organism, tree_rows, snp_rows, index_rows=None):
+        '''Compiles a scheme.
+
+        Keyword arguments:
+        organism -- the name of the organism
+        tree_rows -- (Name, Children) rows of the tree of the organism, as
+                     returned by database.tree_rows
+        snp_rows -- (SNP, Strain, Position, Derived_base, Ancestral_base) rows
+                    of the SNPs of the organism
+        index_rows -- (Node, Parent, Lft, Rgt, Depth) rows of the Tree_index
+                      of the organism, computed from tree_rows if left out
+                      or if they do not cover the tree
+
+        '''
+        self.organism = organism
+
+        # Tree
+        self.node_names = list()
+        self.node_ids = dict()
+        node_children = dict()
+        for name, children in tree_rows:
+            node_id = self._add_node(name)
+            if node_id not in node_children:  # The first row of a node counts
+                node_children[node_id] = children.split(";") if children else []
+        child_lists = list()
+        for node_id in range(len(self.node_names)):
+            child_lists.append([self._add_node(child) for child in node_children.get(node_id, [])])
+        self.child_offsets = array("i", [0])
+        self.child_ids = array("i")
+        for child_list in child_lists:
+            self.child_ids.extend(child_list)
+            self.child_offsets.append(len(self.child_ids))
+        while len(self.child_offsets) <= len(self.node_names):
+            # Nodes only seen as children, they have no children of their own
+            self.child_offsets.append(len(self.child_ids))
+
+        # The root is the first listed node that is not a child anywhere in the tree
+        self.root = None
+        is_child = set(self.child_ids)
+        for name, children in tree_rows:
+            if self.node_ids[name] not in is_child:
+                self.root = name
+                break
+
+        # Tree index
+        if index_rows is None or set(row[0] for row in index_rows) != set(self.node_ids):
+            index_rows = nested_set(tree_rows)
+        self.node_parents = array("i", [-1] * len(self.node_names))
+        self.node_left = array("i", [0] * len(self.node_names))
+        self.node_right = array("i", [0] * len(self.node_names))
+        self.node_depths = array("i", [0] * len(self.node_names))
+        for name, parent, left, right, depth in index_rows:
+            node_id = self.node_ids[name]
+            if parent is not None:
+                self.node_parents[node_id] = self.node_ids[parent]
+            self.node_left[node_id] = left
+            self.node_right[node_id] = right
+            self.node_depths[node_id] = depth
+
+        # SNPs
+        self.strain_names = list()
+        strain_ids = dict()
+        self.snp_names = list()
+        self.snp_strains = array("i")
+        self.snp_positions = array("l")
+        self.snp_derived = list()
+        self.snp_ancestral = list()
+        self.snp_index = dict()
+        for snp, strain, position, derived, ancestral in snp_rows:
+            if strain not in strain_ids:
+                strain_ids[strain] = len(self.strain_names)
+                self.strain_names.append(strain)
+            if snp not in self.snp_index:
+                self.snp_index[snp] = len(self.snp_names)
+            self.snp_names.append(snp)
+            self.snp_strains.append(strain_ids[strain])
+            self.snp_positions.append(position)
+            self.snp_derived.append(derived)
+            self.snp_ancestral.append(ancestral)
+
+        # Number of calls to snp(), the walker visits one node per call
+        self.visits = 0
+
+        # Hash of the rows the scheme was compiled from, see results.scheme_version
+        self.version = None
+
+    def _add_node(self, name):
+        '''Returns the id of a node name, numbering it if it is new.'''
+        try:
+            return self.node_ids[name]
+        except KeyError:
+            self.node_ids[name] = len(self.node_names)
+            self.node_names.append(name)
+            return self.node_ids[name]
+
+    def children(self, node):
+        '''Returns the names of the children of a node, an empty list for leaves.'''
+        node_id = self.node_ids.get(node)
+        if node_id is None:
+            return []
+        return [self.node_names[child_id] for child_id in
+                self.child_ids[self.child_offsets[node_id]:self.child_offsets[node_id + 1]]]
+
+    def lineage(self, node):
+        '''Returns the names of the nodes from the root down to a node, the node included.'''
+        node_id = self.node_ids.get(node)
+        if node_id is None:
+            return [node]
+        path = list()
+        while node_id != -1:
+            path.append(self.node_names[node_id])
+            node_id = self.node_parents[node_id]
+        path.reverse()
+        return path
+
+    def in_clade(self, node, clade):
+        '''Returns True if node is clade or one of its descendants.'''
+        node_id = self.node_ids.get(node)
+        clade_id = self.node_ids.get(clade)
+        if node_id is None or clade_id is None:
+            return False
+        return self.node_left[clade_id] <= self.node_left[node_id] <= self.node_right[clade_id]
+
+    def clade_counts(self, nodes):
+        '''Returns the number of nodes, of a list of classifications, at and under each node.
+
+        Keyword arguments:
+        nodes -- the node names, a node can be listed any number of times
+
+        Returns a list of (node, count at the node, count in its clade) in
+        pre-order. Names that are not in the tree are not counted.
+
+        '''
+        at_left = [0] * (len(self.node_names) + 1)
+        for node in nodes:
+            node_id = self.node_ids.get(node)
+            if node_id is not None:
+                at_left[self.node_left[node_id] + 1] += 1
+        prefix = list(at_left)  # prefix[i + 1] counts the nodes numbered up to i
+        for i in range(1, len(prefix)):
+            prefix[i] += prefix[i - 1]
+        counts = list()
+        for node_id in sorted(range(len(self.node_names)), key=lambda node_id: self.node_left[node_id]):
+            left, right = self.node_left[node_id], self.node_right[node_id]
+            counts.append((self.node_names[node_id], at_left[left + 1], prefix[right + 1] - prefix[left]))
+        return counts
+
+    def snp(self, node):
+        '''Returns (strain, position, derived base) of the SNP of a node, or None.'''
+        self.visits += 1
+        row = self.snp_index.get(node)
+        if row is None:
+            return None
+        return self.strain_names[self.snp_strains[row]], self.snp_positions[row], self.snp_derived[row]
+
+    def snp_rows(self):
+        '''Yields (SNP, strain, position, derived base, ancestral base) in table order.'''
+        for row in range(len(self.snp_names)):
+            yield (self.snp_names[row], self.strain_names[self.snp_strains[row]],
+                   self.snp_positions[row], self.snp_derived[row], self.snp_ancestral[row])
+
+
+def load_scheme(organism, config, c):
+    '''Returns the compiled Scheme of an organism.
+
+    Keyword arguments:
+    organism -- the name of the organism
+    c -- cursor of the CanSNPer database
+
+    Exits if the tree has no root, i.e. every node is listed as a child.
+
+    '''
+    tree = tree_rows(organism, c)
+    c.execute("SELECT SNP, Strain, Position, Derived_base, Ancestral_base FROM SNPs WHERE Organism = ? " +
+              "ORDER BY rowid", (organism,))
+    snps = c.fetchall()
+    scheme = Scheme(organism, tree, snps, tree_index(organism, c))
+    if config["dev"]:  # Developer printout
+        print("#[DEV] root %s tree: %s" % (organism, scheme.root))
+    if not scheme.root:
+        exit("#[ERROR in %s] Could not find root of %s tree" % (config["query"], organism))
+    return scheme
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+'''
+sequences.py: Block-compressed storage of the reference sequences.
+This file is part of CanSNPer.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import zlib
+import sqlite3
+
+# Number of bases in each compressed block, the last block of a sequence is shorter
+BLOCK_SIZE = 65536
+
+
+def create_sequence_tables(c):
+    '''Creates the Sequence_blocks table and its index, if they are not in the database.
+
+    The Sequences table lists the strains that have a reference sequence,
+    the sequence itself is kept in Sequence_blocks, one zlib compressed
+    block of BLOCK_SIZE bases per row. The index on organism, strain and
+    block number is the block index used for random access.
+
+    '''
+    c.execute("CREATE TABLE IF NOT EXISTS Sequence_blocks (Organism text, Strain text, Block integer, Data blob)")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS Sequence_blocks_index ON Sequence_blocks (Organism, Strain, Block)")
+
+
+def sequence_str(sequence):
+    '''Returns a sequence as a byte string.
+
+    Sequences stored as text, by databases from before schema version 1,
+    come out of SQLite as unicode, while the blocks decompress to byte
+    strings. The compressed blocks and the flank and k-mer indexes are
+    made of byte strings, so whatever a sequence comes from, it is made one
+    here before it is used.
+
+    '''
+    return str(sequence)
+
+
+def migrate_sequences(c):
+    '''Moves sequences stored as text in the Sequences table into Sequence_blocks.
+
+    Keyword arguments:
+    c -- cursor of the CanSNPer database
+
+    Databases made by earlier versions of CanSNPer keep the whole sequence
+    in the Sequence column. Each such sequence is compressed into blocks
+    and its Sequence column set to NULL, one strain at a time, so the
+    database is migrated in place, and migrate_database then vacuums the
+    file to give back the space. The column itself is dropped by the
+    migration to schema version 5. Returns the number of sequences moved.
+
+    '''
+    try:
+        c.execute("SELECT rowid, Organism, Strain FROM Sequences WHERE Sequence IS NOT NULL")
+    except sqlite3.OperationalError:  # No Sequences table, nothing to migrate
+        return 0
+    rows = c.fetchall()
+    if not rows:
+        return 0
+    create_sequence_tables(c)
+    for rowid, organism, strain in rows:
+        c.execute("SELECT Sequence FROM Sequences WHERE rowid = ?", (rowid,))
+        store_sequence(organism, strain, c.fetchone()[0], c)
+        c.execute("UPDATE Sequences SET Sequence = NULL WHERE rowid = ?", (rowid,))
+    return len(rows)
+
+
+def store_sequence(organism, strain, sequence, c):
+    '''Stores the sequence of a strain in compressed blocks, replacing any earlier one.
+
+    Keyword arguments:
+    organism -- the organism of the strain
+    strain -- the strain name
+    sequence -- the reference sequence, or an iterable of its pieces in
+                order, e.g. the chunks of a fasta file being read
+
+    Pieces are stored as they come, so only one block of a sequence read
+    in pieces is held in memory at a time.
+
+    '''
+    create_sequence_tables(c)
+    if isinstance(sequence, basestring):
+        sequence = [sequence_str(sequence)]
+    c.execute("DELETE FROM Sequence_blocks WHERE Organism = ? AND Strain = ?", (organism, strain))
+    c.executemany("INSERT INTO Sequence_blocks VALUES(?,?,?,?)",
+                  ((organism, strain, number, sqlite3.Binary(zlib.compress(block)))
+                   for number, block in enumerate(sequence_blocks(sequence))))
+
+
+def sequence_blocks(pieces):
+    '''Yields the blocks of BLOCK_SIZE bases of a sequence given in pieces of any size.'''
+    rest = ""  # The bases of the last piece that did not fill a block
+    for piece in pieces:
+        if rest:
+            piece = rest + piece
+        start = 0
+        while len(piece) - start >= BLOCK_SIZE:
+            yield piece[start:start + BLOCK_SIZE]
+            start += BLOCK_SIZE
+        rest = piece[start:]
+    if rest:
+        yield rest
+
+
+def delete_sequences(organism, c):
+    '''Removes the sequence blocks of every strain of an organism.'''
+    try:
+        c.execute("DELETE FROM Sequence_blocks WHERE Organism = ?", (organism,))
+    except sqlite3.OperationalError:  # No sequences have been stored in blocks
+        pass
+
+
+def sequence_strains(organism, c):
+    '''Returns the strains of an organism that have a reference sequence, in table order.'''
+    c.execute("SELECT Strain FROM Sequences WHERE Organism = ?", (organism,))
+    return [row[0] for row in c.fetchall()]
+
+
+def stream_sequence(organism, strain, c):
+    '''Yields the sequence of a strain one block at a time.
+
+    Keyword arguments:
+    organism -- the organism of the strain
+    strain -- the strain name
+    c -- cursor of the CanSNPer database
+
+    Only one block is decompressed at a time. The blocks are read through
+    a cursor of their own, so c can be used while the sequence is read.
+
+    '''
+    blocks = c.connection.cursor()
+    blocks.execute("SELECT Data FROM Sequence_blocks WHERE Organism = ? AND Strain = ? ORDER BY Block",
+                   (organism, strain))
+    row = blocks.fetchone()
+    while row:
+        yield zlib.decompress(str(row[0]))
+        row = blocks.fetchone()
+    blocks.close()
+
+
+def read_sequence(organism, strain, c):
+    '''Returns the whole sequence of a strain.'''
+    return "".join(stream_sequence(organism, strain, c))
+
+
+def read_region(organism, strain, start, end, c):
+    '''Returns the bases at positions start to end of the sequence of a strain.
+
+    Keyword arguments:
+    organism -- the organism of the strain
+    strain -- the strain name
+    start -- the first position, 1-based
+    end -- the last position, included
+    c -- cursor of the CanSNPer database
+
+    Only the blocks that cover the region are read and decompressed. The
+    region is cut short at the end of the sequence.
+
+    '''
+    first_block = (start - 1) // BLOCK_SIZE
+    last_block = (end - 1) // BLOCK_SIZE
+    c.execute("SELECT Data FROM Sequence_blocks WHERE Organism = ? AND Strain = ? AND Block BETWEEN ? AND ? " +
+              "ORDER BY Block", (organism, strain, first_block, last_block))
+    bases = "".join(zlib.decompress(str(row[0])) for row in c.fetchall())
+    offset = first_block * BLOCK_SIZE
+    return bases[start - 1 - offset:end - offset]
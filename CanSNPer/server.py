@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+'''
+server.py: A CanSNPer daemon that types jobs sent to a local Unix socket.
+This file is part of CanSNPer.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import json
+import os
+import socket
+import sys
+import tempfile
+import traceback
+from SocketServer import ForkingMixIn, UnixStreamServer, StreamRequestHandler
+
+# Options a job sends along with its queries, the rest of the settings
+# (database, tmp folder, aligner paths, threads) are the server's own
+JOB_OPTIONS = ("reference", "mode", "aligner", "snp_window", "allow_differences", "tab_sep", "list_snps",
+               "draw_tree", "save_align", "lineage", "snp_matrix", "clade_counts", "profile", "flank_length",
+               "kmer_length", "min_depth", "alignment_stats", "stats_window", "result_cache", "parallel_samples",
+               "verbose", "dev")
+
+
+def send_job(socket_path, job):
+    '''Sends a job to a CanSNPer server and returns its reply.
+
+    Keyword arguments:
+    socket_path -- the Unix socket the server listens on
+    job -- dict with the working directory ("cwd"), the queries ("query")
+           and the JOB_OPTIONS of the job ("options")
+
+    The reply is a dict of what the job wrote to stdout ("stdout") and
+    stderr ("stderr") and its exit code ("exit_code"), as if it had been
+    run on the command line.
+
+    '''
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.connect(socket_path)
+    try:
+        connection.sendall(json.dumps(job) + "\n")
+        connection.shutdown(socket.SHUT_WR)
+        reply = list()
+        chunk = connection.recv(65536)
+        while chunk:
+            reply.append(chunk)
+            chunk = connection.recv(65536)
+    finally:
+        connection.close()
+    return json.loads("".join(reply))
+
+
+def exit_status(e):
+    '''Returns the message and exit code of a SystemExit, as the Python interpreter would exit with them.'''
+    if e.code is None:
+        return "", 0
+    if isinstance(e.code, int):
+        return "", e.code
+    return "%s\n" % e.code, 1
+
+
+def run_captured(function, *args):
+    '''Calls a function with stdout and stderr going to files, returns (stdout, stderr, exit code).
+
+    File descriptors 1 and 2 are redirected, so everything the function
+    and the processes it starts write ends up in the reply. A SystemExit
+    is turned into an exit code, and its message written to stderr, the
+    way the Python interpreter does it.
+
+    '''
+    captured = [tempfile.TemporaryFile(), tempfile.TemporaryFile()]
+    for stream, fd, capture in ((sys.stdout, 1, captured[0]), (sys.stderr, 2, captured[1])):
+        stream.flush()
+        os.dup2(capture.fileno(), fd)
+    exit_code = 0
+    try:
+        function(*args)
+    except SystemExit as e:
+        message, exit_code = exit_status(e)
+        sys.stderr.write(message)
+    except Exception:
+        sys.stderr.write(traceback.format_exc())
+        exit_code = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    output = list()
+    for capture in captured:
+        capture.seek(0)
+        output.append(capture.read().decode("utf8", "replace"))
+        capture.close()
+    return output[0], output[1], exit_code
+
+
+class JobHandler(StreamRequestHandler):
+    '''Types the job read by TypingServer.process_request, in a process of its own.'''
+
+    def handle(self):
+        stdout, stderr, exit_code = run_captured(self.server.run_job, self.server.job)
+        self.wfile.write(json.dumps({"stdout": stdout, "stderr": stderr, "exit_code": exit_code}))
+
+
+class TypingServer(ForkingMixIn, UnixStreamServer):
+    '''Listens on a Unix socket and types each job in a forked process.
+
+    The job is read and prepare_job(job) called in the server process, so
+    anything prepare_job keeps warm, e.g. compiled schemes and exported
+    references, is there in every forked process without being loaded
+    again. run_job(job) then types the job in the forked process, so jobs
+    run at the same time and a job that fails or exits can not take the
+    server down.
+
+    '''
+
+    def __init__(self, socket_path, prepare_job, run_job):
+        '''Binds the socket, replacing a socket file left by an earlier server.'''
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        UnixStreamServer.__init__(self, socket_path, JobHandler)
+        self.socket_path = socket_path
+        self.prepare_job = prepare_job
+        self.run_job = run_job
+        self.job = None
+
+    def process_request(self, request, client_address):
+        try:
+            self.job = json.loads(request.makefile("rb").readline())
+            self.prepare_job(self.job)
+        except (Exception, SystemExit) as e:
+            if isinstance(e, SystemExit):
+                message, exit_code = exit_status(e)
+            else:
+                message, exit_code = traceback.format_exc(), 1
+            request.sendall(json.dumps({"stdout": "", "stderr": message, "exit_code": exit_code}))
+            self.shutdown_request(request)
+            return
+        ForkingMixIn.process_request(self, request, client_address)
+
+    def server_close(self):
+        UnixStreamServer.server_close(self)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
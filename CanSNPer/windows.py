@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+'''
+windows.py: Mini-references of the windows around the SNPs of a strain.
+This file is part of CanSNPer.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+A mini-reference is the bases of the windows of a reference sequence
+joined one after the other. Its windows, (start, end) with 1-based
+reference positions, are the coordinate map back to the reference: a
+position of the mini-reference is in the first window whose bases reach
+past it. They are written in the fasta header of the mini-reference,
+
+    ><organism>.<strain> snp_windows=<start>-<end>,<start>-<end>,...
+
+so the file can be read on its own, e.g. by the worker of another sample.
+'''
+from sequences import read_region
+
+# Marks the windows in the header of a mini-reference
+WINDOWS_FIELD = "snp_windows="
+
+
+def snp_windows(positions, window):
+    '''Returns the windows of window bases on either side of the SNP positions.
+
+    Keyword arguments:
+    positions -- the 1-based SNP positions on one reference sequence
+    window -- number of bases on each side of a SNP
+
+    Windows that overlap or touch are merged. Returns the (start, end)
+    windows, 1-based and inclusive, in the order of the reference. The last
+    window may reach past the end of the sequence, see mini_reference.
+
+    '''
+    windows = list()
+    for position in sorted(set(positions)):
+        start = max(1, position - window)
+        end = position + window
+        if windows and start <= windows[-1][1] + 1:
+            windows[-1] = (windows[-1][0], end)  # Sorted, so this window ends last
+        else:
+            windows.append((start, end))
+    return windows
+
+
+def mini_reference(organism, strain, windows, c):
+    '''Returns the bases of the windows of a strain joined, and the windows as read.
+
+    Keyword arguments:
+    organism -- the organism of the strain
+    strain -- the strain name
+    windows -- the windows, as returned by snp_windows
+    c -- cursor of the CanSNPer database
+
+    Each window is read with read_region, so only the sequence blocks that
+    cover the windows are decompressed. Windows are cut short at the end of
+    the sequence, and windows past it are left out, so the windows returned
+    are the coordinate map of the mini-reference.
+
+    '''
+    pieces = list()
+    kept = list()
+    for start, end in windows:
+        bases = str(read_region(organism, strain, start, end, c))
+        if not bases:
+            break
+        pieces.append(bases)
+        kept.append((start, start + len(bases) - 1))
+    return "".join(pieces), kept
+
+
+def windows_header(name, windows):
+    '''Returns the fasta header line of a mini-reference, see the module docstring.'''
+    return ">%s %s%s\n" % (name, WINDOWS_FIELD, ",".join("%i-%i" % window for window in windows))
+
+
+def read_windows(reference_file):
+    '''Returns the windows in the header of a mini-reference, None if the file holds a whole reference.'''
+    fasta_file = open(reference_file, "r")
+    header = fasta_file.readline()
+    fasta_file.close()
+    for field in header.split()[1:]:
+        if field.startswith(WINDOWS_FIELD):
+            return [tuple(int(position) for position in window.split("-"))
+                    for window in field[len(WINDOWS_FIELD):].split(",")]
+    return None
+
+
+def window_offsets(windows):
+    '''Returns the 0-based position of each window in the mini-reference.'''
+    offsets = list()
+    offset = 0
+    for start, end in windows:
+        offsets.append(offset)
+        offset += end - start + 1
+    return offsets
+
+
+def lift(sequence, windows):
+    '''Places a sequence in mini-reference coordinates at the reference positions of its windows.
+
+    Keyword arguments:
+    sequence -- e.g. the query aligned to the mini-reference
+    windows -- the windows of the mini-reference
+
+    Returns the sequence in the coordinates of the reference, up to the end
+    of the last window, with a gap, "-", at every position outside the
+    windows, so it can be read at the SNP positions like a query aligned to
+    the whole reference.
+
+    '''
+    if not windows:
+        return ""
+    lifted = bytearray("-" * windows[-1][1])
+    for (start, end), offset in zip(windows, window_offsets(windows)):
+        bases = sequence[offset:offset + end - start + 1]  # Short if the alignment ends early
+        lifted[start - 1:start - 1 + len(bases)] = bases
+    return str(lifted)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+'''
+workspace.py: A private, size limited directory for the tmp files of a run.
+This file is part of CanSNPer.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import errno
+import os
+import shutil
+import socket
+import tempfile
+
+# Workspaces are named <prefix><host>.<pid>.<random>, removed ones get the suffix
+# while they are being deleted
+WORKSPACE_PREFIX = "CanSNPer_run."
+REMOVED_SUFFIX = ".removed"
+
+
+def process_alive(pid):
+    '''Returns True if a process with this pid runs on this host.'''
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM  # Runs, as another user
+    return True
+
+
+def remove_directory(directory):
+    '''Removes a directory and everything in it.
+
+    The directory is renamed first, which is atomic, so at no point is
+    there a half removed directory under its own name. A removal that is
+    cut short leaves a directory with REMOVED_SUFFIX, which the next
+    workspace in the same root removes.
+
+    '''
+    removed = directory
+    if not directory.endswith(REMOVED_SUFFIX):
+        removed = directory + REMOVED_SUFFIX
+        try:
+            os.rename(directory, removed)
+        except OSError as e:
+            if e.errno == errno.ENOENT:  # Already removed
+                return
+            raise
+    shutil.rmtree(removed, ignore_errors=True)
+
+
+def remove_stale_workspaces(root):
+    '''Removes the workspaces in root left by runs on this host that no longer run, e.g. after a crash.'''
+    host = socket.gethostname()
+    for name in os.listdir(root):
+        if not name.startswith(WORKSPACE_PREFIX):
+            continue
+        if name.endswith(REMOVED_SUFFIX):
+            remove_directory(os.path.join(root, name))
+            continue
+        fields = name[len(WORKSPACE_PREFIX):].rsplit(".", 2)
+        if len(fields) != 3 or fields[0] != host or not fields[1].isdigit():
+            continue
+        if not process_alive(int(fields[1])):
+            remove_directory(os.path.join(root, name))
+
+
+class Workspace(object):
+    '''A directory of its own for the tmp files of one CanSNPer run.
+
+    The workspace is made in a root directory, e.g. /dev/shm so that the
+    tmp files never touch a disk, readable by its owner only and named by
+    host and process, so that workspaces left by runs that crashed are
+    removed by the next run. Used as a context manager it is removed, with
+    everything in it, when the run ends, see remove_directory. The files
+    in it may use at most quota bytes, which is checked with check.
+
+    '''
+
+    def __init__(self, root, quota=0):
+        '''
+        Keyword arguments:
+        root -- the directory the workspace is made in, created if missing
+        quota -- the most bytes the files in the workspace may use, 0 for
+                 no limit
+
+        '''
+        try:
+            os.makedirs(root)
+        except OSError as e:
+            if e.errno != errno.EEXIST:  # Another CanSNPer run may have just created it
+                raise
+        remove_stale_workspaces(root)
+        self.quota = quota
+        self.path = tempfile.mkdtemp(prefix="%s%s.%i." % (WORKSPACE_PREFIX, socket.gethostname(), os.getpid()),
+                                     dir=root)
+
+    def directory(self, name):
+        '''Makes a directory of its own in the workspace, e.g. for one sample, and returns its path.'''
+        return tempfile.mkdtemp(prefix="%s." % name, dir=self.path)
+
+    def used(self):
+        '''Returns the number of bytes used by the files in the workspace.'''
+        used = 0
+        for directory, directories, files in os.walk(self.path):
+            for file_name in files:
+                try:
+                    used += os.lstat(os.path.join(directory, file_name)).st_size
+                except OSError:  # Removed while the workspace was walked
+                    pass
+        return used
+
+    def check(self):
+        '''Raises IOError (EDQUOT) if the files in the workspace use more than its quota.'''
+        if not self.quota:
+            return
+        used = self.used()
+        if used > self.quota:
+            raise IOError(errno.EDQUOT, "The tmp files in %s use %i bytes, more than the quota of %i bytes" %
+                          (self.path, used, self.quota))
+
+    def remove(self):
+        '''Removes the workspace and everything in it.'''
+        if self.path is not None:
+            remove_directory(self.path)
+            self.path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.remove()
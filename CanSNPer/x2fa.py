@@ -19,7 +19,18 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 # Apologies for the perl-esque way of coding.
 # I updated a perl script and tried to copy it line for line.
-# VERSION 9
+# VERSION 10
+# Updates for v10:
+# Can be imported. project() returns the converted sequences to the caller without
+# writing a fasta file, x2fa() does what the script does. XmfaIndex looks up single
+# reference positions by seeking into the blocks that cover them, see --positions.
+# align() does not use it: the sequence identity of every alignment, and the warning
+# that goes with it, is computed over the whole projected query, so each xmfa is
+# projected anyway. --snp_window keeps the alignments that small instead.
+# Reads and converts one alignment block at a time instead of keeping every block
+# in memory. The output is written through a memory-mapped file of the final size,
+# so memory use stays near the size of the largest block. Gaps in the reference are
+# removed in one pass per block.
 # Updates for v9:
 # Changed the way screening of flanks is done. Fixed a bug where it sometimes messed
 # the length of the alignment up.
@@ -27,196 +38,474 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 # Saves strings in the form of bytearrays. The immutability of python strings
 # make the process of changing strings inefficient (which is how this implementation works).
 # Using the bytearrays, the program runs a lot faster, especially when screening deletion flanks.
+import mmap
 import re
 import sys
+from bisect import bisect_left, bisect_right
 from string import maketrans
 
+# Regex patterns
+pattern_start_of_seq = re.compile("^>\s*(\d+):(\d+)-(\d+) ([+-])")  # Finds the start of sequence in xmfa
+pattern_seq_name = re.compile("#Sequence(\d+)File")  # Finds comment line that contains sequence name in xmfa
+pattern_comment = re.compile("#")  # Finds comment in xmfa
+pattern_gap = re.compile("-+")  # Finds a gap of any size!
+
+# Number of bases per line in the fasta output
+LINE_LENGTH = 80
+
 
 def reverse_complement(dna):
     '''Complement and reverse DNA string'''
     complements = maketrans('acgtrymkbdhvACGTRYMKBDHV', 'tgcayrkmvhdbTGCAYRKMVHDB')
     return dna.translate(complements)[::-1]
 
-if __name__ == "__main__":
-    '''Run the program'''
-    if len(sys.argv) != 5:
-        # Usage information
-        exit("usage: x2fa.py <.xmfa> <reference> <screen deletions by X bases> <outfile>")
 
-    # Self-explanatory grabbing of command-line arguments
-    xmfa = open(sys.argv[1], "r")
-    outfile = open(sys.argv[4], "w")
-    reference_name = sys.argv[2]
-    flank = int(sys.argv[3])
+def parse_seq_line(line):
+    '''Returns sequence number, start, end and strand of a "> 1:100-200 +" line.'''
+    curr_seq = int(line.split(":")[0].split(" ")[1])
+    startend = line.split(" ")[1].split(":")[1].split("-")
+    startend[0] = int(startend[0])
+    startend[1] = int(startend[1])
+    return curr_seq, min(startend), max(startend), line.split(" ")[2]
 
-    # Counters and other single variable initiations
-    alignment_number = 0  # Keeps track of the alignment
-    curr_seq = None  # Keeps track of which sequence is active when reading xmfa
-    curr_pos = None  # Keeps track of which position in the sequence we are at when reading xmfa
-
-    # Regex patterns
-    pattern_start_of_seq = re.compile("^>\s*(\d+):(\d+)-(\d+) ([+-])")  # Finds the start of sequence in xmfa
-    pattern_seq_name = re.compile("#Sequence(\d+)File")  # Finds comment line that contains sequence name in xmfa
-    pattern_comment = re.compile("#")  # Finds comment in xmfa
-    pattern_gap = re.compile("-+")  # Finds a gap of any size!
-
-    # Dictionaries
-    aGen = dict()  # This is the dictionary that will contain all alignment fragments
-    outseqs = dict()  # Will eventually be filled with finalised sequences
-    rmH = dict()  # Will contain information on things that are going to be removed
-    name2num = dict()  # Conversion dictionaries
-    num2name = dict()  # Conversion dictionaries
-    aGen[alignment_number] = dict()
-    rmH[alignment_number] = dict()
-    for line in xmfa:
-        if pattern_start_of_seq.search(line):
-            # This line contains information on the aligned sequence, add it to aGen
-            curr_seq = int(line.split(":")[0].split(" ")[1])
-            curr_pos = 0
-            aGen[alignment_number][curr_seq] = dict()
-
-            # Get the start and end position of the alignment
-            startend = line.split(" ")[1].split(":")[1].split("-")
-            startend[0] = int(startend[0])
-            startend[1] = int(startend[1])
-            if startend[0] < startend[1]:
-                aGen[alignment_number][curr_seq]["p1"] = startend[0]
-                aGen[alignment_number][curr_seq]["p2"] = startend[1]
-            else:
-                aGen[alignment_number][curr_seq]["p1"] = startend[1]
-                aGen[alignment_number][curr_seq]["p2"] = startend[0]
-            aGen[alignment_number][curr_seq]["sign"] = line.split(" ")[2]
 
-            # Save the alignment as a bytearray.
-            aGen[alignment_number][curr_seq]["seq"] = bytearray(" " * (aGen[alignment_number][curr_seq]["p2"] - aGen[alignment_number][curr_seq]["p1"]), encoding="utf8")
-        elif line.strip() == "=":
-            # = marks the start of a new alignment block
-            alignment_number += 1
-            aGen[alignment_number] = dict()
-            rmH[alignment_number] = dict()
-        elif pattern_seq_name.search(line):
-            # If its a sequence name comment line, add information to name2num/num2name
+def read_sequence_names(xmfa_name):
+    '''Reads the sequence names and lengths of an xmfa file, skipping the alignments.
+
+    Keyword arguments:
+    xmfa_name -- the file name of the xmfa file
+
+    Returns name2num and num2name, the conversion dictionaries between sequence
+    names and numbers, and the position of the last aligned base of each sequence.
+
+    '''
+    name2num = dict()
+    num2name = dict()
+    last_aligned = dict()
+    xmfa = open(xmfa_name, "r")
+    for line in xmfa:
+        if line[0] == ">":
+            if pattern_start_of_seq.search(line):
+                num, p1, p2, sign = parse_seq_line(line)
+                if p2 > last_aligned.get(num, 0):
+                    last_aligned[num] = p2
+        elif line[0] == "#" and pattern_seq_name.search(line):
             num = int(line.split("Sequence")[1].split("File")[0])
             name = line.split("\t")[1].strip()
             name2num[name] = num
             num2name[num] = name
+    xmfa.close()
+    return name2num, num2name, last_aligned
+
+
+def read_blocks(xmfa_name):
+    '''Yields the alignment blocks of an xmfa file, one at a time.
+
+    Keyword arguments:
+    xmfa_name -- the file name of the xmfa file
+
+    Each block is a dict keyed by sequence number, with the start and end
+    position ("p1", "p2"), the strand ("sign") and the aligned sequence as a
+    bytearray ("seq") of each sequence in the block.
+
+    '''
+    xmfa = open(xmfa_name, "r")
+    block = dict()
+    curr_seq = None  # Keeps track of which sequence is active when reading xmfa
+    lines = list()
+    for line in xmfa:
+        if pattern_start_of_seq.search(line):
+            if curr_seq is not None:
+                add_sequence(block[curr_seq], lines)
+            # This line contains information on the aligned sequence, add it to the block
+            curr_seq, p1, p2, sign = parse_seq_line(line)
+            block[curr_seq] = {"p1": p1, "p2": p2, "sign": sign}
+            lines = list()
+        elif line.strip() == "=":
+            # = marks the end of an alignment block
+            if curr_seq is not None:
+                add_sequence(block[curr_seq], lines)
+            yield block
+            block = dict()
+            curr_seq = None
+            lines = list()
         elif pattern_comment.search(line):
-            # If its another type of comment line, dont do anything
+            # Comment lines, the sequence names are read by read_sequence_names
             pass
         else:
-            # The rest is only sequence, add it to the current seq at the current position
-            length_of_line = len(line) - 1
-            aGen[alignment_number][curr_seq]["seq"][curr_pos:curr_pos + length_of_line] = line.strip().encode(encoding="utf8")
-            curr_pos += length_of_line
-
-    # Dont need this file open anymore
+            # The rest is only sequence, add it to the current seq
+            lines.append(line.strip())
+    if curr_seq is not None:
+        add_sequence(block[curr_seq], lines)
+        yield block
     xmfa.close()
 
-    # Find out which of the sequences is the reference
-    reference_num = name2num[reference_name]
-    # Get the length of the reference sequence, the position of the "last" bit that is aligned
-    length_of_reference = 0
-    for alignment in aGen.keys():
-        try:  # Try to test this, but skip any errors, the reference is not in all alignments
-            if aGen[alignment][reference_num]["p2"] > length_of_reference:
-                length_of_reference = aGen[alignment][reference_num]["p2"]
-        except KeyError as e:
-            pass
 
-    # Mock up the output sequences, fill them with only gaps
-    for num in num2name.keys():
-        # Handle the output sequences as bytearrays too!
-        outseqs[num] = bytearray("-" * length_of_reference)
-
-    for alignment in aGen.keys():
-        keep_going_flag = False
-        try:  # Test if the reference is in the alignment
-            tmp = aGen[alignment][reference_num]["seq"]
-            keep_going_flag = True
-        except KeyError as e:  # Delete the alignment if it doesnt have the reference
-            del aGen[alignment]
-
-        if keep_going_flag:  # If we have the reference
-            search_pos = 0
-            list_of_gaps = list()
-            sequence_search_string = str(aGen[alignment][reference_num]["seq"])
-            while search_pos < len(aGen[alignment][reference_num]["seq"]):
+def add_sequence(entry, lines):
+    '''Joins the sequence lines of one sequence of a block into a bytearray.'''
+    entry["seq"] = bytearray("".join(lines))
+    if len(entry["seq"]) < entry["p2"] - entry["p1"]:
+        # Same as previous versions, which filled the sequence out with spaces
+        entry["seq"].extend(" " * (entry["p2"] - entry["p1"] - len(entry["seq"])))
+
+
+def project_block(block, reference_num, flank, length_of_reference):
+    '''Projects an alignment block onto the coordinates of the reference.
+
+    Keyword arguments:
+    block -- an alignment block from read_blocks
+    reference_num -- the number of the reference sequence
+    flank -- the number of bases to screen on each side of deletions
+    length_of_reference -- the position of the last aligned base of the reference
+
+    Removes the columns where the reference has a gap and, if flank > 0,
+    masks flank bases on each side of every deletion. Returns a list of
+    (sequence number, start, bases) to write to the output, start being the
+    0-based reference position of the first base. Blocks without the
+    reference give an empty list.
+
+    '''
+    if reference_num not in block:
+        return list()
+
+    # Looking for gaps in the reference, and remove those columns from all sequences
+    kept = list()  # Column intervals that are kept
+    list_of_gaps = list()  # Deletion positions after the columns have been removed
+    search_pos = 0
+    removed = 0
+    for gap_hit in pattern_gap.finditer(str(block[reference_num]["seq"])):
+        kept.append((search_pos, gap_hit.start()))
+        list_of_gaps.append([gap_hit.start() - removed, gap_hit.start() - removed])
+        removed += gap_hit.end() - gap_hit.start()
+        search_pos = gap_hit.end()
+    if kept:
+        kept.append((search_pos, len(block[reference_num]["seq"])))
+        for sequence in block.keys():
+            seq = block[sequence]["seq"]
+            block[sequence]["seq"] = bytearray().join([seq[start:end] for start, end in kept])
+
+    if flank > 0:  # Extend the deletions by the number of bases given as flank
+        search_pos = 0
+        for sequence in block.keys():
+            if sequence == reference_num:
+                continue
+            sequence_search_string = str(block[sequence]["seq"])
+            while search_pos < length_of_reference:
                 gap_hit = pattern_gap.search(sequence_search_string, search_pos)
-                if gap_hit:  # Looking for gaps in the reference
-                    rmH[alignment][gap_hit.start()] = gap_hit.end() - gap_hit.start()  # Save information
+                if gap_hit:  # Looking for gaps in the non-references
+                    list_of_gaps.append([gap_hit.start(), gap_hit.end()])
                     search_pos = gap_hit.end()
                 else:
                     break
+        for non_ref_gap in list_of_gaps:
+            for sequence in block.keys():
+                new_start = max(0, non_ref_gap[0] - flank)
+                new_end = min(non_ref_gap[1] + flank, len(block[sequence]["seq"]))
+                if new_end > new_start:
+                    block[sequence]["seq"][new_start:new_end] = "-" * (new_end - new_start)
 
-            for pos in reversed(sorted(rmH[alignment].keys())):  # Go through those gaps and remove them
-                if rmH[alignment][pos]:
-                    start = pos
-                    end = pos + rmH[alignment][pos]
-                    for sequence in aGen[alignment].keys():
-                        aGen[alignment][sequence]["seq"][start:end] = bytearray('')
-                    if flank > 0:  # If we are going to extend deletions, store the information for these
-                        for i in range(0, len(list_of_gaps)):
-                            # Reduce the position values as we remove pieces of the genome
-                            list_of_gaps[i] = [list_of_gaps[i][0] - end + start, list_of_gaps[i][1] - end + start]
-                        list_of_gaps.append([start, start])
-
-            if flank > 0:  # Extend the deletions by the number of bases given as flank
-                search_pos = 0
-                for sequence in aGen[alignment].keys():
-                    if sequence == reference_num:
-                        continue
-                    sequence_search_string = str(aGen[alignment][sequence]["seq"])
-                    while search_pos < length_of_reference:
-                        gap_hit = pattern_gap.search(sequence_search_string, search_pos)
-                        if gap_hit:  # Looking for gaps in the non-references
-                            list_of_gaps.append([gap_hit.start(), gap_hit.end()])
-                            search_pos = gap_hit.end()
-                        else:
-                            break
-                for non_ref_gap in list_of_gaps:
-                    for sequence in aGen[alignment].keys():
-                        new_start = max(0, non_ref_gap[0] - flank)
-                        new_end = min(non_ref_gap[1] + flank, len(aGen[alignment][sequence]["seq"]))
-                        aGen[alignment][sequence]["seq"][new_start:new_end] = bytearray("-" * (new_end - new_start))
-
-    # Go through all the alignment blocks and add the sequence to the output bytearrays
-    for alignment in aGen.keys():
-        start = int(aGen[alignment][reference_num]["p1"]) - 1
-        end = int(aGen[alignment][reference_num]["p2"])
-        if flank > 0:
-            start += flank
-            end -= flank
-        if aGen[alignment][reference_num]["sign"] == "+":
-            # Add sequence to outseqs
-            for sequence in aGen[alignment].keys():
-                if start >= 0 and end > 0 and aGen[alignment][sequence]["seq"]:
-                    if flank > 0:
-                        outseqs[sequence][start:end] = bytearray(str(aGen[alignment][sequence]["seq"][flank:-flank]), encoding="utf8")
-                    else:
-                        outseqs[sequence][start:end] = bytearray(str(aGen[alignment][sequence]["seq"]), encoding="utf8")
-        else:
-            # Add reverse complement to outseqs
-            for sequence in aGen[alignment].keys():
-                if start >= 0 and end > 0 and aGen[alignment][sequence]["seq"]:
-                    if flank > 0:
-                        outseqs[sequence][start:end] = bytearray(reverse_complement(str(aGen[alignment][sequence]["seq"][flank:-flank])), encoding="utf8")
-                    else:
-                        outseqs[sequence][start:end] = bytearray(reverse_complement(str(aGen[alignment][sequence]["seq"])), encoding="utf8")
-
-    # First, write the reference sequence
-    outfile.write(">" + num2name[reference_num] + "\n")
-    seqpos = 0
-    # 80 characters at a time
-    while seqpos < len(outseqs[reference_num]):
-        outfile.write(str(outseqs[reference_num][seqpos:seqpos + 80]) + "\n")
-        seqpos += 80
-
-    # Then, write the rest
-    for sequence in outseqs.keys():
-        if sequence != reference_num:
-            outfile.write(">" + num2name[sequence] + "\n")
-            seqpos = 0
-            while seqpos < len(outseqs[sequence]):
-                outfile.write(str(outseqs[sequence][seqpos:seqpos + 80]) + "\n")
-                seqpos += 80
+    # Add the sequences, or their reverse complements, at the reference position
+    writes = list()
+    start = block[reference_num]["p1"] - 1
+    end = block[reference_num]["p2"]
+    if flank > 0:
+        start += flank
+        end -= flank
+    for sequence in block.keys():
+        if start >= 0 and end > 0 and block[sequence]["seq"]:
+            if flank > 0:
+                bases = str(block[sequence]["seq"][flank:-flank])
+            else:
+                bases = str(block[sequence]["seq"])
+            if block[reference_num]["sign"] != "+":
+                bases = reverse_complement(bases)
+            writes.append((sequence, start, bases[:max(0, end - start)]))
+    return writes
+
+
+class FastaOutput(object):
+    '''A fasta file of fixed size, written through a memory map.
+
+    The file is laid out with every sequence filled with gaps, after which
+    any stretch of any sequence can be overwritten in place.
+
+    '''
+
+    def __init__(self, file_name, names, length):
+        '''
+        Keyword arguments:
+        file_name -- the name of the fasta file
+        names -- (key, name) of the sequences, in the order they are written
+        length -- the length of every sequence
+
+        '''
+        self.length = length
+        self.offsets = dict()  # Where the first base of each sequence is in the file
+        gap_line = "-" * LINE_LENGTH + "\n"
+        outfile = open(file_name, "w+b")
+        for key, name in names:
+            outfile.write(">" + name + "\n")
+            self.offsets[key] = outfile.tell()
+            full_lines, rest = divmod(length, LINE_LENGTH)
+            while full_lines:
+                chunk = min(full_lines, 4096)  # Write the gaps a few hundred kb at a time
+                outfile.write(gap_line * chunk)
+                full_lines -= chunk
+            if rest:
+                outfile.write("-" * rest + "\n")
+        outfile.flush()
+        self.outfile = outfile
+        self.map = None
+        if outfile.tell():
+            self.map = mmap.mmap(outfile.fileno(), 0, access=mmap.ACCESS_WRITE)
+
+    def write(self, key, start, bases):
+        '''Writes bases to sequence key, the first one at 0-based position start.'''
+        offset = self.offsets[key]
+        pos = start
+        i = 0
+        end = min(start + len(bases), self.length)
+        while pos < end:
+            n = min(end, (pos // LINE_LENGTH + 1) * LINE_LENGTH) - pos  # To the end of the line
+            file_pos = offset + pos + pos // LINE_LENGTH
+            self.map[file_pos:file_pos + n] = bases[i:i + n]
+            pos += n
+            i += n
+
+    def close(self):
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+        self.outfile.close()
+
+
+class SequenceOutput(object):
+    '''Sequences of fixed length kept in memory, filled with gaps to begin with.'''
+
+    def __init__(self, names, length):
+        '''
+        Keyword arguments:
+        names -- (key, name) of the sequences
+        length -- the length of every sequence
+
+        '''
+        self.length = length
+        self.sequences = dict()
+        for key, name in names:
+            self.sequences[key] = bytearray("-" * length)
+
+    def write(self, key, start, bases):
+        '''Writes bases to sequence key, the first one at 0-based position start.'''
+        end = min(start + len(bases), self.length)
+        if end > start:
+            self.sequences[key][start:end] = bases[:end - start]
+
+    def close(self):
+        pass
+
+
+def convert(xmfa_name, reference_name, flank, make_output):
+    '''Converts an xmfa file into the coordinates of the reference.
+
+    Keyword arguments:
+    xmfa_name -- the file name of the xmfa file
+    reference_name -- the name of the reference sequence, as listed in the xmfa
+    flank -- the number of bases to screen on each side of deletions
+    make_output -- called with the (key, name) list of the sequences and their
+                   length, returns the output the blocks are written to
+
+    Returns the (key, name) list, reference first, and the output.
+
+    '''
+    name2num, num2name, last_aligned = read_sequence_names(xmfa_name)
+
+    # Find out which of the sequences is the reference
+    reference_num = name2num[reference_name]
+    # Get the length of the reference sequence, the position of the "last" bit that is aligned
+    length_of_reference = last_aligned.get(reference_num, 0)
+
+    order = [reference_num] + [num for num in sorted(num2name.keys()) if num != reference_num]
+    names = [(num, num2name[num]) for num in order]
+    output = make_output(names, length_of_reference)
+    for block in read_blocks(xmfa_name):
+        for sequence, start, bases in project_block(block, reference_num, flank, length_of_reference):
+            output.write(sequence, start, bases)
+    output.close()
+    return names, output
+
+
+def x2fa(xmfa_name, reference_name, flank, out_name):
+    '''Converts an xmfa file to a fasta file in the coordinates of the reference.
+
+    Keyword arguments:
+    xmfa_name -- the file name of the xmfa file
+    reference_name -- the name of the reference sequence, as listed in the xmfa
+    flank -- the number of bases to screen on each side of deletions
+    out_name -- the file name of the fasta output
+
+    The reference is written first, then the rest of the sequences.
+
+    '''
+    convert(xmfa_name, reference_name, flank,
+            lambda names, length: FastaOutput(out_name, names, length))
+
+
+def project(xmfa_name, reference_name, flank=0):
+    '''Returns the sequences of an xmfa file in the coordinates of the reference.
+
+    Keyword arguments:
+    xmfa_name -- the file name of the xmfa file
+    reference_name -- the name of the reference sequence, as listed in the xmfa
+    flank -- the number of bases to screen on each side of deletions
+
+    Returns a list of (name, sequence), reference first, with the same
+    sequences that x2fa() would write to the fasta file.
+
+    '''
+    names, output = convert(xmfa_name, reference_name, flank, SequenceOutput)
+    return [(name, str(output.sequences[key])) for key, name in names]
+
+
+def write_fasta(out_name, sequences):
+    '''Writes (name, sequence) pairs to a fasta file, formatted like x2fa() output.'''
+    outfile = open(out_name, "w")
+    for name, sequence in sequences:
+        outfile.write(">" + name + "\n")
+        for seqpos in range(0, len(sequence), LINE_LENGTH):
+            outfile.write(sequence[seqpos:seqpos + LINE_LENGTH] + "\n")
     outfile.close()
+
+
+class XmfaIndex(object):
+    '''Index of the alignment blocks of an xmfa file, for looking up single positions.
+
+    The file is scanned once, recording the reference interval and strand of
+    every block and where in the file the aligned sequence of each of its
+    sequences starts and ends. A lookup then only reads the blocks that cover
+    the positions asked for. The answers are the same as those of project()
+    with flank 0: where blocks overlap the last one wins, and a block only
+    counts for a sequence that is aligned in it.
+
+    '''
+
+    def __init__(self, xmfa_name, reference_name):
+        '''
+        Keyword arguments:
+        xmfa_name -- the file name of the xmfa file
+        reference_name -- the name of the reference sequence, as listed in the xmfa
+
+        '''
+        self.xmfa_name = xmfa_name
+        self.name2num = dict()
+        self.num2name = dict()
+        self.blocks = list()  # (p1, p2, sign, {sequence number: (start offset, end offset)})
+        block = dict()
+        reference_entry = None
+        entries = list()
+        xmfa = open(xmfa_name, "r")
+        while True:
+            offset = xmfa.tell()
+            line = xmfa.readline()
+            if not line or line.strip() == "=" or pattern_start_of_seq.search(line):
+                if entries:  # The aligned sequence of the previous entry ends here
+                    entries[-1][1] = offset
+                if not line or line.strip() == "=":
+                    if reference_entry is not None:
+                        self.blocks.append((reference_entry[0], reference_entry[1], reference_entry[2],
+                                            dict((num, tuple(span)) for num, span in block.items())))
+                    block = dict()
+                    reference_entry = None
+                    entries = list()
+                    if not line:
+                        break
+                    continue
+                curr_seq, p1, p2, sign = parse_seq_line(line)
+                span = [xmfa.tell(), None]
+                block[curr_seq] = span
+                entries.append(span)
+                if curr_seq == self.name2num.get(reference_name):
+                    reference_entry = (p1, p2, sign)
+            elif line[0] == "#" and pattern_seq_name.search(line):
+                num = int(line.split("Sequence")[1].split("File")[0])
+                name = line.split("\t")[1].strip()
+                self.name2num[name] = num
+                self.num2name[num] = name
+        xmfa.close()
+        self.reference_num = self.name2num[reference_name]
+
+    def _read(self, xmfa, span):
+        '''Returns the aligned sequence between two file offsets.'''
+        xmfa.seek(span[0])
+        return "".join(line.strip() for line in xmfa.read(span[1] - span[0]).split("\n")
+                       if line and not pattern_comment.search(line))
+
+    def lookup(self, positions, sequence_name=None):
+        '''Returns the base aligned to each of a list of reference positions.
+
+        Keyword arguments:
+        positions -- 1-based positions in the reference
+        sequence_name -- the sequence to look up, by default the first one
+                         that is not the reference
+
+        Returns a dict of position: base. Positions that no block covers are
+        left out, they are gaps in the project() output.
+
+        '''
+        if sequence_name is None:
+            sequence_num = [num for num in sorted(self.num2name.keys()) if num != self.reference_num][0]
+        else:
+            sequence_num = self.name2num[sequence_name]
+        wanted = sorted(set(positions))
+        bases = dict()
+        xmfa = open(self.xmfa_name, "r")
+        for p1, p2, sign, spans in self.blocks:
+            if p1 < 1 or sequence_num not in spans:
+                continue
+            lo = bisect_left(wanted, p1)
+            hi = bisect_right(wanted, p2)
+            if lo == hi:
+                continue  # This block does not cover any of the positions
+            reference = self._read(xmfa, spans[self.reference_num])
+            sequence = self._read(xmfa, spans[sequence_num])
+            if not sequence:
+                continue
+            gap_runs = [(gap_hit.start(), gap_hit.end()) for gap_hit in pattern_gap.finditer(reference)]
+            ungapped_length = len(reference) - sum(end - start for start, end in gap_runs)
+            for position in wanted[lo:hi]:
+                i = position - p1  # 0-based position within the block
+                if sign == "+":
+                    k = i
+                else:  # The block is reverse complemented in the reference coordinates
+                    k = ungapped_length - 1 - i
+                if k < 0 or k >= ungapped_length:
+                    continue
+                # Find the column of the k:th reference base by skipping the gaps before it
+                column = k
+                for start, end in gap_runs:
+                    if start > column:
+                        break
+                    column += end - start
+                base = sequence[column:column + 1]
+                if sign != "+":
+                    base = reverse_complement(base)
+                bases[position] = base
+        xmfa.close()
+        return bases
+
+if __name__ == "__main__":
+    '''Run the program'''
+    if len(sys.argv) == 4 and sys.argv[3].startswith("--positions="):
+        # Print the base of the first non-reference sequence at some positions
+        index = XmfaIndex(sys.argv[1], sys.argv[2])
+        positions = [int(position) for position in sys.argv[3].split("=", 1)[1].split(",")]
+        bases = index.lookup(positions)
+        for position in positions:
+            print("%i\t%s" % (position, bases.get(position, "-")))
+        sys.exit()
+    if len(sys.argv) != 5:
+        # Usage information
+        exit("usage: x2fa.py <.xmfa> <reference> <screen deletions by X bases> <outfile>\n" +
+             "       x2fa.py <.xmfa> <reference> --positions=<position,position,...>")
+
+    # Self-explanatory grabbing of command-line arguments
+    x2fa(sys.argv[1], sys.argv[2], int(sys.argv[3]), sys.argv[4])
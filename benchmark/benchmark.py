@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+benchmark.py: Times the stages of CanSNPer on simulated queries.
+This file is part of CanSNPer.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+A database is built from the Francisella tularensis SNP list, tree and
+reference genomes that come with CanSNPer. Queries are simulated from the
+reference genomes with the SNPs of a chosen node, and its ancestors, in the
+derived state and every other SNP ancestral, plus random substitutions, cut
+into contigs with every other contig reverse complemented. They are aligned
+with stand_in_mauve.py in place of the aligner chosen with --aligner, so the
+benchmark runs anywhere and gives the same alignments every time, whichever
+aligner output is projected.
+
+The stages of align() and classify() are timed one at a time for a single
+sample and summed over a batch, and the batch is also typed end to end with
+type_queries, serially and with --parallel_samples.
+
+    python benchmark/benchmark.py [--samples 8] [--repeats 3] [--aligner nucmer] [--snp_window 500]
+                                  [--json out.json]
+'''
+import argparse
+import json
+import random
+import shutil
+import sys
+import tempfile
+import time
+from os import path, makedirs
+from StringIO import StringIO
+
+BENCHMARK_DIR = path.dirname(path.abspath(__file__))
+sys.path.insert(0, path.dirname(BENCHMARK_DIR))
+from CanSNPer import __main__ as cansnper
+from CanSNPer.sequences import read_sequence
+from CanSNPer.x2fa import reverse_complement
+
+ORGANISM = "francisella"
+SNP_FILE = "francisella_tularensis_snp.txt"
+TREE_FILE = "francisella_tularensis_tree.txt"
+SEQUENCE_FILES = {"FSC200": "FSC200.fa", "OSU18": "OSU18.fa", "SCHUS4.1": "SCHUS4.1.fa", "SCHUS4.2": "SCHUS4.2.fa"}
+STAGES = ["load scheme", "reference export", "alignment", "projection", "identity", "tree walk", "output"]
+BASES = "ACGT"
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Times the stages of CanSNPer on simulated queries")
+    parser.add_argument("--samples", type=int, default=4,
+                        help="number of simulated queries in the batch [4]")
+    parser.add_argument("--nodes",
+                        help="comma separated tree nodes the queries are simulated from, " +
+                        "picked at random from the nodes with a SNP if not given")
+    parser.add_argument("--repeats", type=int, default=1,
+                        help="times each measurement is repeated, the fastest is reported [1]")
+    parser.add_argument("--parallel_samples", type=int, default=2,
+                        help="--parallel_samples of the parallel batch run, 1 to skip it [2]")
+    parser.add_argument("--aligner", choices=sorted(cansnper.ALIGNERS), default="progressiveMauve",
+                        help="the aligner whose output stand_in_mauve.py writes [progressiveMauve]")
+    parser.add_argument("--snp_window", type=int, default=0,
+                        help="--snp_window of the runs, 0 aligns to the whole references [0]")
+    parser.add_argument("--num_threads", type=int, default=0,
+                        help="--num_threads of the runs [0]")
+    parser.add_argument("--mutation_rate", type=float, default=0.001,
+                        help="fraction of the other bases that are substituted [0.001]")
+    parser.add_argument("--contig_length", type=int, default=100000,
+                        help="length of the simulated contigs [100000]")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="seed of the simulation [1]")
+    parser.add_argument("--work_dir",
+                        help="folder for the database, queries and tmp files, kept " +
+                        "afterwards; a temporary folder that is removed if not given")
+    parser.add_argument("--json",
+                        help="also write the timings to this file")
+    return parser.parse_args()
+
+
+def command_line(work_dir, arguments, extra=()):
+    '''Returns the CanSNPer command line arguments for the benchmark database, with stand_in_mauve.py as aligner.'''
+    stand_in = "%s %s" % (sys.executable, path.join(BENCHMARK_DIR, "stand_in_mauve.py"))
+    return ["-b", path.join(work_dir, "benchmark.db"), "-r", ORGANISM,
+            "-f", path.join(work_dir, "tmp"), "--no_result_cache", "-n", str(arguments.num_threads),
+            "--aligner", arguments.aligner, "-m", stand_in, "--nucmer", stand_in,
+            "--minimap2", stand_in, "--snp_window", str(arguments.snp_window)] + list(extra)
+
+
+def make_config(work_dir, arguments, extra=()):
+    '''Returns a CanSNPer configuration, as from the command line, for the benchmark database.'''
+    argv = sys.argv
+    sys.argv = ["CanSNPer"] + command_line(work_dir, arguments, extra)
+    try:
+        config = cansnper.parse_arguments()
+    finally:
+        sys.argv = argv
+    return config
+
+
+def build_database(config, c):
+    '''Imports the bundled Francisella SNPs, tree and reference genomes.'''
+    source = path.dirname(BENCHMARK_DIR)
+    cansnper.initialise_table(config, c)
+    cansnper.import_to_db(path.join(source, SNP_FILE), config, c)
+    cansnper.import_tree(path.join(source, TREE_FILE), config, c)
+    stdout = sys.stdout
+    sys.stdout = StringIO()  # import_sequence prints the file names
+    try:
+        for strain in sorted(SEQUENCE_FILES):
+            strain_config = dict(config)
+            strain_config["strain_name"] = strain
+            cansnper.import_sequence(path.join(source, SEQUENCE_FILES[strain]), strain_config, c)
+    finally:
+        sys.stdout = stdout
+    c.connection.commit()
+
+
+def simulate_query(file_name, node, scheme, references, arguments, rng):
+    '''Writes a query genome with the SNP states of a node.
+
+    Keyword arguments:
+    file_name -- the fasta file that is written
+    node -- the node the query is to be classified as
+    scheme -- the compiled Scheme of the organism
+    references -- the reference sequences, keyed by strain
+    rng -- the random.Random of the simulation
+
+    The query holds a copy of every reference, so that each alignment
+    finds the SNPs of its strain, cut into contigs named the way
+    stand_in_mauve.py reads them.
+
+    '''
+    lineage = set(scheme.lineage(node))
+    query = open(file_name, "w")
+    for strain in sorted(references):
+        genome = bytearray(references[strain])
+        snp_positions = set()
+        for snp, snp_strain, position, derived, ancestral in scheme.snp_rows():
+            if snp_strain == strain:
+                genome[position - 1] = str(derived if snp in lineage else ancestral)
+                snp_positions.add(position - 1)
+        for i in xrange(int(len(genome) * arguments.mutation_rate)):
+            position = rng.randrange(len(genome))
+            if position not in snp_positions:
+                genome[position] = rng.choice(BASES.replace(chr(genome[position]), ""))
+        genome = str(genome)
+        for number, start in enumerate(xrange(0, len(genome), arguments.contig_length)):
+            contig = genome[start:start + arguments.contig_length]
+            strand = "+"
+            if number % 2:
+                contig = reverse_complement(contig)
+                strand = "-"
+            query.write(">%s.%s|%i %i-%i %s\n" % (ORGANISM, strain, number, start + 1,
+                                                  start + len(contig), strand))
+            for line in xrange(0, len(contig), 80):
+                query.write(contig[line:line + 80] + "\n")
+    query.close()
+
+
+def time_stages(file_name, scheme, config, c, export=True):
+    '''Types one query stage by stage and returns the time of each stage and the classification.
+
+    Keyword arguments:
+    file_name -- the query fasta file
+    scheme -- the compiled Scheme of the organism
+    export -- export the references into an empty reference cache, else
+              use the files already in the cache
+
+    '''
+    timings = dict()
+    if export:
+        shutil.rmtree(config["reference_cache"], ignore_errors=True)
+    start = time.time()
+    if config["snp_window"]:
+        references = cansnper.export_snp_windows(scheme, config, c)
+    else:
+        references = cansnper.export_references(ORGANISM, config, c)
+    timings["reference export"] = time.time() - start
+
+    output = "%s/benchmark.%s.CanSNPer" % (config["tmp_path"], path.basename(file_name))
+    start = time.time()
+    finished = list(cansnper.run_alignments(file_name, references, output, config))
+    timings["alignment"] = time.time() - start
+
+    start = time.time()
+    sequences = dict()
+    windows = dict()
+    aligner = cansnper.make_aligner(config)
+    for strain, uid, reference_file in finished:
+        sequences[strain] = aligner.project(aligner.output_file("%s.%s" % (output, uid)), reference_file, file_name)
+        windows[strain] = cansnper.read_windows(reference_file) if config["snp_window"] else None
+    timings["projection"] = time.time() - start
+
+    start = time.time()
+    alternates = dict()
+    for strain in sequences:
+        reference, alternate = sequences[strain][0][1], sequences[strain][1][1]
+        cansnper.alignment_stats(reference, alternate, config["stats_window"], windows[strain])
+        alternates[strain] = cansnper.lift(alternate, windows[strain]) if windows[strain] else alternate
+    timings["identity"] = time.time() - start
+
+    start = time.time()
+    tree_location = cansnper.multi_tree_walker(scheme.root, alternates, scheme, config["allow_differences"],
+                                               list(), config, bool(config["allow_differences"]))
+    timings["tree walk"] = time.time() - start
+
+    start = time.time()
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        out_name = path.basename(file_name)
+        cansnper.report_result(out_name, tree_location, scheme, dict(), config)
+        snp_file = open("%s_snplist.txt" % file_name, "w")
+        for snp in cansnper.snp_lister(alternates, scheme, out_name, config):
+            snp_file.write("\t".join(snp) + "\n")
+        snp_file.close()
+    finally:
+        sys.stdout = stdout
+    timings["output"] = time.time() - start
+
+    for strain, uid, reference_file in references:
+        cansnper.silent_remove("%s.%s.xmfa" % (output, uid))
+    return timings, tree_location[0]
+
+
+def time_batch(query_files, config, c):
+    '''Returns the time type_queries takes to type a batch, its printout discarded.'''
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        start = time.time()
+        cansnper.type_queries(query_files, config, c)
+        return time.time() - start
+    finally:
+        sys.stdout = stdout
+
+
+def fastest_stages(function, repeats):
+    '''Returns the timings and classification of the fastest of a number of time_stages calls.'''
+    return min([function() for i in range(repeats)], key=lambda result: sum(result[0].values()))
+
+
+def main():
+    arguments = parse_arguments()
+    work_dir = arguments.work_dir or tempfile.mkdtemp(prefix="CanSNPer_benchmark_")
+    try:
+        if not path.isdir(work_dir):
+            makedirs(work_dir)
+        config = make_config(work_dir, arguments)
+        cnx = cansnper.sqlite3.connect(config["db_path"])
+        c = cnx.cursor()
+        cansnper.migrate_database(config, c)
+        c.execute("SELECT COUNT(*) FROM Sequences WHERE Organism = ?", (ORGANISM,))
+        if not c.fetchone()[0]:
+            print("#Building the benchmark database in %s ..." % work_dir)
+            build_database(config, c)
+
+        start = time.time()
+        scheme = cansnper.load_scheme(ORGANISM, config, c)
+        load_time = time.time() - start
+
+        # Simulate the batch
+        rng = random.Random(arguments.seed)
+        if arguments.nodes:
+            nodes = arguments.nodes.split(",")
+        else:
+            nodes = [node for node in scheme.node_names if scheme.snp(node)]
+            nodes = [rng.choice(nodes) for i in range(arguments.samples)]
+        nodes = [nodes[i % len(nodes)] for i in range(arguments.samples)]
+        references = dict((strain, read_sequence(ORGANISM, strain, c)) for strain in sorted(SEQUENCE_FILES))
+        query_files = list()
+        start = time.time()
+        for i, node in enumerate(nodes):
+            file_name = path.join(work_dir, "query_%i.fa" % i)
+            simulate_query(file_name, node, scheme, references, arguments, rng)
+            query_files.append(file_name)
+        print("#Simulated %i queries in %.2f s" % (len(query_files), time.time() - start))
+
+        # One sample, from an empty reference cache, and the batch from a warm one
+        single, classification = fastest_stages(lambda: time_stages(query_files[0], scheme, config, c),
+                                                arguments.repeats)
+        single["load scheme"] = load_time
+        batch = dict((stage, 0.0) for stage in STAGES)
+        batch["load scheme"] = load_time
+        classifications = list()
+        for file_name in query_files:
+            timings, node = fastest_stages(lambda: time_stages(file_name, scheme, config, c, False),
+                                           arguments.repeats)
+            classifications.append(node)
+            for stage in timings:
+                batch[stage] += timings[stage]
+        end_to_end = {"serial": min(time_batch(query_files, config, c) for i in range(arguments.repeats))}
+        if arguments.parallel_samples > 1:
+            parallel_config = make_config(work_dir, arguments, ["--parallel_samples", str(arguments.parallel_samples)])
+            end_to_end["parallel_samples=%i" % arguments.parallel_samples] = \
+                min(time_batch(query_files, parallel_config, c) for i in range(arguments.repeats))
+
+        print("#Stage\tOne sample (s)\tBatch of %i (s)" % len(query_files))
+        for stage in STAGES:
+            print("%s\t%.3f\t%.3f" % (stage, single[stage], batch[stage]))
+        print("total\t%.3f\t%.3f" % (sum(single.values()), sum(batch.values())))
+        for run in sorted(end_to_end):
+            print("type_queries %s\t\t%.3f" % (run, end_to_end[run]))
+        wrong = [(node, found) for node, found in zip(nodes, classifications) if node != found]
+        if wrong:
+            print("#%i queries were not classified as the node they were simulated from: %s" % (len(wrong), wrong))
+
+        if arguments.json:
+            json_file = open(arguments.json, "w")
+            json.dump({"samples": len(query_files), "nodes": nodes, "classifications": classifications,
+                       "one_sample": single, "batch": batch, "type_queries": end_to_end,
+                       "settings": vars(arguments)}, json_file, indent=1, sort_keys=True)
+            json_file.close()
+        cnx.close()
+    finally:
+        if not arguments.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
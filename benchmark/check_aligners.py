@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+check_aligners.py: Checks the projections of recorded aligner output.
+This file is part of CanSNPer.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+The files in recorded/ are the output of nucmer and minimap2 for a query
+of three contigs aligned to a 20 base reference: ctg1 has a substitution,
+a deleted reference base and an inserted base, ctg2 is the reverse
+complement of ctg1, and other aligns to the start of the reference before
+ctg1 does. The minimap2 files also have a secondary alignment, and one has
+no cs tags. Each file is projected with the aligner that wrote it, and the
+query has to come out as in expected.fa, or the error has to be raised.
+
+    python benchmark/check_aligners.py
+'''
+import sys
+from os import path
+
+BENCHMARK_DIR = path.dirname(path.abspath(__file__))
+RECORDED_DIR = path.join(BENCHMARK_DIR, "recorded")
+sys.path.insert(0, path.dirname(BENCHMARK_DIR))
+from CanSNPer.aligners import NucmerAligner, Minimap2Aligner
+from CanSNPer.fasta import read_fasta
+
+REFERENCE = path.join(RECORDED_DIR, "reference.fa")
+QUERY = path.join(RECORDED_DIR, "query.fa")
+EXPECTED = path.join(RECORDED_DIR, "expected.fa")
+
+# The recorded files, the aligner that wrote them and whether projecting them fails
+RECORDED = [("nucmer.delta", NucmerAligner, False),
+            ("nucmer_reverse.delta", NucmerAligner, False),
+            ("minimap2.paf", Minimap2Aligner, False),
+            ("minimap2_reverse.paf", Minimap2Aligner, False),
+            ("minimap2_no_cs.paf", Minimap2Aligner, True)]
+
+
+def check(alignment_file, aligner, fails, expected):
+    '''Projects a recorded file, returns None if it came out as expected, else what went wrong.'''
+    try:
+        projection = aligner(None).project(path.join(RECORDED_DIR, alignment_file), REFERENCE, QUERY)
+    except ValueError as e:
+        if fails:
+            return None
+        return str(e)
+    if fails:
+        return "no error"
+    query = projection[1][1]
+    if query != expected:
+        return "%s, expected %s" % (query, expected)
+    return None
+
+
+def main():
+    expected = [sequence for name, sequence in read_fasta(EXPECTED)][0]
+    failed = 0
+    for alignment_file, aligner, fails in RECORDED:
+        error = check(alignment_file, aligner, fails, expected)
+        if error is None:
+            print("%s\tok" % alignment_file)
+        else:
+            print("%s\tFAILED: %s" % (alignment_file, error))
+            failed += 1
+    if failed:
+        sys.exit("%i of %i recorded files projected wrong" % (failed, len(RECORDED)))
+
+
+if __name__ == '__main__':
+    main()
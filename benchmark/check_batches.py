@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+check_batches.py: Checks that a batch typed in parallel stops at a failed sample.
+This file is part of CanSNPer.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Builds the benchmark database and simulates queries as benchmark.py does,
+and types them from the command line with --parallel_samples, with a query
+that has an invalid base second in the batch. CanSNPer has to exit with the
+error of that query within TIMEOUT seconds, instead of hanging on the pool
+of sample workers, and leave no tmp files behind. Takes the options of
+benchmark.py, e.g.
+
+    python benchmark/check_batches.py [--samples 4] [--parallel_samples 2] [--aligner nucmer]
+'''
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from os import path, makedirs, listdir
+
+import benchmark
+from benchmark import cansnper, ORGANISM, SEQUENCE_FILES
+from CanSNPer.sequences import read_sequence
+
+# Seconds the batch may take before it counts as hung
+TIMEOUT = 300
+
+
+def main():
+    arguments = benchmark.parse_arguments()
+    work_dir = path.abspath(arguments.work_dir or tempfile.mkdtemp(prefix="CanSNPer_check_"))
+    try:
+        if not path.isdir(work_dir):
+            makedirs(work_dir)
+        config = benchmark.make_config(work_dir, arguments)
+        cnx = cansnper.sqlite3.connect(config["db_path"])
+        c = cnx.cursor()
+        cansnper.migrate_database(config, c)
+        c.execute("SELECT COUNT(*) FROM Sequences WHERE Organism = ?", (ORGANISM,))
+        if not c.fetchone()[0]:
+            print("#Building the benchmark database in %s ..." % work_dir)
+            benchmark.build_database(config, c)
+        scheme = cansnper.load_scheme(ORGANISM, config, c)
+        rng = random.Random(arguments.seed)
+        nodes = [node for node in scheme.node_names if scheme.snp(node)]
+        references = dict((strain, read_sequence(ORGANISM, strain, c)) for strain in sorted(SEQUENCE_FILES))
+        cnx.close()
+        query_files = list()
+        for i in range(arguments.samples):
+            file_name = path.join(work_dir, "query_%i.fa" % i)
+            benchmark.simulate_query(file_name, rng.choice(nodes), scheme, references, arguments, rng)
+            query_files.append(file_name)
+        bad_file = path.join(work_dir, "invalid.fa")
+        bad = open(bad_file, "w")
+        bad.write(">invalid\nACGTJACGT\n")
+        bad.close()
+        query_files.insert(1, bad_file)
+
+        command = [sys.executable, path.join(path.dirname(benchmark.BENCHMARK_DIR), "CanSNPer")] + \
+            benchmark.command_line(work_dir, arguments,
+                                   ["--parallel_samples", str(arguments.parallel_samples), "-i"] + query_files)
+        start = time.time()
+        errors = tempfile.TemporaryFile()  # Not a pipe, which a hung batch could fill
+        process = subprocess.Popen(command, stdout=open("/dev/null", "w"), stderr=errors, cwd=work_dir)
+        while process.poll() is None and time.time() - start < TIMEOUT:
+            time.sleep(0.1)
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+            sys.exit("FAILED: the batch was still running after %i s" % TIMEOUT)
+        errors.seek(0)
+        errors = errors.read()
+        print("#The batch exited with %i after %.2f s" % (process.returncode, time.time() - start))
+        failures = list()
+        if process.returncode == 0:
+            failures.append("it exited with 0")
+        if "[ERROR in %s]" % bad_file not in errors:
+            failures.append("the error of %s was not printed:\n%s" % (bad_file, errors))
+        if listdir(path.join(work_dir, "tmp")) != ["reference_cache"]:
+            failures.append("tmp files were left in %s" % path.join(work_dir, "tmp"))
+        if failures:
+            sys.exit("FAILED: " + "\n".join(failures))
+        print("ok")
+    finally:
+        if not arguments.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
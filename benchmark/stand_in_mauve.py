@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+stand_in_mauve.py: A deterministic stand-in for the aligners, for benchmarks.
+This file is part of CanSNPer.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Takes the same arguments as CanSNPer gives progressiveMauve:
+
+    stand_in_mauve.py --output=<xmfa> <reference fasta> <query fasta>
+
+and writes an xmfa file laid out like the progressiveMauve output: one
+block per aligned query contig, with the reference on the + strand and the
+contig on its own strand, plus a block of its own for every stretch of the
+reference and every query contig that is not aligned. Given the arguments
+CanSNPer gives nucmer (--prefix=<prefix>) it writes the same alignments
+to <prefix>.delta instead, and given those of minimap2 (-c) it writes
+them to stdout as PAF with cs tags. Nothing is searched
+for: the contigs written by benchmark.py carry the reference record and
+the interval they were copied from in their names,
+
+    ><reference record>|<contig number> <start>-<end> <strand>
+
+so only contigs copied from the reference are aligned, base for base.
+Other contigs, e.g. real assemblies, are left unaligned. A mini-reference
+of --snp_window, whose header lists the windows of the reference it is
+made of, gets the part of each contig that falls in each window.
+'''
+import sys
+
+LINE_LENGTH = 80
+WINDOWS_FIELD = "snp_windows="
+COMPLEMENTS = dict(zip("ACGTNacgtn", "TGCANtgcan"))
+
+
+def read_fasta(file_name):
+    '''Returns the (header, sequence) records of a fasta file.'''
+    records = list()
+    header = None
+    lines = list()
+    fasta = open(file_name, "r")
+    for line in fasta:
+        if line.startswith(">"):
+            if header is not None:
+                records.append((header, "".join(lines)))
+            header = line[1:].strip()
+            lines = list()
+        else:
+            lines.append(line.strip())
+    if header is not None:
+        records.append((header, "".join(lines)))
+    fasta.close()
+    return records
+
+
+def reverse_complement(sequence):
+    return "".join(COMPLEMENTS.get(base, base) for base in reversed(sequence))
+
+
+def placement(header, reference_name):
+    '''Returns (start, end, strand) of a simulated contig on the reference, or None.'''
+    fields = header.split()
+    if len(fields) < 3 or fields[0].split("|")[0] != reference_name:
+        return None
+    start, end = fields[1].split("-")
+    return int(start), int(end), fields[2]
+
+
+def write_entry(xmfa, number, start, end, strand, file_name, sequence):
+    xmfa.write("> %i:%i-%i %s %s\n" % (number, start, end, strand, file_name))
+    for i in range(0, len(sequence), LINE_LENGTH):
+        xmfa.write(sequence[i:i + LINE_LENGTH] + "\n")
+
+
+def cs_tag(reference, contig):
+    '''Returns the minimap2 cs tag of a contig aligned base for base to a stretch of the reference.'''
+    operations = list()
+    matches = 0
+    for start in range(0, len(contig), LINE_LENGTH):
+        if reference[start:start + LINE_LENGTH] == contig[start:start + LINE_LENGTH]:
+            matches += len(contig[start:start + LINE_LENGTH])
+            continue
+        for reference_base, base in zip(reference[start:start + LINE_LENGTH], contig[start:start + LINE_LENGTH]):
+            if reference_base == base:
+                matches += 1
+                continue
+            if matches:
+                operations.append(":%i" % matches)
+                matches = 0
+            operations.append("*%s%s" % (reference_base.lower(), base.lower()))
+    if matches:
+        operations.append(":%i" % matches)
+    return "".join(operations)
+
+
+def reference_windows(header, length):
+    '''Returns the windows of a reference as (start, end, start in the file), one if it is not a mini-reference.'''
+    for field in header.split()[1:]:
+        if field.startswith(WINDOWS_FIELD):
+            windows = list()
+            position = 1
+            for window in field[len(WINDOWS_FIELD):].split(","):
+                start, end = [int(end) for end in window.split("-")]
+                windows.append((start, end, position))
+                position += end - start + 1
+            return windows
+    return [(1, length, 1)]
+
+
+def contig_pieces(place, contig, query_start, windows):
+    '''Returns the parts of a placed contig that fall in the windows of the reference, see main.'''
+    start, end, strand = place
+    forward = contig if strand == "+" else reverse_complement(contig)  # On the strand of the reference
+    pieces = list()
+    for window_start, window_end, position in windows:
+        first, last = max(start, window_start), min(end, window_end)
+        if first > last:
+            continue
+        # The part in the contig, 0-based and half open
+        if strand == "+":
+            contig_start, contig_end = first - start, last - start + 1
+        else:
+            contig_start, contig_end = end - last, end - first + 1
+        pieces.append((position + first - window_start, position + last - window_start,
+                       query_start + contig_start, query_start + contig_end - 1, strand,
+                       forward[first - start:last - start + 1], contig_start, contig_end))
+    return pieces
+
+
+def write_delta(output, reference_file, query_file, reference_name, reference, aligned):
+    '''Writes the alignments as a nucmer delta file, see main.'''
+    delta = open(output, "w")
+    delta.write("%s %s\nNUCMER\n" % (reference_file, query_file))
+    for start, end, query_start, query_end, strand, bases, contig_start, contig_end, header, length in aligned:
+        delta.write(">%s %s %i %i\n" % (reference_name, header.split()[0], len(reference), length))
+        if strand == "+":
+            delta.write("%i %i %i %i 0 0 0\n0\n" % (start, end, contig_start + 1, contig_end))
+        else:
+            delta.write("%i %i %i %i 0 0 0\n0\n" % (start, end, contig_end, contig_start + 1))
+    delta.close()
+
+
+def write_paf(reference_name, reference, aligned):
+    '''Writes the alignments to stdout as minimap2 PAF lines with cs tags, see main.'''
+    for start, end, query_start, query_end, strand, bases, contig_start, contig_end, header, length in aligned:
+        sys.stdout.write("\t".join([header.split()[0], str(length), str(contig_start), str(contig_end), strand,
+                                     reference_name, str(len(reference)), str(start - 1), str(end),
+                                     str(len(bases)), str(len(bases)), "60", "tp:A:P",
+                                     "cs:Z:%s" % cs_tag(reference[start - 1:end], bases)]) + "\n")
+
+
+def main(arguments):
+    reference_file, query_file = arguments[-2:]
+    reference_header, reference = read_fasta(reference_file)[0]
+    reference_name = reference_header.split()[0]
+    windows = reference_windows(reference_header, len(reference))
+
+    # Query contigs in the coordinates of the concatenated query, like progressiveMauve
+    aligned = list()  # (reference start, reference end, query start, query end, strand, bases,
+    #                   start and end in the contig, contig header, contig length)
+    unaligned = list()  # (query start, query end, contig)
+    query_position = 1
+    for header, contig in read_fasta(query_file):
+        query_start, query_end = query_position, query_position + len(contig) - 1
+        query_position += len(contig)
+        if not contig:
+            continue
+        place = placement(header, reference_name)
+        pieces = list()
+        if place and place[1] - place[0] + 1 == len(contig):
+            pieces = contig_pieces(place, contig, query_start, windows)
+        if pieces:
+            aligned.extend(piece + (header, len(contig)) for piece in pieces)
+        else:
+            unaligned.append((query_start, query_end, contig))
+    aligned.sort()
+    kept = list()  # Pieces that overlap an earlier one are left unaligned
+    covered = 0  # The reference is covered up to here
+    for piece in aligned:
+        if piece[0] > covered:
+            kept.append(piece)
+            covered = piece[1]
+
+    prefixes = [argument for argument in arguments if argument.startswith("--prefix=")]
+    if prefixes:
+        write_delta("%s.delta" % prefixes[0].split("=", 1)[1], reference_file, query_file, reference_name,
+                    reference, kept)
+        return
+    if "-c" in arguments:
+        write_paf(reference_name, reference, kept)
+        return
+
+    output = [argument for argument in arguments if argument.startswith("--output=")][0].split("=", 1)[1]
+    xmfa = open(output, "w")
+    xmfa.write("#FormatVersion Mauve1\n")
+    for number, file_name in ((1, reference_file), (2, query_file)):
+        xmfa.write("#Sequence%iFile\t%s\n#Sequence%iFormat\tFastA\n" % (number, file_name, number))
+    covered = 0
+    for start, end, query_start, query_end, strand, bases, contig_start, contig_end, header, length in kept:
+        if start > covered + 1:
+            write_entry(xmfa, 1, covered + 1, start - 1, "+", reference_file, reference[covered:start - 1])
+            xmfa.write("=\n")
+        write_entry(xmfa, 1, start, end, "+", reference_file, reference[start - 1:end])
+        # The query is written as it aligns to the + strand of the reference
+        write_entry(xmfa, 2, query_start, query_end, strand, query_file, bases)
+        xmfa.write("=\n")
+        covered = end
+    if covered < len(reference):
+        write_entry(xmfa, 1, covered + 1, len(reference), "+", reference_file, reference[covered:])
+        xmfa.write("=\n")
+    for query_start, query_end, contig in sorted(unaligned):
+        write_entry(xmfa, 2, query_start, query_end, "+", query_file, contig)
+        xmfa.write("=\n")
+    xmfa.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])